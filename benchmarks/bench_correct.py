@@ -0,0 +1,50 @@
+import logging
+import os
+import sys
+import timeit
+
+import click
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))     # 不在benchmarks目录下运行时也能导入generators
+from generators import make_balance_table
+from open_budget.parser.pdf_parser import BaseParser
+
+
+def correct_iterrows(df: pd.DataFrame):
+    """ 原来逐个单元格处理的实现, 作为对照 """
+    max_row, max_col = df.shape
+    for index, series in df.iterrows():
+        for c, text in series.items():
+            is_merge, divided_cells = BaseParser.split_merge_cell(text)
+            if is_merge:
+                if c >= 1 and df.iloc[index, c - 1] == '':
+                    df.iloc[index, c - 1], df.iloc[index, c] = divided_cells
+                elif c <= max_col - 2 and df.iloc[index, c + 1] == '':
+                    df.iloc[index, c], df.iloc[index, c + 1] = divided_cells
+
+
+@click.command()
+@click.option('--rows', default='50,500,5000',
+              help="Comma separated row counts of the tables. Defaults to '50,500,5000'")
+@click.option('--repeat', default=5, type=int, help="Repeat times, the best is reported. Defaults to 5")
+def run(rows, repeat):
+    """ BaseParser.correct的微基准, 和逐个单元格处理的实现对比.
+    Examples:
+    $python benchmarks/bench_correct.py --rows 50,500
+    """
+    logging.disable(logging.WARNING)
+    for n in [int(r) for r in rows.split(',')]:
+        table = make_balance_table(n)
+        expected, actual = table.copy(), table.copy()
+        correct_iterrows(expected)
+        BaseParser.correct(actual)
+        assert expected.equals(actual)
+        t_old = min(timeit.repeat(lambda: correct_iterrows(table.copy()), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: BaseParser.correct(table.copy()), number=1, repeat=repeat))
+        click.echo(f'rows={n:>6}  iterrows {t_old * 1000:9.2f} ms  vectorized {t_new * 1000:8.2f} ms  '
+                   f'speedup {t_old / t_new:6.1f}x')
+
+
+if __name__ == '__main__':
+    run()
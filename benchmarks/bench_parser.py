@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import platform
+import sys
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+import click
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)   # 不在benchmarks目录下运行时也能导入generators
+from generators import make_balance_table, make_parsed_df, make_split_tables
+from open_budget.parser.pdf_parser import BACKENDS, BalanceParser, DeptFilesParser, ParseError
+from open_budget.parser.table_cache import CachedTable, TableCache
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+PDF_DIR = os.path.join(BENCH_DIR, '..', 'pdf_files', 'jszwfw')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+@click.command()
+@click.option('--suite', '-s',
+              multiple=True, default=['synthetic', 'fixtures'], type=click.Choice(['synthetic', 'fixtures', 'pdf']),
+              help="Suites to run, can be given more than once. Defaults to synthetic and fixtures")
+@click.option('--repeat', default=5, type=int, help="Repeat times, the best is reported. Defaults to 5")
+@click.option('--output', '-o', default=None, type=click.Path(), help="Write the results to a json file")
+@click.option('--baseline', default=BASELINE_PATH, type=click.Path(),
+              help="Baseline results to compare with. Defaults to benchmarks/baseline.json")
+@click.option('--save-baseline', is_flag=True, help="Save the results as the new baseline")
+@click.option('--threshold', default=0.3, type=float,
+              help="Flag a case as a regression when its throughput relative to the calibration loop drops by more "
+                   "than this ratio. Defaults to 0.3")
+@click.option('--make-fixtures', is_flag=True,
+              help="Extract the tables of the pdf files in pdf_files/jszwfw to benchmarks/fixtures, then exit")
+def run(suite, repeat, output, baseline, save_baseline, threshold, make_fixtures):
+    """ 解析模块的基准测试, 分三个层次:
+    synthetic: 生成的收支预算总表, 测试correct, get_df, correct_wrong_new_line和parse_tables;
+    fixtures: benchmarks/fixtures里保存的camelot解析结果, 不运行camelot, 测试parsers;
+    pdf: pdf_files/jszwfw里真实的pdf文件, 包括提取table, 每个backend分别测试, 耗时较长.
+    每次运行在用例前后给固定的校准循环(calibration_work)计时, 每个用例的吞吐量乘以校准循环的耗时, 得到和机器速度
+    无关的相对吞吐量(relative), 即校准循环耗时内完成的工作量. 和baseline比较相对吞吐量,
+    下降超过threshold的用例标记为退化, 返回码为1. 运行出错的用例也让返回码为1.
+    Examples:
+    $python benchmarks/bench_parser.py
+    $python benchmarks/bench_parser.py --suite pdf --repeat 1
+    $python benchmarks/bench_parser.py --save-baseline
+    $python benchmarks/bench_parser.py --make-fixtures
+    """
+    logging.disable(logging.WARNING)
+    if make_fixtures:
+        for path in write_fixtures(PDF_DIR, FIXTURES_DIR):
+            click.echo('保存fixture到 >> ' + path)
+        return
+    suites = {'synthetic': bench_synthetic, 'fixtures': bench_fixtures, 'pdf': bench_pdf}
+    calibration = best_time(calibration_work, max(repeat, 5))
+    results: Dict[str, dict] = dict()
+    errors: List[str] = list()
+    for name in suite:
+        results.update(suites[name](repeat, errors))
+    calibration = min(calibration, best_time(calibration_work, max(repeat, 5)))     # 前后各测一次, 减少干扰
+    click.echo(f'校准循环耗时 {calibration * 1000:.2f}ms')
+    for case in results.values():
+        case['relative'] = case['throughput'] * calibration
+    baseline_results = dict()
+    if os.path.exists(baseline) and not save_baseline:
+        with open(baseline, encoding='utf-8') as f:
+            baseline_results = json.load(f)['cases']
+    regressions = report(results, baseline_results, threshold)
+    data = {'python': platform.python_version(), 'pandas': pd.__version__, 'calibration': calibration,
+            'cases': results}
+    for path in [output] + ([baseline] if save_baseline else []):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+            click.echo('保存结果到 >> ' + path)
+    if errors:
+        click.secho(f'{len(errors)}个用例出错: ' + ', '.join(errors), fg='red')
+    if regressions:
+        click.secho(f'{len(regressions)}个用例性能退化: ' + ', '.join(regressions), fg='red')
+    if errors or regressions:
+        sys.exit(1)
+
+
+def best_time(func: Callable, repeat: int) -> float:
+    """ 每轮运行足够多次(至少0.2秒)以减少计时误差, 返回repeat轮中最快的单次耗时 """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def calibration_work():
+    """ 校准循环: 固定的计算量, 和解析模块一样是Python循环加上pandas的字符串和数值操作 """
+    total = 0
+    for i in range(20000):
+        total += i * i % 7
+    s = pd.Series([f'{i:,}.00' for i in range(2000)])
+    return total + pd.to_numeric(s.str.replace(',', '', regex=False)).sum()
+
+
+def runs(func: Callable, name, errors: List[str]) -> bool:
+    """ 先运行一次, 出错的用例记到errors里, 不计时 """
+    try:
+        func()
+        return True
+    except Exception as e:
+        click.secho(f'{name} 出错: {e!r}', fg='red')
+        errors.append(name)
+        return False
+
+
+def result(seconds: float, work: float, unit: str) -> dict:
+    return {'seconds': seconds, 'throughput': work / seconds, 'unit': unit}
+
+
+def parsed_df(rows: List[pd.DataFrame]) -> pd.DataFrame:
+    """ 逐年合并解析结果, 读取时逐年纠正错误换行 """
+    parser = BalanceParser()
+    for row in rows:
+        parser.merge(row)
+    return parser.parsed_df
+
+
+def bench_synthetic(repeat, errors) -> Dict[str, dict]:
+    results = dict()
+    for rows in (50, 500, 5000):
+        table = make_balance_table(rows)
+        t = best_time(lambda: BalanceParser.correct(table.copy()), repeat)
+        results[f'synthetic/correct/rows={rows}'] = result(t, table.size, 'cells/s')
+    for rows, parts in ((50, 1), (500, 4)):
+        tables = make_split_tables(rows, parts)
+        t = best_time(lambda: BalanceParser().get_df(tables, 0), repeat)
+        results[f'synthetic/get_df/rows={rows},parts={parts}'] = result(t, rows, 'rows/s')
+    for items, pairs in ((100, 10), (2000, 200)):
+        df = make_parsed_df(10, items, pairs)
+        t = best_time(lambda: BalanceParser.correct_wrong_new_line(df.copy()), repeat)
+        columns = len(df.columns)
+        results[f'synthetic/correct_wrong_new_line/columns={columns}'] = result(t, columns, 'columns/s')
+    for years in (10, 100):
+        df = make_parsed_df(years, 400, 40)
+        rows = [df.iloc[[k]].dropna(axis=1) for k in range(years)]     # 每年只有出现的项目
+        t = best_time(lambda: parsed_df(rows), repeat)
+        results[f'synthetic/parsed_df/years={years}'] = result(t, years, 'years/s')
+    for noise in (10, 200):
+        tables = make_split_tables(50, 2, noise)
+        parse = lambda: DeptFilesParser('bench', BENCH_DIR).parse_tables(tables, 'bench2019.pdf', 2019)
+        t = best_time(parse, repeat)
+        results[f'synthetic/parse_tables/tables={len(tables)}'] = result(t, len(tables), 'tables/s')
+    return results
+
+
+def bench_fixtures(repeat, errors) -> Dict[str, dict]:
+    results = dict()
+    for dept_name, files in load_fixtures(FIXTURES_DIR).items():
+        def parse():
+            parser = DeptFilesParser(dept_name, BENCH_DIR)
+            for file_name, year, tables in files:
+                parser.parse_tables(tables, file_name, year)
+            return parser.parsers[0].parsed_df     # 读取时才合并结果
+        if not runs(parse, f'fixtures/{dept_name}', errors):
+            continue
+        t = best_time(parse, repeat)
+        results[f'fixtures/{dept_name}'] = result(t, sum(len(tables) for _, _, tables in files), 'tables/s')
+    return results
+
+
+def bench_pdf(repeat, errors) -> Dict[str, dict]:
+    results = dict()
+    for backend in BACKENDS:
+        for dept_name in sorted(os.listdir(PDF_DIR)):
+            path = os.path.join(PDF_DIR, dept_name)
+            if dept_name.startswith('.') or not os.path.isdir(path):
+                continue
+            parsers = list()
+
+            def parse():
+                parser = DeptFilesParser(dept_name, path, backend=backend)     # 不使用缓存
+                parser.parse()
+                parsers.append(parser)
+            name = f'pdf/{backend}/{dept_name}'
+            if not runs(parse, name, errors):
+                continue
+            t = best_time(parse, repeat)
+            results[name] = result(t, parsers[-1].pages_total, 'pages/s')
+    return results
+
+
+def write_fixtures(pdf_dir, fixtures_dir) -> List[str]:
+    """ 把pdf文件里需要解析的页的camelot结果保存为json, 每个pdf一个文件. 解析出错(会被隔离)的文件不保存 """
+    res = list()
+    cache = TableCache()
+    for dept_name in sorted(os.listdir(pdf_dir)):
+        path = os.path.join(pdf_dir, dept_name)
+        if dept_name.startswith('.') or not os.path.isdir(path):
+            continue
+        parser = DeptFilesParser(dept_name, path, cache)
+        os.makedirs(os.path.join(fixtures_dir, dept_name), exist_ok=True)
+        for file_path, year in sorted(parser.list_files()):
+            tables = parser._read_tables(file_path)
+            try:
+                DeptFilesParser(dept_name, path).parse_tables(tables, os.path.basename(file_path), year)
+            except ParseError as e:
+                click.secho(f'{file_path} 解析出错, 不保存fixture: {e}', fg='yellow')
+                continue
+            data = {'year': year, 'tables': [{'page': table.page, 'data': table.df.values.tolist()}
+                                             for table in tables]}
+            fixture_path = os.path.join(fixtures_dir, dept_name, os.path.basename(file_path) + '.json')
+            with open(fixture_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            res.append(fixture_path)
+    return res
+
+
+def load_fixtures(fixtures_dir) -> Dict[str, List[Tuple[str, int, List[CachedTable]]]]:
+    """ 读取fixtures, 返回 {部门: [(pdf文件名, 年度, tables)]} """
+    res = dict()
+    if not os.path.exists(fixtures_dir):
+        return res
+    for dept_name in sorted(os.listdir(fixtures_dir)):
+        files = list()
+        for name in sorted(os.listdir(os.path.join(fixtures_dir, dept_name))):
+            with open(os.path.join(fixtures_dir, dept_name, name), encoding='utf-8') as f:
+                data = json.load(f)
+            tables = [CachedTable(table['page'], table['data']) for table in data['tables']]
+            files.append((name[:-len('.json')], data['year'], tables))
+        res[dept_name] = files
+    return res
+
+
+def report(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """ 打印结果, 返回性能退化的用例 """
+    regressions = list()
+    for name, case in results.items():
+        line = f'{name:<55} {case["throughput"]:>14,.1f} {case["unit"]:<10}'
+        base = baseline.get(name)
+        if base and 'relative' in base:
+            change = case['relative'] / base['relative'] - 1
+            line += f' {change:+8.1%}'
+            if change < -threshold:
+                regressions.append(name)
+                click.secho(line + '  REGRESSION', fg='red')
+                continue
+        click.echo(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,46 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from open_budget.parser.table_cache import CachedTable
+
+HEAD = [['收入', '收入', '支出', '支出', '支出', '支出'],
+        ['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途'],
+        ['', '', '功能科目名称', '金额', '项目名称', '金额']]
+TAIL = ['收入合计', '24,458.43', '支出合计', '24,458.43', '', '']
+
+
+def make_balance_table(rows: int) -> pd.DataFrame:
+    """ 生成收支预算总表形状的camelot table, 每隔几行有一个camelot合并错误的单元格 """
+    data = [list(row) for row in HEAD]
+    for i in range(rows):
+        if i % 4 == 0:
+            data.append(['', '24,458.43二、财政专户管理资金', f'{i}.一般公共服务支出', '1,364.00', '一、基本支出', '20,153.75'])
+        else:
+            data.append([f'{i}.一般公共预算', '24,458.43', '二、外交支出', '', '二、项目支出', '4,335.30'])
+    data.append(list(TAIL))
+    return pd.DataFrame(data)
+
+
+def make_split_tables(rows: int, parts: int, noise: int = 0) -> List[CachedTable]:
+    """ 生成跨parts页的收支预算总表, 每页是一个table, 前面有noise个不相关的table. 用于get_df和parse_tables """
+    tables = [CachedTable(str(page), [['说明', f'第{page}页']]) for page in range(1, noise + 1)]
+    table = make_balance_table(rows)
+    for k, chunk in enumerate(np.array_split(np.arange(len(table)), parts)):
+        tables.append(CachedTable(str(noise + k + 1), table.iloc[chunk].values.tolist()))
+    return tables
+
+
+def make_parsed_df(years: int, items: int, pairs: int) -> pd.DataFrame:
+    """ 生成解析结果形状的DataFrame(行是年度, 列是项目), 其中pairs对列是camelot错误换行拆开的:
+    列名是截断关系(比如'一般公共服务支出'和'一般公共服务支出其他'), 数据互补 """
+    rng = np.random.default_rng(0)
+    index = pd.to_datetime([f'{2000 + year}-01-01' for year in range(years)])
+    data = {f'项目{k}': rng.random(years) * 1000 for k in range(items)}
+    for k in range(pairs):
+        values = rng.random(years) * 1000
+        odd = np.arange(years) % 2 == 1
+        data[f'支出{k}'] = np.where(odd, np.nan, values)
+        data[f'支出{k}其他'] = np.where(odd, values, np.nan)
+    return pd.DataFrame(data, index=index)
@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from open_budget.parser.table_cache import file_sha256
+
+
+class Manifest:
+    """ 部门目录下已经解析过的pdf文件清单, 用于增量解析.
+    每个pdf文件记录内容的sha256, mtime, size, 以及解析出来的 {table_name: [年度]}.
+    文件内容和另一个文件相同时, 记录duplicate_of, 不再解析.
+    parser_version和清单里的不一致时, 清空清单, 所有文件重新解析. 部门有参数配置时, parser_version带上配置的摘要.
+    """
+    file_name = '.manifest.json'
+
+    def __init__(self, path, parser_version: Union[int, str]):
+        self.file_path = os.path.join(path, self.file_name)
+        self.parser_version = parser_version
+        self.files: Dict[str, dict] = dict()
+        if os.path.exists(self.file_path):
+            with open(self.file_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('parser_version') == parser_version:
+                self.files = data.get('files', dict())
+            else:
+                logging.info(f'{self.file_path} 解析程序版本变化, 重新解析所有文件')
+
+    def save(self):
+        data = {'parser_version': self.parser_version, 'files': self.files}
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.file_path)
+
+    def clear(self):
+        self.files = dict()
+
+    def retain(self, names: Iterable[str]):
+        """ 删除已经不存在的文件 """
+        names = set(names)
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+
+    def is_unchanged(self, file_path) -> bool:
+        """ 文件是否已经解析过并且没有变化. mtime和size没变时不计算hash """
+        entry = self.files.get(os.path.basename(file_path))
+        if entry is None:
+            return False
+        duplicate_of = entry.get('duplicate_of')
+        if duplicate_of and self.files.get(duplicate_of, {}).get('sha256') != entry['sha256']:
+            return False    # 原文件已经变化, 这个文件不再是重复文件
+        stat = os.stat(file_path)
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return True
+        if entry['sha256'] == file_sha256(file_path):
+            entry['mtime'] = stat.st_mtime     # 只是mtime变化(比如重新下载), 内容没变
+            return True
+        return False
+
+    def duplicate_of(self, file_path, sha256) -> Optional[str]:
+        """ 返回内容相同的另一个文件名 """
+        name = os.path.basename(file_path)
+        for other, entry in self.files.items():
+            if other != name and entry['sha256'] == sha256 and not entry.get('duplicate_of'):
+                return other
+        return None
+
+    def record(self, file_path, sha256, tables: Dict[str, List[int]] = None, duplicate_of: str = None):
+        stat = os.stat(file_path)
+        entry = {'sha256': sha256, 'mtime': stat.st_mtime, 'size': stat.st_size, 'tables': tables or dict()}
+        if duplicate_of:
+            entry['duplicate_of'] = duplicate_of
+        self.files[os.path.basename(file_path)] = entry
+
+    def set_tables(self, name, tables: Dict[str, List[int]]):
+        self.files[name]['tables'] = tables
+
+    def years(self, table_name) -> Set[int]:
+        """ 清单里的文件解析出来的年度 """
+        res = set()
+        for entry in self.files.values():
+            res.update(entry['tables'].get(table_name, []))
+        return res
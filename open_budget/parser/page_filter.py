@@ -0,0 +1,74 @@
+import io
+import logging
+import re
+from typing import List, Sequence, Tuple
+
+from pdfminer.converter import TextConverter
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.pdfpage import PDFPage
+
+re_space = re.compile(r'\s+')
+
+
+def read_pages_text(file_path) -> List[str]:
+    """ 读取pdf每一页的文本层, 去掉空白字符. 不做版面分析(laparams=None), 比camelot解析快一个数量级 """
+    res = list()
+    manager = PDFResourceManager(caching=True)
+    with open(file_path, 'rb') as f:
+        for page in PDFPage.get_pages(f):
+            output = io.StringIO()
+            device = TextConverter(manager, output, laparams=None)
+            try:
+                PDFPageInterpreter(manager, device).process_page(page)
+            finally:
+                device.close()
+            res.append(re_space.sub('', output.getvalue()))
+    return res
+
+
+def count_pages(file_path) -> int:
+    """ pdf总页数, 只读取页面树, 不解析页面内容 """
+    with open(file_path, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+
+def find_pages(pages_text: List[str], head_keywords: Sequence[str], tail_keywords: Sequence[str],
+               max_following=3) -> List[int]:
+    """ 找出可能包含目标表格的页码(从1开始).
+    一页包含所有head_keywords, 说明表头在这一页. 如果这一页没有包含所有tail_keywords, 说明表格跨页,
+    继续加入后面的页, 直到找到表尾, 最多加入max_following页(get_df最多合并4个table).
+    """
+    pages = set()
+    for i, text in enumerate(pages_text):
+        if not all(k in text for k in head_keywords):
+            continue
+        pages.add(i + 1)
+        j = i
+        while j < i + max_following and j + 1 < len(pages_text) and not all(k in pages_text[j] for k in tail_keywords):
+            j += 1
+            pages.add(j + 1)
+    return sorted(pages)
+
+
+def select_pages(file_path, keywords: Sequence[Tuple[Sequence[str], Sequence[str]]]) -> Tuple[str, int]:
+    """ 返回camelot.read_pdf的pages参数和pdf总页数.
+    Parameters
+    ----------
+    file_path : pdf文件路径
+    keywords : [(head_keywords, tail_keywords)], 每个parser的表头和表尾关键字
+    Returns
+    -------
+    pages : str. 比如'7,8,9'; 读取不到文本层时返回'all'; 没有候选页时返回''
+    total : int. pdf总页数
+    """
+    try:
+        pages_text = read_pages_text(file_path)
+    except Exception as e:
+        logging.warning(f'读取{file_path}文本层出错, 解析所有页. {e}')
+        return 'all', 0
+    if not any(pages_text):     # 没有文本层, 比如扫描件
+        return 'all', len(pages_text)
+    pages = set()
+    for head_keywords, tail_keywords in keywords:
+        pages.update(find_pages(pages_text, head_keywords, tail_keywords))
+    return ','.join(str(page) for page in sorted(pages)), len(pages_text)
@@ -0,0 +1,88 @@
+import os
+import shutil
+from typing import Dict, List, Sequence
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.fs
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+SCHEMA = pa.schema([
+    ('table', pa.dictionary(pa.int32(), pa.string())),
+    ('item', pa.dictionary(pa.int32(), pa.string())),
+    ('amount', pa.float64()),
+])
+PARTITIONING = ds.partitioning(pa.schema([('department', pa.string()), ('year', pa.int32())]), flavor='hive')
+
+
+def to_long(table_name, parsed_df: pd.DataFrame) -> pd.DataFrame:
+    """ 把解析结果(行是年度, 列是项目)转换为长表: year, table, item, amount. 去掉没有数值的项目 """
+    df = parsed_df.copy()
+    df.index = pd.DatetimeIndex(df.index).year
+    df.index.name = 'year'
+    df.columns.name = 'item'
+    long = df.stack().rename('amount').reset_index()
+    long['table'] = table_name
+    return long[['year', 'table', 'item', 'amount']]
+
+
+class ParquetStore:
+    """ 所有部门解析结果的列式存储.
+    长表格式(department, year, table, item, amount), 按部门和年度分区保存为parquet文件:
+    root/department=江苏省人民检察院/year=2019/part-0.parquet
+    table和item用字典编码, amount是float64. 读取时用内存映射, 只读取需要的列和分区.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, dept_name, parsed_dfs: Dict[str, pd.DataFrame]):
+        """ 保存一个部门所有表的解析结果, 覆盖这个部门原来的数据 """
+        frames = [to_long(table_name, df) for table_name, df in parsed_dfs.items() if df is not None]
+        dept_dir = os.path.join(self.root, f'department={dept_name}')
+        tmp_dir = os.path.join(self.root, f'.{os.getpid()}.department={dept_name}')     # 以.开头, 读取时会忽略
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if frames:
+            long = pd.concat(frames, ignore_index=True)
+            for year, df in long.groupby('year'):
+                year_dir = os.path.join(tmp_dir, f'year={year}')
+                os.makedirs(year_dir)
+                table = pa.Table.from_pandas(df.drop(columns='year'), schema=SCHEMA, preserve_index=False)
+                pq.write_table(table, os.path.join(year_dir, 'part-0.parquet'))
+        shutil.rmtree(dept_dir, ignore_errors=True)
+        if frames:
+            os.rename(tmp_dir, dept_dir)
+        return dept_dir
+
+    def dataset(self) -> ds.Dataset:
+        return ds.dataset(self.root, format='parquet', partitioning=PARTITIONING,
+                          filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+
+    def read(self, columns: Sequence[str] = None, departments: Sequence[str] = None,
+             years: Sequence[int] = None, tables: Sequence[str] = None) -> pd.DataFrame:
+        """ 读取长表. columns只读取需要的列, departments/years/tables过滤分区和行 """
+        if not os.path.exists(self.root):
+            return pd.DataFrame(columns=columns or ['department', 'year', 'table', 'item', 'amount'])
+        expr = None
+        for name, values in (('department', departments), ('year', years), ('table', tables)):
+            if values is not None:
+                e = ds.field(name).isin(list(values))
+                expr = e if expr is None else expr & e
+        return self.dataset().to_table(columns=list(columns) if columns else None, filter=expr).to_pandas()
+
+    def read_dept(self, dept_name, table_name) -> pd.DataFrame:
+        """ 读取一个部门一个表的解析结果, 转换回和csv一样的宽表: 行是年度, 列是项目 """
+        long = self.read(columns=['year', 'item', 'amount'], departments=[dept_name], tables=[table_name])
+        long['item'] = long['item'].astype(str)
+        wide = long.pivot_table(index='year', columns='item', values='amount', aggfunc='first')
+        wide = wide.reindex(columns=long['item'].unique())    # 保持项目原来的顺序
+        wide.index = pd.to_datetime(wide.index.astype(str), format='%Y')
+        wide.index.name = None
+        wide.columns.name = None
+        return wide
+
+    def departments(self) -> List[str]:
+        if not os.path.exists(self.root):
+            return list()
+        return sorted(name[len('department='):] for name in os.listdir(self.root) if name.startswith('department='))
@@ -0,0 +1,118 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+DEPT_STAGE = ''     # 不属于某个文件的阶段(合并结果, 导出csv等), 记在部门上
+
+
+class ParseMetrics:
+    """ 解析过程的计时和计数, 按文件记录, 汇总到部门.
+    计时(秒): select_pages(读取文本层筛选页), cache_read, camelot或vector(提取table, 和backend同名),
+        parse(parsers解析tables, 包括get_df和correct; 流式解析时table是边提取边解析的, 也包括提取的时间),
+        get_df, correct, correct_wrong_new_line, to_csv, to_parquet, to_index, repair_extract(修复后在子进程里提取table).
+    计数: pages_scanned, pages_parsed, tables_extracted, tables_matched.<表名>, tables_unmatched,
+        merge_attempts(get_df尝试合并的table数), cells_repaired(correct分开的单元格数), cache_hits, cache_misses,
+        files_failed(第一次解析失败的文件数), files_repaired(修复后解析成功), files_quarantined(修复后仍然失败, 放进隔离区).
+    只有dict和数字, 可以pickle后从解析进程返回, 再用merge合并.
+    """
+
+    def __init__(self):
+        self.files: Dict[str, Dict[str, Dict[str, float]]] = dict()     # {文件名: {'timers': {}, 'counters': {}}}
+        self.current: str = DEPT_STAGE     # 正在解析的文件名
+
+    @contextmanager
+    def file(self, name):
+        """ 这个范围内的计时和计数记到文件name上 """
+        previous, self.current = self.current, name
+        self._stats(name)
+        try:
+            yield
+        finally:
+            self.current = previous
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timers = self._stats(self.current)['timers']
+            timers[stage] = timers.get(stage, 0.0) + time.perf_counter() - start
+
+    def timed(self, stage, iterable: Iterable) -> Iterator:
+        """ 逐个返回iterable的元素, 只把取下一个元素的时间记到stage上, 用于生成器 """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        counters = self._stats(self.current)['counters']
+        counters[name] = counters.get(name, 0) + n
+
+    def counter(self, name) -> int:
+        """ 所有文件的计数之和 """
+        return sum(stats['counters'].get(name, 0) for stats in self.files.values())
+
+    def merge(self, other: 'ParseMetrics'):
+        for name, stats in other.files.items():
+            mine = self._stats(name)
+            for kind in ('timers', 'counters'):
+                for key, value in stats[kind].items():
+                    mine[kind][key] = mine[kind].get(key, 0) + value
+
+    def totals(self) -> Dict[str, Dict[str, float]]:
+        res = {'timers': dict(), 'counters': dict()}
+        self.merge_into(res)
+        return res
+
+    def merge_into(self, res: Dict[str, Dict[str, float]]):
+        for stats in self.files.values():
+            for kind in ('timers', 'counters'):
+                for key, value in stats[kind].items():
+                    res[kind][key] = res[kind].get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        """ {'totals': 部门汇总, 'files': {文件名: 统计}}, 不属于某个文件的阶段只算在totals里 """
+        return {'totals': self.totals(),
+                'files': {name: stats for name, stats in sorted(self.files.items()) if name != DEPT_STAGE}}
+
+    def _stats(self, name) -> Dict[str, Dict[str, float]]:
+        stats = self.files.get(name)
+        if stats is None:
+            stats = self.files[name] = {'timers': dict(), 'counters': dict()}
+        return stats
+
+
+def write_metrics(file_path, dept_metrics: Dict[str, ParseMetrics]) -> dict:
+    """ 把每个部门的统计写到json文件, 返回写入的内容 """
+    totals = {'timers': dict(), 'counters': dict()}
+    for metrics in dept_metrics.values():
+        metrics.merge_into(totals)
+    data = {'totals': totals, 'departments': {name: metrics.to_dict() for name, metrics in dept_metrics.items()}}
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    return data
+
+
+@contextmanager
+def profiled(profile_dir: Optional[str], name):
+    """ profile_dir不为None时, 用cProfile统计这个范围, 保存到profile_dir/name.prof, 可以用snakeviz或pstats查看 """
+    if profile_dir is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(profile_dir, name + '.prof'))
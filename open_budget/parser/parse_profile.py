@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+# 部门目录下的参数配置文件, tune_params.py调优后写入, DeptFilesParser自动读取
+PROFILE_NAME = 'parse_profile.json'
+
+# 可以按部门调优的提取参数, READ_PDF_KWARGS里的同名参数
+TUNABLE = ('layout_kwargs', 'copy_text', 'strip_text')
+
+# 没有记录backend的配置是用vector后端调优的
+DEFAULT_BACKEND = 'vector'
+
+
+def profile_path(path) -> str:
+    return os.path.join(path, PROFILE_NAME)
+
+
+def load_profile(path, backend=None) -> dict:
+    """ 读取部门目录下的参数配置, 只返回TUNABLE里的参数, 没有配置时返回空dict.
+    backend不是None时, 只返回为这个backend调优的配置, 参数在别的backend上不一定好 """
+    data = _read(path)
+    if data is None or (backend is not None and data.get('backend', DEFAULT_BACKEND) != backend):
+        return dict()
+    return {key: data[key] for key in TUNABLE if key in data}
+
+
+def _read(path) -> Optional[dict]:
+    file_path = profile_path(path)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_profile(path, params: dict, tuning: dict, backend) -> str:
+    """ 保存用backend调优出来的参数, tuning是调优的记录(得分, 用到的文件, 时间), 只供查看 """
+    file_path = profile_path(path)
+    data = dict({key: params[key] for key in TUNABLE}, backend=backend, tuning=tuning)
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def remove_profile(path, backend=None) -> bool:
+    """ 删除参数配置, 返回是否删除了. backend不是None时, 只删除为这个backend调优的配置 """
+    data = _read(path)
+    if data is None or (backend is not None and data.get('backend', DEFAULT_BACKEND) != backend):
+        return False
+    os.remove(profile_path(path))
+    return True
+
+
+def apply_profile(read_kwargs: dict, profile: dict) -> dict:
+    """ 用配置覆盖read_kwargs里的参数, 返回新的dict. layout_kwargs按单个参数覆盖 """
+    res = dict(read_kwargs)
+    for key, value in profile.items():
+        if key == 'layout_kwargs':
+            res[key] = dict(read_kwargs.get(key) or {}, **value)
+        else:
+            res[key] = value
+    return res
+
+
+def profile_digest(profile: dict) -> Optional[str]:
+    """ 配置内容的摘要, 没有配置时返回None. 配置变化后, 增量解析需要重新解析这个部门的文件 """
+    if not profile:
+        return None
+    text = json.dumps(profile, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
@@ -3,43 +3,386 @@ from abc import ABCMeta, abstractmethod
 import pandas as pd
 import numpy as np
 import re
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Set, Type
+import json
 import logging
+import math
+import multiprocessing
 import os
-from operator import xor
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import click
+from open_budget.parser.table_cache import CachedTable, TableCache
+from open_budget.parser.page_filter import count_pages, select_pages
+from open_budget.parser.manifest import Manifest
+from open_budget.parser.table_cache import file_sha256
+from open_budget.parser.parquet_store import ParquetStore
+from open_budget.parser.sqlite_index import BudgetIndex
+from open_budget.parser.parse_metrics import ParseMetrics, profiled, write_metrics
+from open_budget.parser import vector_lattice
+from open_budget.parser.table_stream import TableWindow, page_batches
+from open_budget.parser.quarantine import Quarantine, call_with_timeout, failure_report, failure_summary, \
+    repair_pdf
+from open_budget.parser.parse_profile import apply_profile, load_profile, profile_digest
+
+# 解析程序的版本, 修改了解析逻辑(会改变解析结果)时加1, 增量解析时会重新解析所有文件
+PARSER_VERSION = 1
+
+# camelot.read_pdf的参数, 也作为缓存key的一部分. 部门目录下有为所用backend调优的参数配置(parse_profile.json,
+# 见tune_params.py)时, 用配置里的layout_kwargs, copy_text, strip_text覆盖
+READ_PDF_KWARGS = dict(
+    pages='all',
+    layout_kwargs={
+        'char_margin': 1.0,
+        'line_margin': 0.5,
+        'word_margin': 0.1,
+        'detect_vertical': False
+    },
+    copy_text=['h'], strip_text='\n',
+    flavor='lattice', suppress_stdout=True)
+
+# 提取table的后端. camelot: 把页面渲染成图片, 用OpenCV识别表格线; vector: 直接读取pdf的画线操作, 不渲染图片
+BACKENDS = ('camelot', 'vector')
+
+
+class ExtractError(Exception):
+    """ backend提取table出错, 原来的异常在__cause__里 """
+
+
+class ParseError(Exception):
+    """ parser解析table出错, 比如表头和预期的对不上. header是对不上的那一行表头 """
+
+    def __init__(self, message, header: List[str] = None):
+        super().__init__(message)
+        self.header = header
+
+    def __reduce__(self):
+        return type(self), (self.args[0], self.header)
 
 
 @click.command()
 @click.argument('path', default='../../pdf_files/jszwfw', type=click.Path(exists=True))
-def run(path):
+@click.option('--jobs', '-j',
+              default=1, type=int,
+              help="Number of worker processes parsing pdf files in parallel. Defaults to 1")
+@click.option('--no-cache', is_flag=True,
+              help="Do not read or write the cache of camelot results")
+@click.option('--refresh', is_flag=True,
+              help="Ignore cached camelot results, parse pdf files again and update the cache")
+@click.option('--cache-dir',
+              default=os.path.expanduser('~/.cache/open_budget/tables'), type=click.Path(),
+              help="Directory of the cache of camelot results. Defaults to '~/.cache/open_budget/tables'")
+@click.option('--cache-size',
+              default=1024, type=int,
+              help="Max size of the cache in MB, least recently used files are removed. Defaults to 1024")
+@click.option('--all-pages', is_flag=True,
+              help="Parse all pages with camelot, instead of the pages whose text matches the table keywords")
+@click.option('--full', is_flag=True,
+              help="Parse all pdf files again, instead of only the new or changed files in the manifest")
+@click.option('--output', '-o',
+              multiple=True, default=['csv'], type=click.Choice(['csv', 'parquet', 'sqlite']),
+              help="Output formats, can be given more than once, e.g. -o csv -o parquet -o sqlite. Defaults to csv")
+@click.option('--store',
+              default=None, type=click.Path(),
+              help="Directory of the parquet store. Defaults to the departments directory with suffix '.parquet'")
+@click.option('--index',
+              default=None, type=click.Path(),
+              help="SQLite index of line items. Defaults to the departments directory with suffix '.sqlite'")
+@click.option('--metrics',
+              default=None, type=click.Path(),
+              help="Write the timers and counters of every stage, per file and per department, to a json file")
+@click.option('--profile',
+              default=None, type=click.Path(),
+              help="Profile parsing every pdf file with cProfile, dump the stats to this directory")
+@click.option('--backend',
+              default='camelot', type=click.Choice(BACKENDS),
+              help="Table extraction backend. 'vector' rebuilds the tables from the line drawing operators of the pdf "
+                   "instead of rendering pages to images. Defaults to 'camelot'")
+@click.option('--batch-pages',
+              default=None, type=int,
+              help="Stream every pdf file: extract this many pages at a time and parse the tables as they come, "
+                   "so memory stays constant however long the file is. Defaults to extracting all pages at once")
+@click.option('--timeout',
+              default=600, type=int,
+              help="Seconds to wait for extracting the tables of a repaired pdf file, "
+                   "after the first try failed. Defaults to 600")
+@click.option('--quarantined', is_flag=True,
+              help="Only parse the files in the quarantine, which still failed after being repaired in earlier runs")
+@click.option('--failures',
+              default=None, type=click.Path(),
+              help="Write the failure reports of the quarantined files, per department, to a json file")
+def run(path, jobs, no_cache, refresh, cache_dir, cache_size, all_pages, full, output, store, index, metrics,
+        profile, backend, batch_pages, timeout, quarantined, failures):
     """ 解析pdf文件, 把数据导出为csv格式的文件.
     Examples:
     $python pdf_parser.py ../../pdf_files/jszwfw/江苏省人大办公厅
+    $python pdf_parser.py ../../pdf_files/jszwfw --jobs 4
+    $python pdf_parser.py ../../pdf_files/jszwfw --refresh
+    $python pdf_parser.py ../../pdf_files/jszwfw --all-pages
+    $python pdf_parser.py ../../pdf_files/jszwfw --full
+    $python pdf_parser.py ../../pdf_files/jszwfw --output csv --output parquet --output sqlite
+    $python pdf_parser.py ../../pdf_files/jszwfw --output parquet --store ../../pdf_files/jszwfw.parquet
+    $python pdf_parser.py ../../pdf_files/jszwfw --output sqlite --index ../../pdf_files/jszwfw.sqlite
+    $python pdf_parser.py ../../pdf_files/jszwfw --metrics metrics.json --profile profiles
+    $python pdf_parser.py ../../pdf_files/jszwfw --backend vector
+    $python pdf_parser.py ../../pdf_files/jszwfw --batch-pages 10
+    $python pdf_parser.py ../../pdf_files/jszwfw --quarantined --failures failures.json
     """
+    if jobs < 1 or timeout < 1 or (batch_pages is not None and batch_pages < 1):
+        click.secho('Invalid jobs, timeout or batch-pages. They must be at least 1', err=True, fg='red')
+        return
+    cache = None if no_cache else TableCache(cache_dir, cache_size * 1024 * 1024, refresh)
+    depts_dir, departments = list_departments(path)
+    dept_parsers = [DeptFilesParser(dept_name, dept_path, cache, not all_pages, not full, profile, backend,
+                                    batch_pages, timeout, quarantined)
+                    for dept_name, dept_path in departments]
+    click.echo('正在解析pdf中, 可能耗时几分钟，请耐心等待...')
+    if jobs == 1:
+        for parser in dept_parsers:
+            parser.parse()
+    else:
+        parse_parallel(dept_parsers, jobs)
+    export_results(dept_parsers, depts_dir, output, store, index, metrics, failures)
+    pages_total = sum(parser.pages_total for parser in dept_parsers)
+    pages_parsed = sum(parser.pages_parsed for parser in dept_parsers)
+    if pages_total:
+        click.echo(f'{backend}解析了{pages_parsed}页, 跳过了{pages_total - pages_parsed}页')
+
+
+def list_departments(path) -> Tuple[str, List[Tuple[str, str]]]:
+    """ path是一个部门的目录(下面都是文件), 或者多个部门目录的上级目录.
+    返回(部门目录的上级目录, [(部门名称, 部门目录)]) """
     is_all_files = all([os.path.isfile(os.path.join(path, item)) for item in os.listdir(path)])
     if is_all_files:    # 该文件夹下面都是文件, 解析一个部门
-        dept_name = os.path.basename(path)
-        parser = DeptFilesParser(dept_name, path)
-    else:
-        for sub_dir in os.listdir(path):   # 文件夹下还是文件夹，解析多个部门
-            dept_name = sub_dir
-            parser = DeptFilesParser(dept_name, path + '/' + sub_dir)
-    click.echo('正在解析pdf中, 可能耗时几分钟，请耐心等待...')
-    parser.parse()
-    print(parser)
-    parser.to_csv()
+        return os.path.dirname(os.path.abspath(path)), [(os.path.basename(path), path)]
+    departments = list()
+    for sub_dir in os.listdir(path):   # 文件夹下还是文件夹，解析多个部门
+        if sub_dir.startswith('.') or not os.path.isdir(os.path.join(path, sub_dir)):
+            continue    # 以.开头的是爬虫的下载目录
+        departments.append((sub_dir, path + '/' + sub_dir))
+    return os.path.abspath(path), departments
+
+
+def export_results(dept_parsers: List['DeptFilesParser'], depts_dir, output, store=None, index=None, metrics=None,
+                   failures=None):
+    """ 导出解析结果(csv, parquet, SQLite索引), 更新清单和隔离区, 报告隔离的文件, 保存统计和失败报告 """
+    parquet_store = ParquetStore(store or depts_dir + '.parquet') if 'parquet' in output else None
+    budget_index = BudgetIndex(index or depts_dir + '.sqlite') if 'sqlite' in output else None
+    for parser in dept_parsers:
+        print(parser)
+        if 'csv' in output:
+            parser.to_csv()
+        if parquet_store is not None:
+            parser.to_parquet(parquet_store)
+        if budget_index is not None:
+            parser.to_index(budget_index)
+        parser.save_manifest()
+    if metrics:
+        data = write_metrics(metrics, {parser.dept_name: parser.metrics for parser in dept_parsers})
+        timers = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in sorted(data['totals']['timers'].items()))
+        click.echo(f'各阶段耗时: {timers}')
+        click.echo('保存统计到 >> ' + metrics)
+    dept_failures = {parser.dept_name: parser.failures for parser in dept_parsers if parser.failures}
+    for dept_name, dept_failed in dept_failures.items():
+        for name, report in sorted(dept_failed.items()):
+            click.secho(f'{dept_name}/{name} {failure_summary(report)}', fg='yellow')
+    if dept_failures:
+        click.echo('检查或者替换这些文件后, 用--quarantined重新解析')
+    if failures:
+        with open(failures, 'w', encoding='utf-8') as f:
+            json.dump(dept_failures, f, ensure_ascii=False, indent=2, sort_keys=True)
+        click.echo('保存失败报告到 >> ' + failures)
+
+
+def _add_years(changed: Dict[str, Set[int]], tables: Dict[str, List[int]]):
+    for table_name, years in tables.items():
+        changed.setdefault(table_name, set()).update(years)
+
+
+def parse_parallel(dept_parsers: List['DeptFilesParser'], jobs: int):
+    """ 把(部门, pdf文件)作为一个任务分发到进程池中解析. 子进程返回每个文件的解析结果,
+    主进程再按照固定的顺序(部门顺序, 部门内文件顺序)合并, 结果和串行解析一致 """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [[executor.submit(parse_dept_file, parser.dept_name, parser.path, file_path, year,
+                                    parser.cache, parser.filter_pages, parser.profile_dir, parser.backend,
+                                    parser.batch_pages, parser.timeout)
+                    for file_path, year in parser.pending_files()]
+                   for parser in dept_parsers]
+        for parser, dept_futures in zip(dept_parsers, futures):
+            for future in dept_futures:
+                parser.merge(future.result())
+
+
+def parse_dept_file(dept_name, path, file_path, year, cache=None, filter_pages=True, profile_dir=None,
+                    backend='camelot', batch_pages=None, timeout=600) -> 'DeptFilesParser':
+    """ 进程池的任务: 解析部门的一个pdf文件, 返回只包含这个文件解析结果, 失败报告和统计的DeptFilesParser """
+    parser = DeptFilesParser(dept_name, path, cache, filter_pages, profile_dir=profile_dir, backend=backend,
+                             batch_pages=batch_pages, timeout=timeout)
+    parser._parse_file(file_path, year)
+    return parser
+
+
+def read_repaired_pdf(dept_name, path, file_path, repaired_path, filter_pages=True, backend='camelot') \
+        -> Tuple[List[CachedTable], ParseMetrics]:
+    """ 在子进程里提取修复后的pdf文件里的table, 返回table和统计(记在原文件名上) """
+    parser = DeptFilesParser(dept_name, path, filter_pages=filter_pages, backend=backend)
+    with parser.metrics.file(os.path.basename(file_path)):
+        tables = parser._read_pdf(repaired_path)
+    return [CachedTable(table.page, table.df.values.tolist()) for table in tables], parser.metrics
 
 
 class DeptFilesParser:
-    def __init__(self, dept_name, path):
+    def __init__(self, dept_name, path, cache: TableCache = None, filter_pages=True, incremental=False,
+                 profile_dir=None, backend='camelot', batch_pages=None, timeout=600, quarantined=False):
+        """ 部门目录下有为backend调优的参数配置(parse_profile.json)时, 自动用配置里的提取参数, 见tune_params.py
+        Parameters
+        ----------
+        dept_name : 部门名称
+        path : 部门pdf文件所在目录
+        cache : TableCache, 提取出来的table的缓存, None表示不使用缓存
+        filter_pages : bool, 先读取pdf文本层, 只把包含目标表格的页交给backend提取table
+        incremental : bool, 增量解析, 只解析清单(manifest)里没有或者内容有变化的pdf文件,
+            解析结果合并到已有的csv文件中
+        profile_dir : 用cProfile统计每个pdf文件的解析, 保存到这个目录, None表示不统计
+        backend : 提取table的后端, 见BACKENDS
+        batch_pages : int, 流式解析: 每次提取batch_pages页, 提取出来的table逐个交给parsers,
+            只保留parsers向后查看需要的几个table, 内存占用和pdf页数无关. None表示一次提取所有页.
+            vector后端本来就是逐页提取的, 只要不是None就逐页流式解析
+        timeout : 提取table出错时修复文件, 在子进程里重新提取, 最多等待timeout秒
+        quarantined : bool, 只解析隔离区(Quarantine)里的文件, 不管文件有没有变化
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'不支持的backend: {backend}')
+        if batch_pages is not None and batch_pages < 1:
+            raise ValueError(f'batch_pages必须大于0: {batch_pages}')
         self.dept_name = dept_name
         self.path = path
-        balance_parser = BalanceParser()
+        self.cache = cache
+        self.filter_pages = filter_pages
+        self.profile_dir = profile_dir
+        self.backend = backend
+        self.batch_pages = batch_pages
+        self.timeout = timeout
+        self.quarantined = quarantined
+        self.metrics = ParseMetrics()
+        self.profile = load_profile(path, backend)
+        self.read_kwargs = apply_profile(READ_PDF_KWARGS, self.profile)
+        # 参数配置变化后, 解析结果可能不同, 清单作废, 重新解析这个部门的所有文件
+        digest = profile_digest(self.profile)
+        parser_version = PARSER_VERSION if digest is None else f'{PARSER_VERSION}-{digest}'
+        self.manifest = Manifest(path, parser_version) if incremental else None
+        self.quarantine = Quarantine(path)
+        self.parsed_files: Dict[str, Dict[str, List[int]]] = dict()   # {文件名: {table_name: [年度]}}
+        self.failures: Dict[str, dict] = dict()     # 这次解析失败放进隔离区的文件, {文件名: 失败报告}
+        self.parsers: List[BaseParser] = [parser_type() for parser_type in PARSER_TYPES.values()]
+        self._dispatch: Dict[Tuple[str, ...], BaseParser] = dict()     # {表头签名: parser}
+        for parser in self.parsers:
+            parser.metrics = self.metrics
+            self._dispatch[parser.head_signature] = parser
 
-        self.parsers: List[BaseParser] = [balance_parser]
+    @property
+    def pages_total(self) -> int:
+        """ 筛选过页的文件的总页数 """
+        return self.metrics.counter('pages_scanned')
+
+    @property
+    def pages_parsed(self) -> int:
+        """ 其中交给backend提取table的页数 """
+        return self.metrics.counter('pages_parsed')
 
     def parse(self):
+        for file_path, year in self.pending_files():
+            self._parse_file(file_path, year)
+
+    def pending_files(self) -> List[Tuple[str, int]]:
+        """ 返回需要解析的pdf文件. 增量解析时, 跳过已经解析过的文件和内容重复的文件,
+        并且把已有csv里, 没有变化的文件解析出来的年度读入parsed_df.
+        变化或者删除了的文件原来解析出来的年度不从csv读取, 这些年度还有别的文件解析出来时, 别的文件也重新解析.
+        quarantined为True时, 只返回隔离区里的文件 """
+        files = self.list_files()
+        self.quarantine.retain(os.path.basename(file_path) for file_path, _ in files)
+        quarantined = [(file_path, year) for file_path, year in files
+                       if os.path.basename(file_path) in self.quarantine.files]
+        if self.manifest is None:
+            return quarantined if self.quarantined else files
+        names = {os.path.basename(file_path) for file_path, _ in files}
+        changed: Dict[str, Set[int]] = dict()
+        for name, entry in self.manifest.files.items():
+            if name not in names:
+                _add_years(changed, entry['tables'])
+        self.manifest.retain(names)
+        for parser in self.parsers:
+            if self.manifest.years(parser.table_name) and not os.path.exists(parser.csv_path(self.path)):
+                self.manifest.clear()   # csv文件被删除了, 重新解析所有文件
+        if self.quarantined:
+            res = quarantined
+            for file_path, _ in res:    # 失败的文件在清单里没有解析出来的年度, 重新记录就行
+                self.manifest.record(file_path, file_sha256(file_path))
+        else:
+            res = [(file_path, year) for file_path, year in files if self.is_pending(file_path, changed)]
+            res += self._sharing_years(files, res, changed)
+        for parser in self.parsers:
+            parser.read_csv(self.path, self.manifest.years(parser.table_name) - changed.get(parser.table_name, set()))
+        return res
+
+    def pending_file(self, file_path, year) -> List[Tuple[str, int]]:
+        """ 已经读入csv之后, 部门目录下又下载了一个文件(边爬取边解析), 返回需要解析的文件:
+        文件本身, 以及和它原来解析出来的年度相同的文件. 同时从parsed_df去掉这些年度 """
+        changed: Dict[str, Set[int]] = dict()
+        if not self.is_pending(file_path, changed):
+            return list()
+        res = [(file_path, year)]
+        res += self._sharing_years(self.list_files(), res, changed)
+        for parser in self.parsers:
+            years = changed.get(parser.table_name)
+            if years and parser.parsed_df is not None:
+                df = parser.parsed_df[~parser.parsed_df.index.year.isin(years)]
+                parser.parsed_df = df if len(df) else None
+        return res
+
+    def is_pending(self, file_path, changed: Dict[str, Set[int]] = None) -> bool:
+        """ 文件是否需要解析. 增量解析时, 没有变化的文件和内容重复的文件不需要解析, 需要解析的文件记录到清单里.
+        文件内容变化时, 把它原来解析出来的年度加到changed里 """
+        if self.manifest is None:
+            return True
+        if self.manifest.is_unchanged(file_path):
+            return False
+        entry = self.manifest.files.get(os.path.basename(file_path))
+        if entry is not None and changed is not None:
+            _add_years(changed, entry['tables'])
+        sha256 = file_sha256(file_path)
+        duplicate_of = self.manifest.duplicate_of(file_path, sha256)
+        if duplicate_of:
+            logging.info(f'{file_path} 和 {duplicate_of} 内容相同, 跳过')
+            self.manifest.record(file_path, sha256, duplicate_of=duplicate_of)
+            return False
+        self.manifest.record(file_path, sha256)
+        return True
+
+    def _sharing_years(self, files: List[Tuple[str, int]], pending: List[Tuple[str, int]],
+                       changed: Dict[str, Set[int]]) -> List[Tuple[str, int]]:
+        """ 没有变化, 但是解析出来的年度在changed里的文件. 这些年度的行不从csv读取, 所以这些文件也要重新解析,
+        它们解析出来的其他年度也加到changed里, 直到没有新的文件 """
+        pending = {file_path for file_path, _ in pending}
+        res = list()
+        found = True
+        while found:
+            found = False
+            for file_path, year in files:
+                entry = self.manifest.files.get(os.path.basename(file_path))
+                if file_path in pending or entry is None or not any(
+                        set(years) & changed.get(table_name, set()) for table_name, years in entry['tables'].items()):
+                    continue
+                _add_years(changed, entry['tables'])
+                self.manifest.record(file_path, entry['sha256'])
+                pending.add(file_path)
+                res.append((file_path, year))
+                found = True
+        return res
+
+    def list_files(self) -> List[Tuple[str, int]]:
+        """ 列出部门目录下需要解析的pdf文件, 返回 [(文件路径, 年度)] """
+        res = list()
         for file in os.listdir(self.path):
             if not file.endswith('.pdf'):
                 continue
@@ -47,14 +390,54 @@ class DeptFilesParser:
             if not year:
                 logging.warning(f'{file} 文件名解析不到年度信息')
                 continue
-            self._parse_file(self.path + '/' + file, year)
+            res.append((self.path + '/' + file, year))
+        return res
+
+    def parsed_dfs(self) -> Dict[str, pd.DataFrame]:
+        return {parser.table_name: parser.parsed_df for parser in self.parsers if parser.parsed_df is not None}
+
+    def merge(self, other: 'DeptFilesParser'):
+        """ 合并其他进程解析出来的结果 """
+        parsed_dfs = other.parsed_dfs()
+        for parser in self.parsers:
+            if parser.table_name in parsed_dfs:
+                parser.merge(parsed_dfs[parser.table_name])
+        self.metrics.merge(other.metrics)
+        self.parsed_files.update(other.parsed_files)
+        self.failures.update(other.failures)
 
     def to_csv(self):
         """ 导出csv """
         for parser in self.parsers:
-            file_path = parser.to_csv(self.path)
+            if parser.parsed_df is None:
+                continue
+            with self.metrics.timer('to_csv'):
+                file_path = parser.to_csv(self.path)
             print('保存csv到 >> ' + file_path)
 
+    def to_parquet(self, store: ParquetStore):
+        """ 保存到parquet列式存储 """
+        parsed_dfs = self.parsed_dfs()
+        with self.metrics.timer('to_parquet'):
+            dept_dir = store.write(self.dept_name, parsed_dfs)
+        print('保存parquet到 >> ' + dept_dir)
+
+    def to_index(self, index: BudgetIndex):
+        """ 更新SQLite索引里这个部门的数据 """
+        parsed_dfs = self.parsed_dfs()
+        with self.metrics.timer('to_index'):
+            index.replace_department(self.dept_name, parsed_dfs)
+        print('更新索引 >> ' + index.db_path)
+
+    def save_manifest(self):
+        """ 导出结果后更新隔离区; 增量解析时, 同时更新清单 """
+        self.quarantine.update(self.failures, self.parsed_files)
+        self.quarantine.save()
+        if self.manifest is not None:
+            for name, tables in self.parsed_files.items():
+                self.manifest.set_tables(name, tables)
+            self.manifest.save()
+
     def __str__(self):
         res = f'{self.dept_name}:\n'
         for parser in self.parsers:
@@ -69,58 +452,259 @@ class DeptFilesParser:
             return None
         return int(result.group(1))
 
-    def _parse_file(self, file_path, year):
+    def _read_tables(self, file_path):
+        """ 用backend提取pdf里的table, 优先读取缓存. 流式解析时返回table的生成器 """
+        if self.cache is None:
+            return self._read_pdf(file_path)
+        with self.metrics.timer('cache_read'):
+            key = self._cache_key(file_path)
+            tables = self.cache.get(key) if self.batch_pages is None else self.cache.stream(key)
+        if tables is None:
+            self.metrics.count('cache_misses')
+            tables = self._read_pdf(file_path)
+            if self.batch_pages is None:
+                self.cache.put(key, tables)
+            else:
+                tables = self.cache.tee(key, tables)     # 解析完最后一个table时写入缓存
+        else:
+            self.metrics.count('cache_hits')
+        return tables
+
+    def _cache_key(self, file_path):
+        key_kwargs = dict(self.read_kwargs, camelot_version=camelot.__version__)
+        if self.backend == 'vector':
+            key_kwargs['backend'] = f'vector-{vector_lattice.VERSION}'
+        if self.filter_pages:
+            key_kwargs['pages'] = self._page_keywords()
+        return self.cache.key(file_path, key_kwargs)
+
+    def _page_keywords(self):
+        return [(parser.head_keywords, parser.tail_keywords) for parser in self.parsers]
+
+    def _read_pdf(self, file_path):
+        if not self.filter_pages:
+            return self._extract(file_path, self.read_kwargs['pages'])
+        with self.metrics.timer('select_pages'):
+            try:
+                pages, total = select_pages(file_path, self._page_keywords())
+            except Exception as e:
+                raise ExtractError(f'读取文本层出错: {e!r}') from e
+        self.metrics.count('pages_scanned', total)
+        if pages == 'all':
+            self.metrics.count('pages_parsed', total)
+        elif pages:
+            self.metrics.count('pages_parsed', pages.count(',') + 1)
+        else:
+            return []
+        return self._extract(file_path, pages)
+
+    def _extract(self, file_path, pages):
+        if self.batch_pages is not None:
+            return self.metrics.timed(self.backend, self._stream(file_path, pages))
+        with self.metrics.timer(self.backend):
+            try:
+                if self.backend == 'vector':
+                    return vector_lattice.read_pdf(file_path, pages, self.read_kwargs['layout_kwargs'],
+                                                   self.read_kwargs['copy_text'], self.read_kwargs['strip_text'])
+                return camelot.read_pdf(file_path, **dict(self.read_kwargs, pages=pages))
+            except Exception as e:
+                raise ExtractError(f'{self.backend}提取table出错: {e!r}') from e
+
+    def _stream(self, file_path, pages):
+        """ 每次提取batch_pages页, 逐个返回table, 同时只保留一批的table """
         try:
-            tables = camelot.read_pdf(
-                file_path, pages='all',
-                layout_kwargs={
-                    'char_margin': 1.0,
-                    'line_margin': 0.5,
-                    'word_margin': 0.1,
-                    'detect_vertical': False
-                },
-                copy_text=['h'], strip_text='\n',
-                flavor='lattice', suppress_stdout=True)
-
-            i, tables_size = 0, len(tables)
+            if self.backend == 'vector':
+                yield from vector_lattice.iter_tables(file_path, pages, self.read_kwargs['layout_kwargs'],
+                                                      self.read_kwargs['copy_text'], self.read_kwargs['strip_text'])
+                return
+            total = count_pages(file_path) if pages == 'all' else 0
+            for batch in page_batches(pages, total, self.batch_pages):
+                tables = list(camelot.read_pdf(file_path, **dict(self.read_kwargs, pages=batch)))
+                tables.reverse()
+                while tables:
+                    yield tables.pop()      # 交出去之后这里不再引用
         except Exception as e:
-            logging.error(f'camelot解析文件{file_path}出错')
-            raise e
-        while i < tables_size:
-            for parser in self.parsers:
-                next_i = parser.parse(tables, i, year)
+            raise ExtractError(f'{self.backend}提取table出错: {e!r}') from e
+
+    def _parse_file(self, file_path, year):
+        """ 提取table出错(ExtractError)时修复文件后重试; 解析table出错时重试的结果也一样, 直接放进隔离区 """
+        name = os.path.basename(file_path)
+        with self.metrics.file(name), profiled(self.profile_dir, f'{self.dept_name}-{name}'):
+            try:
+                # 流式解析时, 边提取边解析
+                self._parse_or_rollback(file_path, year, lambda: self._read_tables(file_path))
+            except ExtractError as e:
+                logging.exception(f'{self.backend}提取文件{file_path}的table出错, 修复后重试')
+                self.metrics.count('files_failed')
+                self._recover(file_path, year, e)
+            except Exception as e:
+                logging.exception(f'解析文件{file_path}出错, 放进隔离区')
+                self.metrics.count('files_failed')
+                self._quarantine(file_path, year, e, repaired=False)
+
+    def _parse_or_rollback(self, file_path, year, read_tables):
+        """ 解析一个文件, 出错时撤销这个文件已经合并到parsers的结果, 再抛出异常 """
+        rows = [len(parser.parsed_rows) for parser in self.parsers]
+        try:
+            self.parse_tables(read_tables(), file_path, year)
+        except Exception:
+            for parser, size in zip(self.parsers, rows):
+                del parser.parsed_rows[size:]
+            self.parsed_files.pop(os.path.basename(file_path), None)
+            raise
+
+    def _recover(self, file_path, year, error: Exception):
+        """ 把pdf修复到临时目录, 在子进程里重新提取table(最多等待timeout秒)再解析.
+        修复后仍然失败的文件放进隔离区, 记录失败报告, 不影响其他文件的解析 """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            repaired_path = repair_pdf(file_path, tmp_dir)
+            if repaired_path is not None:
+                try:
+                    self._parse_or_rollback(file_path, year, lambda: self._read_repaired(file_path, repaired_path))
+                    self.metrics.count('files_repaired')
+                    logging.info(f'{file_path} 修复后解析成功')
+                    return
+                except Exception as e:
+                    logging.exception(f'{file_path} 修复后仍然解析失败, 放进隔离区')
+                    error = e
+        self._quarantine(file_path, year, error, repaired_path is not None)
+
+    def _quarantine(self, file_path, year, error: Exception, repaired: bool):
+        """ 记录失败报告, 导出结果时放进隔离区 """
+        stage = 'extract' if isinstance(error, ExtractError) else 'parse'
+        if isinstance(error, ExtractError) and error.__cause__ is not None:
+            error = error.__cause__     # 报告backend原来的异常
+        self.failures[os.path.basename(file_path)] = failure_report(year, file_sha256(file_path), self.backend, stage,
+                                                                    error, repaired)
+        self.metrics.count('files_quarantined')
+
+    def _read_repaired(self, file_path, repaired_path) -> List[CachedTable]:
+        """ 提取修复后的文件里的table, 以原文件的缓存key写入缓存, 下次直接读取缓存 """
+        with self.metrics.timer('repair_extract'):
+            try:
+                tables, metrics = call_with_timeout(
+                    read_repaired_pdf, (self.dept_name, self.path, file_path, repaired_path, self.filter_pages,
+                                        self.backend), self.timeout)
+            except multiprocessing.TimeoutError:
+                raise ExtractError(f'{self.backend}提取table超过{self.timeout}秒') from None
+            except ExtractError:
+                raise
+            except Exception as e:
+                raise ExtractError(f'{self.backend}提取table出错: {e!r}') from e
+        self.metrics.merge(metrics)
+        if self.cache is not None:
+            self.cache.put(self._cache_key(file_path), tables)
+        return tables
+
+    def parse_tables(self, tables, file_path, year):
+        """ 用parsers解析一个pdf文件里的tables(camelot的TableList, CachedTable列表或者生成器) """
+        with self.metrics.file(os.path.basename(file_path)), self.metrics.timer('parse'):
+            self._parse_tables(tables, file_path, year)
+
+    def _parse_tables(self, tables, file_path, year):
+        """ 每个table算一次表头签名, 在_dispatch里找到对应的parser, 只交给这一个parser解析.
+        parser合并的跨页table(table_index到next_index)都归这个parser, 从next_index继续.
+        tables是生成器(流式解析)时包装成TableWindow, 前面的table解析完就释放, 内存占用和table总数无关 """
+        streaming = not hasattr(tables, '__len__')
+        if streaming:
+            tables = TableWindow(tables)
+        i = 0
+        parsed_tables = self.parsed_files.setdefault(os.path.basename(file_path), dict())
+        while True:
+            if streaming:
+                tables.release(i)
+            try:
+                table = tables[i]
+            except IndexError:
+                break
+            parser = self._dispatch.get(BaseParser.signature(table.df))
+            next_i = i if parser is None else parser.parse(tables, i, year)
             if next_i == i:
                 # print('无法处理该Table', str(tables[i]))
-                i = next_i + 1
-            else:
-                i = next_i
+                self.metrics.count('tables_unmatched')
+                i += 1
+                continue
+            self.metrics.count('tables_matched.' + parser.table_name, next_i - i)
+            if year not in parsed_tables.setdefault(parser.table_name, []):
+                parsed_tables[parser.table_name].append(year)
+            i = next_i
+        self.metrics.count('tables_extracted', tables.consumed if streaming else len(tables))
+
+
+# 注册的parser类型, {表头签名: parser类}, DeptFilesParser按注册顺序为每个类型创建一个parser
+PARSER_TYPES: Dict[Tuple[str, ...], Type['BaseParser']] = dict()
+
+
+def register_parser(parser_type: Type['BaseParser']) -> Type['BaseParser']:
+    """ 注册parser的类装饰器. 每种表格的表头签名必须不同, table按签名只交给一个parser解析 """
+    signature = parser_type.head_signature
+    if not signature:
+        raise ValueError(f'{parser_type.__name__}没有定义head_signature')
+    registered = PARSER_TYPES.get(signature)
+    if registered is not None and registered is not parser_type:
+        raise ValueError(f'{parser_type.__name__}和{registered.__name__}的表头签名相同: {signature}')
+    PARSER_TYPES[signature] = parser_type
+    return parser_type
 
 
 class BaseParser:
     table_name: str = None
+    head_signature: Tuple[str, ...] = ()    # 表格第一行去掉空白后的单元格, 用来把table分派给parser
+    head_keywords: Tuple[str, ...] = ()    # 表头所在页的文本必须包含的关键字, 用来筛选交给camelot解析的页
+    tail_keywords: Tuple[str, ...] = ()    # 表尾所在页的文本包含的关键字, 没有找到表尾时, 表格可能跨页
+    max_tables = 4      # get_df最多合并的table数, 也是流式解析时parser最多向后查看的table数
     re_digit = re.compile(r'^[0-9]+\.')
     re_zh_digit = re.compile('^[一二三四五六七八九十]+、')
     re_merge = re.compile('[一二三四五六七八九十]+、')
+    # 中文序号前面还有内容的单元格, 比如'24,458.43二、财政专户管理资金'. 分为中文序号前面的内容和后面的内容
+    re_split = re.compile('^(?![一二三四五六七八九十]+、)(.+?)([一二三四五六七八九十]+、.*)$', re.S)
 
     def __init__(self):
-        self.parsed_df: pd.DataFrame = None
+        self._parsed_df: pd.DataFrame = None
+        self.parsed_rows: List[pd.DataFrame] = list()     # 还没有合并到parsed_df的行
+        self.metrics = ParseMetrics()     # DeptFilesParser会换成部门的统计
+
+    @property
+    def parsed_df(self) -> pd.DataFrame:
+        """ 所有年度的解析结果. 新解析的行先放在parsed_rows里, 读取时一次合并, 再逐年纠正错误换行 """
+        if self.parsed_rows:
+            with self.metrics.timer('correct_wrong_new_line'):
+                self._parsed_df = self.correct_per_year(self._parsed_df, self.parsed_rows)
+            self.parsed_rows = list()
+        return self._parsed_df
+
+    @parsed_df.setter
+    def parsed_df(self, df: pd.DataFrame):
+        self._parsed_df = df
+        self.parsed_rows = list()
 
-    @abstractmethod
     def has_head(self, df: pd.DataFrame) -> bool:
-        """ 检查表的前几行是否符合 """
-        pass
+        """ 检查表的第一行是否符合 """
+        return self.signature(df) == self.head_signature
+
+    @classmethod
+    def signature(cls, df: pd.DataFrame) -> Tuple[str, ...]:
+        """ 表头签名: 第一行每个单元格去掉空白 """
+        if df.empty:
+            return ()
+        return tuple(re.sub(r'\s+', '', cell) if isinstance(cell, str) else cell for cell in df.iloc[0])
 
     @abstractmethod
     def has_tail(self, df: pd.DataFrame) -> bool:
         """ 检查表的最后几行是否符合 """
         pass
 
+    def reconcile(self, df: pd.DataFrame) -> int:
+        """ 核对get_df合并出来的表里的合计, 返回对得上的组数, 调优提取参数时作为得分. 默认没有可以核对的合计 """
+        return 0
+
     @abstractmethod
     def parse(self, tables: List[pd.DataFrame], table_index, year):
         """解析, 同时返回下一个的table_index.
         Parameters
         ----------
-        tables : List[pd.DataFrame]
+        tables : List[pd.DataFrame]. 流式解析时是TableWindow, 没有len, 只能访问table_index往后max_tables个table,
+            超出末尾时抛出IndexError
         table_index : int, 当前要解析的table_index
         year: int, 年度
         Returns
@@ -130,18 +714,43 @@ class BaseParser:
         pass
 
     @classmethod
-    def correct(cls, df: pd.DataFrame):
-        max_row, max_col = df.shape
-        for index, series in df.iterrows():
-            for c, text in series.iteritems():
-                is_merge, divided_cells = cls.split_merge_cell(text)
-                if is_merge:
-                    if c >= 1 and df.iloc[index, c - 1] == '':
-                        df.iloc[index, c - 1], df.iloc[index, c] = divided_cells
-                    elif c <= max_col - 2 and df.iloc[index, c + 1] == '':
-                        df.iloc[index, c], df.iloc[index, c + 1] = divided_cells
-                    else:
-                        logging.warning(f'单位格分开可能出错. df[{index}][{c}] {text}')
+    def correct(cls, df: pd.DataFrame) -> int:
+        """ 把camelot合到一起的单元格分开, 见split_merge_cell. 直接修改df, 返回分开的单元格数.
+        分开后的两部分写到这个单元格和左边的空单元格; 左边不是空的, 写到这个单元格和右边的空单元格.
+        整个表一次str.extract找出合并的单元格, 用平移后的布尔矩阵判断左右两边是否为空, 最后一次性写回.
+        """
+        values = df.values.copy()
+        if values.dtype != object or values.size == 0:
+            return 0
+        extracted = pd.Series(values.ravel()).str.extract(cls.re_split)
+        merged = extracted[0].notna().values.reshape(values.shape)
+        if not merged.any():
+            return 0
+        prefix = extracted[0].values.reshape(values.shape)
+        rest = extracted[1].values.reshape(values.shape)
+        empty = values == ''
+        left_empty = np.zeros_like(empty)
+        left_empty[:, 1:] = empty[:, :-1]
+        right_empty = np.zeros_like(empty)
+        right_empty[:, :-1] = empty[:, 1:]
+        # 左边的空单元格被左边第二个单元格向右分开时写入了, 就不再是空的. 这个依赖是从左往右传递的, 迭代到不变为止
+        blocked = np.zeros_like(empty)
+        while True:
+            to_left = merged & left_empty & ~blocked
+            to_right = merged & ~to_left & right_empty
+            new_blocked = np.zeros_like(empty)
+            new_blocked[:, 2:] = to_right[:, :-2]
+            if (new_blocked == blocked).all():
+                break
+            blocked = new_blocked
+        rows, cols = to_left.nonzero()
+        values[rows, cols - 1], values[rows, cols] = prefix[rows, cols], rest[rows, cols]
+        rows, cols = to_right.nonzero()
+        values[rows, cols], values[rows, cols + 1] = prefix[rows, cols], rest[rows, cols]
+        for row, col in zip(*(merged & ~to_left & ~to_right).nonzero()):
+            logging.warning(f'单位格分开可能出错. df[{df.index[row]}][{df.columns[col]}] {df.iat[row, col]}')
+        df.iloc[:, :] = values
+        return int(to_left.sum() + to_right.sum())
 
     @classmethod
     def split_merge_cell(cls, text):
@@ -149,58 +758,143 @@ class BaseParser:
             比如'24,458.43二、财政专户管理资金' 分为'24,458.43'和'二、财政专户管理资金' """
         if not text or not isinstance(text, str):
             return False, None
-        r = cls.re_merge.search(text)
+        r = cls.re_split.match(text)
         if not r:
             return False, None
-        start, end = r.span()
-        if start == 0:
-            return False, None
-        else:
-            return True, (text[:start], text[start:])
+        return True, r.groups()
 
     @staticmethod
     def correct_wrong_new_line(df: pd.DataFrame):
         """ 由于camelot在解析table的时候，有些table换行隔得很远，会误解析为两行。这里纠正这个错误。
         检测dataframe，如果两列的名字是截断关系（startswith），并且对应行的数据是异或关系，一个数据为合法数值，则另一个数据为nan
         """
-        row_size, col_size = df.shape
-        wrong_list = list()
-        for i in list(df.columns):
-            for j in list(df.columns):
-                if i != j and i.startswith(j):
-                    if all([xor(pd.isna(df[i][row]), pd.isna(df[j][row])) for row in range(0, row_size)]):
-                        logging.info(f'检测到列{i}, 列{j}存在互补，可能是camelot解析错误换行导致的，现在合并两列')
-                        wrong_list.append((i, j))
-        for (i, j) in wrong_list:
-            for row in range(0, row_size):
-                if pd.isna(df[i][row]):
-                    df[i][row] = df[j][row]
-            df.drop(columns=[j], inplace=True)      # 名字较短的列，删掉该列
+        columns = list(df.columns)
+        pairs = BaseParser.truncated_pairs(columns)
+        if not pairs:
+            return df
+        is_na = df.isna().values
+        i_index, j_index = np.array(pairs).T
+        complement = (is_na[:, i_index] ^ is_na[:, j_index]).all(axis=0)
+        dropped = list()
+        for (i, j), is_complement in zip(pairs, complement):
+            i, j = columns[i], columns[j]
+            if not is_complement or i in dropped or j in dropped:
+                continue
+            logging.info(f'检测到列{i}, 列{j}存在互补，可能是camelot解析错误换行导致的，现在合并两列')
+            df[i] = df[i].combine_first(df[j])
+            dropped.append(j)
+        df.drop(columns=dropped, inplace=True)      # 名字较短的列，删掉该列
         return df
 
+    @staticmethod
+    def truncated_pairs(columns: List[str]) -> List[Tuple[int, int]]:
+        """ 列名是截断关系的两列的位置(长的列, 短的列), 按列顺序排列, 和按列顺序两两比较时的合并顺序一致 """
+        position = {c: k for k, c in enumerate(columns)}
+        # 排序后, 以j开头的列名都紧跟在j后面, 不需要两两比较所有列
+        names = sorted(position)
+        pairs = list()
+        for k, j in enumerate(names):
+            for i in names[k + 1:]:
+                if not i.startswith(j):
+                    break
+                pairs.append((position[i], position[j]))
+        pairs.sort()
+        return pairs
+
+    @staticmethod
+    def correct_per_year(df: pd.DataFrame, rows: List[pd.DataFrame]) -> pd.DataFrame:
+        """ 把rows依次合并到已经纠正过的df(可以是None), 结果和每合并一个row调用一次correct_wrong_new_line一样:
+        只合并已经合并的年度里截断关系的列, 不会把这一年的截断列名和以后年度才出现的完整列名合并.
+        所有row只concat一次. 每合并一个row时, 只检查新出现的列和上一次合并过的列: 其他列上一次不互补,
+        加上新的行以后也不会互补 """
+        frames = rows if df is None else [df] + rows
+        combined = pd.concat(frames, sort=False)
+        data = {c: combined[c].to_numpy(copy=True) for c in combined.columns}
+        columns = list()    # 逐年合并时当前的列, 按逐年合并时的顺序
+        dirty = set()       # 新出现的列和上一次合并过的列
+        end = 0
+        for k, frame in enumerate(frames):
+            end += len(frame)
+            present = set(columns)
+            new = [c for c in frame.columns if c not in present]
+            columns += new
+            dirty.update(new)
+            if k == 0 and df is not None:
+                continue    # df已经纠正过, 合并过哪些列不知道, 下一个row检查所有列
+            pairs = [(i, j) for i, j in BaseParser.truncated_pairs(columns)
+                     if columns[i] in dirty or columns[j] in dirty]
+            dirty = set()
+            if not pairs:
+                continue
+            names = list({columns[c] for pair in pairs for c in pair})
+            is_na = {c: pd.isna(data[c][:end]) for c in names}
+            dropped = list()
+            for i, j in pairs:
+                i, j = columns[i], columns[j]
+                if i in dropped or j in dropped or not (is_na[i] ^ is_na[j]).all():
+                    continue
+                logging.info(f'检测到列{i}, 列{j}存在互补，可能是camelot解析错误换行导致的，现在合并两列')
+                values = data[i][:end]
+                values = np.where(pd.isna(values), data[j][:end], values)
+                if values.dtype != data[i].dtype:
+                    data[i] = data[i].astype(values.dtype)
+                data[i][:end] = values
+                if data[j].dtype.kind not in 'fcO':
+                    data[j] = data[j].astype(float)
+                data[j][:end] = np.nan      # 以后的年度又有这一列时, 作为新的列放在最后
+                dropped.append(j)
+                dirty.add(i)
+            columns = [c for c in columns if c not in dropped]
+        return pd.DataFrame({c: data[c] for c in columns}, index=combined.index, columns=columns)
+
     def get_df(self, tables: List[pd.DataFrame], table_index) -> Tuple[pd.DataFrame, int]:
         """ 检查是否符合, 如果发现是属于同一个表的, 把它们合并 """
         if not self.has_head(tables[table_index].df):
             return None, table_index
-        df: pd.DataFrame = None
-        i = table_index
-        while i < table_index + 4:  # 最多合并4个table
-            if df is None:
-                df = tables[i].df
-            else:
-                df = df.append(tables[i].df, ignore_index=True, sort=False)
-            if self.has_tail(df):
-                return df, i + 1
-            i += 1
-        else:
-            # 没有找到
-            return None, table_index
+        with self.metrics.timer('get_df'):
+            return self._merge_tables(tables, table_index)
+
+    def _merge_tables(self, tables: List[pd.DataFrame], table_index) -> Tuple[pd.DataFrame, int]:
+        fragments: List[pd.DataFrame] = list()
+        columns = pd.Index([])
+        for i in range(table_index, table_index + self.max_tables):
+            try:
+                fragment = tables[i].df
+            except IndexError:      # 超出末尾, tables可能是不知道长度的TableWindow
+                break
+            fragments.append(fragment)
+            self.metrics.count('merge_attempts')
+            columns = columns.union(fragment.columns, sort=False)
+            # 只检查最后一个table, 补齐前面table多出来的列, 和合并后的最后几行一致
+            tail = fragment if len(fragment.columns) == len(columns) else fragment.reindex(columns=columns)
+            if self.has_tail(tail):
+                if len(fragments) == 1:
+                    return fragment, i + 1
+                return pd.concat(fragments, ignore_index=True, sort=False), i + 1
+        # 没有找到
+        return None, table_index
+
+    def merge(self, df: pd.DataFrame):
+        """ 把新解析出来的行合并到parsed_df """
+        self.parsed_rows.append(df)
+
+    def csv_path(self, path):
+        return f'{path}/{self.table_name}.csv'
 
     def to_csv(self, path):
-        file_path = f'{path}/{self.table_name}.csv'
+        file_path = self.csv_path(path)
         self.parsed_df.to_csv(file_path)
         return file_path
 
+    def read_csv(self, path, years):
+        """ 读取已经导出的csv, 只保留years中的年度 """
+        file_path = self.csv_path(path)
+        if not years or not os.path.exists(file_path):
+            return
+        df = pd.read_csv(file_path, index_col=0, parse_dates=True)
+        df = df[df.index.year.isin(years)]
+        self.parsed_df = df if len(df) else None
+
     @classmethod
     def strip(cls, word):
         """ 去掉前面的'1.', '一、', 去掉包括空格、制表符、换页符 [ \f\n\r\t\v] """
@@ -232,24 +926,48 @@ class BaseParser:
         return f'   {self.table_name}:\n' + str(self.parsed_df)
 
 
+@register_parser
 class BalanceParser(BaseParser):
     """ 解析收支预算总表 """
     table_name = '收支预算总表'
-
-    def has_head(self, df: pd.DataFrame) -> bool:
-        return df.iloc[0, :].equals(pd.Series(['收入', '收入', '支出', '支出', '支出', '支出']))
+    head_signature = ('收入', '收入', '支出', '支出', '支出', '支出')
+    head_keywords = ('收入', '支出', '项目名称', '功能分类')
+    tail_keywords = ('收入合计', '支出合计')
 
     def has_tail(self, df: pd.DataFrame):
         return df.iloc[-1, 0] == '收入合计' and df.iloc[-1, 2] == '支出合计'
 
+    def reconcile(self, df: pd.DataFrame) -> int:
+        """ 收入, 功能分类, 支出用途三组(项目名称, 金额)列, 每组一级项目(一、二、...)的金额之和等于小计或者合计行里的
+        某个金额时, 这组算对得上. 提取参数不合适时, 单元格分错或者文字跨行, 金额对不上. df要先correct """
+        if len(df.columns) != len(self.head_signature):
+            return 0
+        totals = set()
+        sums, counts = [0.0] * 3, [0] * 3
+        for row in df.itertuples(index=False):
+            cells = [cell if isinstance(cell, str) else '' for cell in row]
+            if any('小计' in re.sub(r'\s+', '', cell) or '合计' in re.sub(r'\s+', '', cell) for cell in cells):
+                totals.update(v for v in map(self.parse_float, cells) if v is not None)
+            for k, (column_title, column_num) in enumerate(((0, 1), (2, 3), (4, 5))):
+                num = self.parse_float(cells[column_num])
+                if num and self.re_zh_digit.match(cells[column_title].strip()):
+                    sums[k] += num
+                    counts[k] += 1
+        return sum(1 for s, count in zip(sums, counts)
+                   if count and any(math.isclose(s, total, abs_tol=0.01) for total in totals))
+
     def parse(self, tables: List[pd.DataFrame], table_index, year):
         df, next_index = self.get_df(tables, table_index)
         if df is None:
             return next_index
 
-        assert df.iloc[1, :].equals(pd.Series(['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途']))
-        assert df.iloc[2, :].equals(pd.Series(['', '', '功能科目名称', '金额', '项目名称', '金额']))
-        self.correct(df)
+        for row, header in ((1, ['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途']),
+                            (2, ['', '', '功能科目名称', '金额', '项目名称', '金额'])):
+            if not df.iloc[row, :].equals(pd.Series(header)):
+                actual = df.iloc[row, :].tolist()
+                raise ParseError(f'{self.table_name}第{row + 1}行表头对不上: {actual}, 应该是{header}', actual)
+        with self.metrics.timer('correct'):
+            self.metrics.count('cells_repaired', self.correct(df))
 
         array, columns = list(), list()
         self.set_data(df, columns, array, 0, 1)
@@ -257,11 +975,7 @@ class BalanceParser(BaseParser):
         self.set_data(df, columns, array, 4, 5)
 
         df_res = pd.DataFrame(np.array([array]), index=[pd.datetime(year=year, month=1, day=1)], columns=columns)
-        if self.parsed_df is None:
-            self.parsed_df = df_res
-        else:
-            self.parsed_df = self.parsed_df.append(df_res, sort=False)
-        self.correct_wrong_new_line(self.parsed_df)
+        self.merge(df_res)
         return next_index
 
     def set_data(self, df, columns, array, column_title, column_num):
@@ -0,0 +1,98 @@
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import traceback
+from typing import Callable, Dict, Iterable, Optional
+
+# mutool clean修复一个pdf文件的最长时间(秒)
+REPAIR_TIMEOUT = 120
+
+
+class Quarantine:
+    """ 部门目录下解析失败的pdf文件(隔离区).
+    修复后重试仍然失败的文件记录在这里, 每个文件一个失败报告: 年度, sha256, backend, 出错阶段(extract提取table,
+    parse解析table), 异常类型和信息, 最后几层调用栈, 是否修复过, 时间.
+    增量解析会跳过隔离区里内容没有变化的文件, 用--quarantined只重新解析隔离区里的文件, 解析成功后移出隔离区.
+    """
+    file_name = '.quarantine.json'
+
+    def __init__(self, path):
+        self.file_path = os.path.join(path, self.file_name)
+        self.files: Dict[str, dict] = dict()     # {文件名: 失败报告}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, encoding='utf-8') as f:
+                self.files = json.load(f)
+
+    def save(self):
+        """ 隔离区为空时删除文件 """
+        if not self.files:
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+            return
+        tmp_path = self.file_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.file_path)
+
+    def update(self, failures: Dict[str, dict], parsed: Iterable[str]):
+        """ 加入这次解析失败的文件, 移出解析成功的文件 """
+        for name in parsed:
+            self.files.pop(name, None)
+        self.files.update(failures)
+
+    def retain(self, names: Iterable[str]):
+        """ 删除已经不存在的文件 """
+        names = set(names)
+        for name in list(self.files):
+            if name not in names:
+                del self.files[name]
+
+
+def failure_report(year, sha256, backend, stage, error: BaseException, repaired: bool) -> dict:
+    return {'year': year, 'sha256': sha256, 'backend': backend, 'stage': stage,
+            'error': type(error).__name__, 'message': str(error),
+            'traceback': traceback.format_exception(type(error), error, error.__traceback__)[-3:],
+            'repaired': repaired, 'time': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def failure_summary(report: dict) -> str:
+    """ 失败报告的一行说明. 解析table出错的文件没有修复过, 修复也不会改变解析的结果 """
+    if report['repaired']:
+        what = '修复后仍然解析失败'
+    elif report['stage'] == 'parse':
+        what = '解析table出错'
+    else:
+        what = '提取table出错, 修复失败'
+    return f'{what}, 已隔离: {report["error"]}: {report["message"]}'
+
+
+def repair_pdf(file_path, out_dir) -> Optional[str]:
+    """ 修复pdf文件(重建xref表, 解压并重写对象), 保存到out_dir, 不修改原文件. 返回修复后的文件路径, 修复失败时返回None.
+    优先用mupdf的mutool clean, 没有安装mupdf时用pdfium(camelot的依赖)读取后重新保存 """
+    out_path = os.path.join(out_dir, os.path.basename(file_path))
+    mutool = shutil.which('mutool')
+    try:
+        if mutool:
+            subprocess.run([mutool, 'clean', file_path, out_path], check=True, capture_output=True,
+                           timeout=REPAIR_TIMEOUT)
+        else:
+            import pypdfium2
+            pdf = pypdfium2.PdfDocument(file_path)
+            try:
+                pdf.save(out_path)
+            finally:
+                pdf.close()
+    except Exception as e:
+        logging.warning(f'修复{file_path}失败: {e!r}')
+        return None
+    return out_path
+
+
+def call_with_timeout(func: Callable, args: tuple, timeout: float):
+    """ 在子进程里调用func(*args), 超过timeout秒时结束子进程, 抛出multiprocessing.TimeoutError """
+    with multiprocessing.Pool(1) as pool:      # 退出时terminate, 卡住的子进程也会被结束
+        return pool.apply_async(func, args).get(timeout)
@@ -0,0 +1,104 @@
+import re
+import sqlite3
+import unicodedata
+from contextlib import contextmanager
+from typing import Dict, List
+
+import pandas as pd
+
+from open_budget.parser.parquet_store import to_long
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS line_items (
+    department TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    table_name TEXT NOT NULL,
+    item TEXT NOT NULL,
+    amount REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_dept_year ON line_items (department, year);
+CREATE INDEX IF NOT EXISTS idx_item_year ON line_items (table_name, item, year, department, amount);
+CREATE INDEX IF NOT EXISTS idx_year_item ON line_items (year, table_name, item, amount);
+"""
+
+
+def normalize_item(item: str) -> str:
+    """ 统一项目名称的写法: 全角转半角, 去掉空白字符 """
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', str(item)))
+
+
+class BudgetIndex:
+    """ 所有部门解析结果的SQLite索引, 用于跨部门的汇总查询.
+    每一行是一个项目: department, year, table_name, item(规范化后的项目名称), amount.
+    索引覆盖了按部门/年度, 按项目/年度的查询, 汇总、Top N、同比查询不需要回表.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def replace_department(self, dept_name, parsed_dfs: Dict[str, pd.DataFrame]):
+        """ 用部门最新的解析结果替换索引里这个部门原来的数据, 没有表时先建表 """
+        rows = list()
+        for table_name, df in parsed_dfs.items():
+            if df is None:
+                continue
+            long = to_long(table_name, df)
+            rows.extend((dept_name, int(year), table_name, normalize_item(item), float(amount))
+                        for year, _, item, amount in long.itertuples(index=False))
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            with conn:     # 事务
+                conn.execute('DELETE FROM line_items WHERE department = ?', (dept_name,))
+                conn.executemany('INSERT INTO line_items VALUES (?, ?, ?, ?, ?)', rows)
+
+    def query(self, sql, params=()) -> pd.DataFrame:
+        with self._connect() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def departments(self) -> List[str]:
+        return self.query('SELECT DISTINCT department FROM line_items ORDER BY department')['department'].tolist()
+
+    def items(self, table_name) -> List[str]:
+        df = self.query('SELECT DISTINCT item FROM line_items WHERE table_name = ? ORDER BY item', (table_name,))
+        return df['item'].tolist()
+
+    def total_by_year(self, table_name, item) -> pd.DataFrame:
+        """ 所有部门某个项目每年的合计: year, amount, departments """
+        return self.query("""
+            SELECT year, SUM(amount) AS amount, COUNT(DISTINCT department) AS departments
+            FROM line_items WHERE table_name = ? AND item = ?
+            GROUP BY year ORDER BY year""", (table_name, normalize_item(item)))
+
+    def top_departments(self, table_name, item, year, n=10) -> pd.DataFrame:
+        """ 某年某个项目金额最大的n个部门: department, amount """
+        return self.query("""
+            SELECT department, SUM(amount) AS amount
+            FROM line_items WHERE table_name = ? AND item = ? AND year = ?
+            GROUP BY department ORDER BY amount DESC LIMIT ?""", (table_name, normalize_item(item), year, n))
+
+    def year_over_year(self, table_name, item, department=None) -> pd.DataFrame:
+        """ 某个项目的同比变化: department, year, amount, previous, growth.
+        department为None时, 返回所有部门 """
+        sql = """
+            SELECT department, year, amount,
+                   LAG(amount) OVER (PARTITION BY department ORDER BY year) AS previous
+            FROM (SELECT department, year, SUM(amount) AS amount
+                  FROM line_items WHERE table_name = ? AND item = ? {}
+                  GROUP BY department, year)"""
+        params = [table_name, normalize_item(item)]
+        if department is not None:
+            sql = sql.format('AND department = ?')
+            params.append(department)
+        else:
+            sql = sql.format('')
+        df = self.query(sql + ' ORDER BY department, year', params)
+        df['growth'] = df['amount'] / df['previous'] - 1
+        return df
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+
+def file_sha256(file_path) -> str:
+    """ 文件内容的sha256 """
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CachedTable:
+    """ 缓存中读出来的table, 和camelot.core.Table一样提供page和df属性 """
+
+    def __init__(self, page: str, data: List[List[str]]):
+        self.page = page
+        self.df = pd.DataFrame(data)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} page={self.page} shape={self.df.shape}>'
+
+
+class TableCache:
+    """ camelot解析结果的磁盘缓存.
+    缓存的key是pdf文件内容的sha256加上camelot的解析参数, 所以pdf文件改名或者移动目录后仍然能命中缓存.
+    每个pdf文件保存为一个gzip压缩的.tables文件, 里面每个table的(页码, 单元格)依次用pickle序列化,
+    可以一边提取一边写入(tee), 一边读取一边解析(stream), 不需要把整个文件的table放在内存里.
+    缓存总大小超过max_size后, 按最近访问时间(LRU)删除旧的缓存文件.
+    """
+    suffix = '.tables'
+
+    def __init__(self, cache_dir=os.path.expanduser('~/.cache/open_budget/tables'),
+                 max_size=1024 * 1024 * 1024, refresh=False):
+        """
+        Parameters
+        ----------
+        cache_dir : 缓存目录
+        max_size : int, 缓存总大小上限, 单位字节
+        refresh : bool, 为True时不读取缓存, 重新解析后覆盖缓存
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.refresh = refresh
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(file_path, read_kwargs: dict) -> str:
+        h = hashlib.sha256(file_sha256(file_path).encode('ascii'))
+        h.update(json.dumps(read_kwargs, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key) -> Optional[List[CachedTable]]:
+        tables = self.stream(key)
+        return None if tables is None else list(tables)
+
+    def stream(self, key) -> Optional[Iterator[CachedTable]]:
+        """ 逐个读出缓存的table. 先完整解压一遍校验文件, 缓存不存在或者损坏时返回None """
+        if self.refresh:
+            return None
+        file_path = self._path(key)
+        try:
+            f = gzip.open(file_path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            while f.read(1024 * 1024):      # 读到末尾时gzip会校验crc
+                pass
+            f.seek(0)
+        except (OSError, EOFError, zlib.error):
+            f.close()
+            logging.warning(f'缓存文件{file_path}已损坏, 重新解析')
+            return None
+        os.utime(file_path)     # 更新访问时间, 用于LRU
+        return self._records(f)
+
+    @staticmethod
+    def _records(f) -> Iterator[CachedTable]:
+        with f:
+            while True:
+                try:
+                    page, cells = pickle.load(f)
+                except EOFError:
+                    return
+                yield CachedTable(page, cells)
+
+    def put(self, key, tables):
+        """ 保存camelot的TableList """
+        for _ in self.tee(key, tables):
+            pass
+
+    def tee(self, key, tables: Iterable) -> Iterator:
+        """ 逐个返回tables里的table, 同时写入缓存. 全部读完后缓存才生效, 中途出错或者没有读完时不写入 """
+        file_path = self._path(key)
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        try:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                for table in tables:
+                    pickle.dump((table.page, table.df.values.tolist()), f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield table
+            os.replace(tmp_path, file_path)     # 多进程同时写同一个key时, 保证文件完整
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """ 缓存超过大小上限时, 删除最久没有访问的缓存文件 """
+        entries = list()
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(self.suffix):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
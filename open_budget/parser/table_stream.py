@@ -0,0 +1,49 @@
+from collections import deque
+from typing import Deque, Iterable, Iterator, List
+
+from open_budget.parser.vector_lattice import parse_pages
+
+
+class TableWindow:
+    """ 把table的迭代器包装成可以按下标访问的序列, 给parsers流式解析用.
+    按下标访问时才从迭代器读取table, release之后前面的table就不再保留.
+    parsers从当前table往后最多看4个(get_df最多合并4个table), 所以每次release到当前下标, 同时保留的table数不超过4个,
+    和pdf有多少页无关. 访问已经释放的table或者超出末尾时抛出IndexError, 和list一样.
+    """
+
+    def __init__(self, tables: Iterable):
+        self._tables = iter(tables)
+        self._buffer: Deque = deque()
+        self.start = 0      # _buffer[0]的下标
+        self.peak = 0       # 同时保留的table数的最大值
+
+    def __getitem__(self, index):
+        if index < self.start:
+            raise IndexError(f'table {index}已经释放')
+        while index >= self.consumed:
+            try:
+                self._buffer.append(next(self._tables))
+            except StopIteration:
+                raise IndexError(f'table {index}超出范围') from None
+            self.peak = max(self.peak, len(self._buffer))
+        return self._buffer[index - self.start]
+
+    @property
+    def consumed(self) -> int:
+        """ 已经从迭代器读取的table数 """
+        return self.start + len(self._buffer)
+
+    def release(self, index):
+        """ 释放下标小于index的table """
+        while self._buffer and self.start < index:
+            self._buffer.popleft()
+            self.start += 1
+
+
+def page_batches(pages: str, total: int, batch_pages: int) -> Iterator[str]:
+    """ 把pages(camelot.read_pdf的pages参数)分成每批最多batch_pages页, 返回每批的pages参数.
+    pages为'all'时, 按pdf总页数total分批 """
+    selected = parse_pages(pages)
+    numbers: List[int] = list(range(1, total + 1)) if selected is None else sorted(selected)
+    for k in range(0, len(numbers), batch_pages):
+        yield ','.join(str(number) for number in numbers[k:k + batch_pages])
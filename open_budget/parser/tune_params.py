@@ -0,0 +1,265 @@
+import datetime
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import click
+from camelot.handlers import PDFHandler
+from camelot.parsers import Lattice
+from camelot.utils import get_image_char_and_text_objects
+from pdfminer.layout import LTPage
+
+from open_budget.parser import vector_lattice
+from open_budget.parser.page_filter import select_pages
+from open_budget.parser.parse_profile import apply_profile, remove_profile, save_profile
+from open_budget.parser.pdf_parser import BACKENDS, PARSER_TYPES, READ_PDF_KWARGS, BaseParser, DeptFilesParser, \
+    list_departments
+from open_budget.parser.table_cache import CachedTable
+
+# 调优的参数网格. char_margin: 字符间距小于它(字符宽度的倍数)时算同一行; line_margin: 行间距小于它(行高的倍数)时
+# 算同一段; word_margin: 字符间距大于它时插入空格; copy_text: 合并单元格的文字复制的方向; strip_text: 去掉的字符
+PARAM_GRID = dict(
+    char_margin=(0.5, 1.0, 2.0, 3.0),
+    line_margin=(0.2, 0.5, 1.0),
+    word_margin=(0.05, 0.1, 0.3),
+    copy_text=(['h'], ['h', 'v']),
+    strip_text=('\n', ' \n'),
+)
+
+# camelot做版面分析时(get_page_layout)和pdfminer的LAParams默认值不同的参数
+CAMELOT_LAYOUT_DEFAULTS = dict(detect_vertical=True, all_texts=True)
+
+# camelot识别出来的一页的表格线: (table_bbox_parses, vertical_segments, horizontal_segments)
+Lines = tuple
+# [(文件名, [(页码, 没有做版面分析的页面, 表格线)])], vector后端的表格线是None.
+# 每个worker进程初始化时收到一次, 所有参数组合共用
+Samples = List[Tuple[str, List[Tuple[int, LTPage, Optional[Lines]]]]]
+_samples: Samples = None
+
+
+@click.command()
+@click.argument('path', default='../../pdf_files/jszwfw', type=click.Path(exists=True))
+@click.option('--jobs', '-j',
+              default=1, type=int,
+              help="Number of worker processes trying parameters in parallel. Defaults to 1")
+@click.option('--files',
+              default=None, type=int,
+              help="Tune on the pdf files of the latest years only, at most this many per department. Defaults to all")
+@click.option('--trials',
+              default=None, type=int,
+              help="Random search: try this many parameter combinations sampled from the grid, "
+                   "instead of the whole grid. Defaults to the whole grid")
+@click.option('--seed',
+              default=0, type=int,
+              help="Random seed of the random search. Defaults to 0")
+@click.option('--backend',
+              default='camelot', type=click.Choice(BACKENDS),
+              help="Table extraction backend the parameters are tuned for, see pdf_parser.py --backend. "
+                   "Defaults to camelot")
+@click.option('--dry-run', is_flag=True,
+              help="Only print the best parameters, do not write or remove the profiles")
+def run(path, jobs, files, trials, seed, backend, dry_run):
+    """ 按部门调优提取table的参数(layout_kwargs, copy_text, strip_text), 最好的参数和backend写入部门目录下的
+    parse_profile.json, 之后pdf_parser.py用同一个backend解析这个部门时自动使用. 默认参数得分最高时删除配置.
+    每组参数的得分: 表头签名对得上的table每个1分, 找到表尾(has_tail)再加1分, 合计(reconcile)每组对得上再加1分.
+    提取或解析table出错的参数得0分.
+    每个pdf文件只读取一次筛选出来的页(文字和画线, 不做版面分析), 每组参数只重新做版面分析, 用backend提取table.
+    camelot后端每页只渲染一次图片识别表格线(和参数无关), 每组参数只重新把文字放进单元格.
+    Examples:
+    $python tune_params.py ../../pdf_files/jszwfw/江苏省人大办公厅
+    $python tune_params.py ../../pdf_files/jszwfw --jobs 4
+    $python tune_params.py ../../pdf_files/jszwfw --files 2 --trials 30
+    $python tune_params.py ../../pdf_files/jszwfw --backend vector
+    $python tune_params.py ../../pdf_files/jszwfw --dry-run
+    """
+    if jobs < 1 or (files is not None and files < 1) or (trials is not None and trials < 1):
+        click.secho('Invalid jobs, files or trials. They must be at least 1', err=True, fg='red')
+        return
+    _, departments = list_departments(path)
+    for dept_name, dept_path in departments:
+        parser = DeptFilesParser(dept_name, dept_path, backend=backend)
+        samples = load_samples(parser, files)
+        if not samples:
+            click.echo(f'{dept_name}: 没有找到包含目标表格的页, 跳过')
+            continue
+        params_list = candidates(PARAM_GRID, parser.profile, trials, seed)
+        start = time.time()
+        scores = score_parallel(samples, params_list, jobs)
+        best = max(range(len(params_list)), key=lambda k: scores[k])    # 得分相同时取前面的, 和默认参数差别小
+        click.echo(f'{dept_name}: {len(samples)}个文件, {len(params_list)}组参数, 耗时{time.time() - start:.1f}s. '
+                   f'默认参数{scores[0]}分, 最好{scores[best]}分')
+        if best == 0:
+            click.echo('  默认参数最好')
+            if not dry_run and remove_profile(dept_path, backend):
+                click.echo('  删除参数配置')
+            continue
+        click.echo(f'  {params_list[best]}')
+        if not dry_run:
+            tuning = {'score': scores[best], 'default_score': scores[0], 'files': [name for name, _ in samples],
+                      'trials': len(params_list), 'time': datetime.datetime.now().isoformat(timespec='seconds')}
+            click.echo('  保存参数配置到 >> ' + save_profile(dept_path, params_list[best], tuning, backend))
+
+
+def load_samples(parser: DeptFilesParser, max_files=None) -> Samples:
+    """ 读取部门最近几年(最多max_files个)包含目标表格的pdf文件里, 筛选出来的页, 每页只读取一次.
+    parser.backend是camelot时, 同时识别每页的表格线 """
+    files = sorted(parser.list_files(), key=lambda item: (-item[1], item[0]))
+    samples = list()
+    for file_path, _ in files:
+        if max_files is not None and len(samples) >= max_files:
+            break
+        pages, _ = select_pages(file_path, parser._page_keywords())
+        if not pages:
+            continue    # 没有目标表格的文件, 比如预算说明
+        try:
+            if parser.backend == 'vector':
+                layouts = [(number, raw, None) for number, raw in vector_lattice.read_layouts(file_path, pages)]
+            else:
+                layouts = render_pages(file_path, pages)
+        except Exception as e:
+            logging.warning(f'读取{file_path}出错, 不参与调优. {e!r}')
+            continue
+        samples.append((os.path.basename(file_path), layouts))
+    return samples
+
+
+def render_pages(file_path, pages) -> List[Tuple[int, LTPage, Lines]]:
+    """ 和camelot.read_pdf一样把每页存成单页的pdf(旋转过的页会转正), 渲染成图片识别表格线.
+    表格线和提取参数无关, 每页只识别一次. 返回[(页码, 单页pdf没有做版面分析的页面, 表格线)] """
+    handler = PDFHandler(file_path, pages)
+    layout_kwargs = READ_PDF_KWARGS['layout_kwargs']
+    res = list()
+    with tempfile.TemporaryDirectory() as tempdir:
+        for number in handler.pages:
+            layout, dimensions, images, _, horizontal_text, vertical_text = handler._save_page(
+                file_path, number, tempdir, **layout_kwargs)
+            page_path = os.path.join(tempdir, f'page-{number}.pdf')
+            lattice = Lattice()
+            lattice.prepare_page_parse(page_path, layout, dimensions, number, images, horizontal_text, vertical_text,
+                                       layout_kwargs)
+            lattice._generate_table_bbox()
+            (_, raw), = vector_lattice.read_layouts(page_path)
+            res.append((number, raw, (lattice.table_bbox_parses, lattice.vertical_segments,
+                                      lattice.horizontal_segments)))
+    return res
+
+
+class _CachedLattice(Lattice):
+    """ 用render_pages识别出来的表格线, 不重新渲染图片 """
+    def __init__(self, lines: Lines, **kwargs):
+        super().__init__(**kwargs)
+        self.lines = lines
+
+    def _generate_table_bbox(self):
+        self.table_bbox_parses, self.vertical_segments, self.horizontal_segments = self.lines
+
+
+def candidates(grid: Dict[str, Sequence], profile: dict = None, trials=None, seed=0) -> List[dict]:
+    """ 要尝试的参数组合. 第一组是默认参数(READ_PDF_KWARGS), 第二组是部门现有的配置,
+    后面是网格里的组合, 按和默认参数不同的参数个数排序. trials不是None时, 从网格里随机抽取, 总共trials组 """
+    default = _params(READ_PDF_KWARGS)
+    res = [default]
+    if profile:
+        res.append(_params(apply_profile(READ_PDF_KWARGS, profile)))
+    layout_keys = [key for key in grid if key not in ('copy_text', 'strip_text')]
+    combos = list()
+    for values in itertools.product(*grid.values()):
+        combo = dict(zip(grid, values))
+        layout_kwargs = dict(default['layout_kwargs'], **{key: combo[key] for key in layout_keys})
+        combos.append(_params(dict(layout_kwargs=layout_kwargs,
+                                   copy_text=combo.get('copy_text', default['copy_text']),
+                                   strip_text=combo.get('strip_text', default['strip_text']))))
+    combos = [params for params in combos if params not in res]
+    if trials is not None:
+        combos = random.Random(seed).sample(combos, max(0, min(trials - len(res), len(combos))))
+    combos.sort(key=lambda params: _distance(params, default))
+    return res + combos
+
+
+def _params(kwargs: dict) -> dict:
+    return {'layout_kwargs': dict(kwargs['layout_kwargs']), 'copy_text': list(kwargs['copy_text']),
+            'strip_text': kwargs['strip_text']}
+
+
+def _distance(params: dict, default: dict) -> int:
+    """ 和默认参数不同的参数个数 """
+    layout_kwargs = params['layout_kwargs']
+    return (sum(value != default['layout_kwargs'].get(key) for key, value in layout_kwargs.items()) +
+            (params['copy_text'] != default['copy_text']) + (params['strip_text'] != default['strip_text']))
+
+
+def score_parallel(samples: Samples, params_list: List[dict], jobs=1) -> List[int]:
+    """ 在jobs个进程里给每组参数打分. 页面只在每个进程初始化时传一次 """
+    if jobs == 1:
+        _init_worker(samples)
+        try:
+            return [score_params(params) for params in params_list]
+        finally:
+            _init_worker(None)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(samples,)) as executor:
+        return list(executor.map(score_params, params_list, chunksize=max(1, len(params_list) // (jobs * 4))))
+
+
+def _init_worker(samples: Samples):
+    global _samples
+    _samples = samples
+
+
+def score_params(params: dict) -> int:
+    """ 用一组参数重新做版面分析, 提取table, 所有文件的得分之和. 出错时得0分, 不影响其他参数 """
+    parsers = [parser_type() for parser_type in PARSER_TYPES.values()]
+    score = 0
+    for name, layouts in _samples:
+        try:
+            score += score_tables(extract_tables(layouts, params), parsers)
+        except Exception as e:
+            logging.warning(f'参数{params}提取或解析{name}的table出错, 得0分. {e!r}')
+            return 0
+    return score
+
+
+def extract_tables(layouts: List[Tuple[int, LTPage, Optional[Lines]]], params: dict) -> list:
+    """ 用一组参数提取一个文件的table. 有表格线的页和camelot一样提取, 否则和vector后端一样提取 """
+    tables = list()
+    for number, raw, lines in layouts:
+        if lines is None:
+            page = vector_lattice.analyze_layout(raw, params['layout_kwargs'])
+            tables.extend(vector_lattice.extract_tables(page, number, params['copy_text'], params['strip_text']))
+            continue
+        page = vector_lattice.analyze_layout(raw, dict(CAMELOT_LAYOUT_DEFAULTS, **params['layout_kwargs']))
+        images, _, horizontal_text, vertical_text = get_image_char_and_text_objects(page)
+        lattice = _CachedLattice(lines, copy_text=params['copy_text'], strip_text=params['strip_text'])
+        lattice.prepare_page_parse(f'page-{number}.pdf', page, (page.bbox[2], page.bbox[3]), number, images,
+                                   horizontal_text, vertical_text, params['layout_kwargs'])
+        tables.extend(CachedTable(number, table.df.values.tolist()) for table in lattice.extract_tables())
+    return tables
+
+
+def score_tables(tables: list, parsers: List[BaseParser]) -> int:
+    """ 一个文件的table的得分: 表头签名对得上1分, 找到表尾再加1分, 合并后的表里合计每组对得上再加1分 """
+    dispatch = {parser.head_signature: parser for parser in parsers}
+    score = 0
+    i = 0
+    while i < len(tables):
+        parser = dispatch.get(BaseParser.signature(tables[i].df))
+        if parser is None:
+            i += 1
+            continue
+        score += 1
+        df, next_i = parser.get_df(tables, i)
+        if df is None:
+            i += 1
+            continue
+        parser.correct(df)
+        score += 1 + parser.reconcile(df)
+        i = next_i
+    return score
+
+
+if __name__ == '__main__':
+    run()
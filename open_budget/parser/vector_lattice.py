@@ -0,0 +1,325 @@
+import math
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LAParams, LTContainer, LTCurve, LTLine, LTPage, LTRect, LTTextLineHorizontal
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+from open_budget.parser.table_cache import CachedTable
+
+# 提取逻辑的版本, 修改了提取逻辑(会改变提取结果)时加1, 作为缓存key的一部分
+VERSION = 1
+
+
+class Segment(NamedTuple):
+    """ 水平或者垂直的线段, x0 <= x1, y0 <= y1 """
+    x0: float
+    y0: float
+    x1: float
+    y1: float
+
+
+def read_pdf(file_path, pages='all', layout_kwargs: dict = None, copy_text: Sequence[str] = (), strip_text='',
+             line_tol=2, joint_tol=2) -> List[CachedTable]:
+    """ 不经过渲染图片, 直接从pdf的画线操作(线段和矩形)重建表格的单元格, 再把文本层的文字放进单元格.
+    结果和camelot lattice一样: 每个表格一个CachedTable, 合并单元格的文字放在左上角, copy_text包含'h'时复制到右边.
+    Parameters
+    ----------
+    file_path : pdf文件路径
+    pages : str, 和camelot.read_pdf一样, 比如'all', '1,3,5', '2-4'
+    layout_kwargs : pdfminer版面分析的参数LAParams
+    copy_text : 合并单元格的文字复制的方向, 'h'水平, 'v'垂直
+    strip_text : 从文字里去掉的字符
+    line_tol : 坐标相差不超过line_tol的表格线合并为一条
+    joint_tol : 线段端点和表格线相差不超过joint_tol时认为相交
+    """
+    return list(iter_tables(file_path, pages, layout_kwargs, copy_text, strip_text, line_tol, joint_tol))
+
+
+def iter_tables(file_path, pages='all', layout_kwargs: dict = None, copy_text: Sequence[str] = (), strip_text='',
+                line_tol=2, joint_tol=2) -> Iterator[CachedTable]:
+    """ 和read_pdf一样, 但是逐页提取, 逐个返回table, 只保留当前页的版面分析结果 """
+    wanted = parse_pages(pages)
+    manager = PDFResourceManager(caching=True)
+    device = PDFPageAggregator(manager, laparams=LAParams(**(layout_kwargs or {})))
+    interpreter = PDFPageInterpreter(manager, device)
+    with open(file_path, 'rb') as f:
+        for number, page in enumerate(PDFPage.get_pages(f), 1):
+            if wanted is not None and number not in wanted:
+                continue
+            interpreter.process_page(page)
+            yield from extract_tables(device.get_result(), number, copy_text, strip_text, line_tol, joint_tol)
+
+
+def read_layouts(file_path, pages='all') -> List[Tuple[int, LTPage]]:
+    """ 读取页面上的文字和画线, 不做版面分析(laparams=None). 返回[(页码, 页面)], 页面可以pickle.
+    调优提取参数时每页只读取一次, 每组参数用analyze_layout重新做版面分析 """
+    wanted = parse_pages(pages)
+    manager = PDFResourceManager(caching=True)
+    device = PDFPageAggregator(manager, laparams=None)
+    interpreter = PDFPageInterpreter(manager, device)
+    res = list()
+    with open(file_path, 'rb') as f:
+        for number, page in enumerate(PDFPage.get_pages(f), 1):
+            if wanted is not None and number not in wanted:
+                continue
+            interpreter.process_page(page)
+            res.append((number, device.get_result()))
+    return res
+
+
+def analyze_layout(raw: LTPage, layout_kwargs: dict = None) -> LTPage:
+    """ 用layout_kwargs对read_layouts读取的页面做版面分析, 返回新的页面, 不修改raw.
+    和iter_tables里PDFPageAggregator带laparams时的结果一样 """
+    page = LTPage(raw.pageid, raw.bbox, raw.rotate)
+    for item in raw:
+        page.add(item)
+    page.analyze(LAParams(**(layout_kwargs or {})))
+    return page
+
+
+def parse_pages(pages: str) -> Optional[Set[int]]:
+    """ 解析camelot的pages参数, 返回页码(从1开始)的集合, 'all'返回None """
+    if pages == 'all':
+        return None
+    res = set()
+    for part in str(pages).split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            res.update(range(int(start), int(end) + 1))
+        elif part.strip():
+            res.add(int(part))
+    return res
+
+
+def extract_tables(layout: LTContainer, page, copy_text: Sequence[str] = (), strip_text='', line_tol=2,
+                   joint_tol=2) -> List[CachedTable]:
+    """ 从一页的版面分析结果里提取表格, 按从上到下的顺序返回 """
+    horizontals, verticals = find_segments(layout, line_tol)
+    texts = list(_text_lines(layout))
+    res = list()
+    for hs, vs, joints in sorted(_group(horizontals, verticals, joint_tol), key=lambda t: -max(h.y0 for h in t[0])):
+        if len(joints) <= 4:     # 和camelot一样, 少于4个交点的不是表格
+            continue
+        grid = _Grid(hs, vs, joints, line_tol, joint_tol)
+        grid.set_text(texts, strip_text)
+        grid.copy_spanning_text(copy_text)
+        res.append(CachedTable(page, grid.data()))
+    return res
+
+
+def find_segments(layout: LTContainer, tol=2) -> Tuple[List[Segment], List[Segment]]:
+    """ 找出页面上画出来的水平线和垂直线. 画线操作在pdfminer里是LTLine, LTRect和LTCurve:
+    描边的线段和矩形边框是表格线; 填充的细长矩形(或者细长的四边形路径)也是表格线; 白色的填充(单元格背景)看不见, 跳过 """
+    horizontals, verticals = list(), list()
+
+    def add(x0, y0, x1, y1):
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        if y1 - y0 <= tol and x1 - x0 > tol:
+            y = (y0 + y1) / 2
+            horizontals.append(Segment(x0, y, x1, y))
+        elif x1 - x0 <= tol and y1 - y0 > tol:
+            x = (x0 + x1) / 2
+            verticals.append(Segment(x, y0, x, y1))
+
+    for item in _walk(layout):
+        if not isinstance(item, LTCurve):
+            continue
+        stroked = item.stroke and _is_visible(item.stroking_color)
+        filled = item.fill and _is_visible(item.non_stroking_color)
+        if isinstance(item, LTLine):
+            if stroked or filled:
+                add(item.x0, item.y0, item.x1, item.y1)
+        elif filled and (item.width <= tol or item.height <= tol):
+            add(item.x0, item.y0, item.x1, item.y1)
+        elif isinstance(item, LTRect) and stroked:
+            add(item.x0, item.y0, item.x1, item.y0)
+            add(item.x0, item.y1, item.x1, item.y1)
+            add(item.x0, item.y0, item.x0, item.y1)
+            add(item.x1, item.y0, item.x1, item.y1)
+        elif stroked:
+            for (x0, y0), (x1, y1) in zip(item.pts, item.pts[1:]):
+                add(x0, y0, x1, y1)
+    return horizontals, verticals
+
+
+def merge_close_lines(values: Iterable[float], line_tol=2) -> List[float]:
+    """ 合并相差不超过line_tol的坐标(和camelot一样取滑动平均), values需要排好序 """
+    res = list()
+    for v in values:
+        if res and math.isclose(res[-1], v, abs_tol=line_tol):
+            res[-1] = (res[-1] + v) / 2.0
+        else:
+            res.append(v)
+    return res
+
+
+def _walk(layout: LTContainer):
+    for item in layout:
+        yield item
+        if isinstance(item, LTContainer):
+            yield from _walk(item)
+
+
+def _text_lines(layout: LTContainer):
+    for item in _walk(layout):
+        if isinstance(item, LTTextLineHorizontal):
+            yield item
+
+
+def _is_visible(color) -> bool:
+    """ 颜色是不是白色(灰度1, RGB(1, 1, 1), CMYK(0, 0, 0, 0)); 没有颜色时当作黑色 """
+    if color is None:
+        return True
+    if isinstance(color, (int, float)):
+        return color < 1
+    color = tuple(color)
+    if not all(isinstance(c, (int, float)) for c in color):     # 图案(pattern)填充, 颜色是图案名
+        return True
+    if len(color) == 1:
+        return color[0] < 1
+    if len(color) == 3:
+        return any(c < 1 for c in color)
+    if len(color) == 4:
+        return any(c > 0 for c in color)
+    return True
+
+
+def _group(horizontals: List[Segment], verticals: List[Segment], tol) \
+        -> List[Tuple[List[Segment], List[Segment], List[Tuple[float, float]]]]:
+    """ 相交的线段连成一个表格, 返回每个表格的(水平线, 垂直线, 交点) """
+    if not horizontals or not verticals:
+        return []
+    h = np.array(horizontals)
+    v = np.array(verticals)
+    # cross[i, j]: 水平线i和垂直线j相交
+    cross = ((v[:, 0] >= h[:, 0, None] - tol) & (v[:, 0] <= h[:, 2, None] + tol) &
+             (h[:, 1, None] >= v[:, 1] - tol) & (h[:, 1, None] <= v[:, 3] + tol))
+    res = list()
+    seen_h = np.zeros(len(h), dtype=bool)
+    for start in range(len(h)):
+        if seen_h[start] or not cross[start].any():
+            continue
+        h_mask = np.zeros(len(h), dtype=bool)
+        h_mask[start] = True
+        v_mask = np.zeros(len(v), dtype=bool)
+        while True:     # 交替扩展水平线和垂直线, 直到不变
+            new_v = cross[h_mask].any(axis=0) | v_mask
+            new_h = cross[:, new_v].any(axis=1) | h_mask
+            if (new_v == v_mask).all() and (new_h == h_mask).all():
+                break
+            h_mask, v_mask = new_h, new_v
+        seen_h |= h_mask
+        rows, cols = cross[np.ix_(h_mask, v_mask)].nonzero()
+        hs = [horizontals[i] for i in h_mask.nonzero()[0]]
+        vs = [verticals[j] for j in v_mask.nonzero()[0]]
+        joints = [(vs[j].x0, hs[i].y0) for i, j in zip(rows, cols)]
+        res.append((hs, vs, joints))
+    return res
+
+
+class _Grid:
+    """ 表格线交点的x坐标是列的边界, y坐标是行的边界. 每个单元格记录左边和上边有没有线,
+    没有线说明和左边(上边)的格子是一个合并单元格 """
+
+    def __init__(self, hs: List[Segment], vs: List[Segment], joints: List[Tuple[float, float]], line_tol=2,
+                 joint_tol=2):
+        x0, x1 = min(h.x0 for h in hs), max(h.x1 for h in hs)
+        y0, y1 = min(v.y0 for v in vs), max(v.y1 for v in vs)
+        self.bbox = (x0, y0, x1, y1)
+        self.cols = merge_close_lines(sorted([x for x, _ in joints] + [x0, x1]), line_tol)
+        self.rows = merge_close_lines(sorted([y for _, y in joints] + [y0, y1], reverse=True), line_tol)
+        shape = (max(len(self.rows) - 1, 0), max(len(self.cols) - 1, 0))
+        self.left = np.zeros(shape, dtype=bool)     # 单元格左边有没有线
+        self.top = np.zeros(shape, dtype=bool)      # 单元格上边有没有线
+        self.text = [[''] * shape[1] for _ in range(shape[0])]
+        self._set_edges(hs, vs, joint_tol)
+
+    def _set_edges(self, hs: List[Segment], vs: List[Segment], tol):
+        n_rows, n_cols = self.left.shape
+        tops, bottoms = np.array(self.rows[:-1]), np.array(self.rows[1:])
+        lefts, rights = np.array(self.cols[:-1]), np.array(self.cols[1:])
+        for v in vs:
+            i = self._anchor(self.cols, v.x0, tol)
+            if i is None:
+                continue
+            covered = (v.y1 >= tops - tol) & (v.y0 <= bottoms + tol)
+            if i < n_cols:
+                self.left[covered, i] = True
+        for h in hs:
+            j = self._anchor(self.rows, h.y0, tol)
+            if j is None:
+                continue
+            covered = (h.x0 <= lefts + tol) & (h.x1 >= rights - tol)
+            if j < n_rows:
+                self.top[j, covered] = True
+        self.left[:, 0] = self.top[0, :] = True
+
+    @staticmethod
+    def _anchor(anchors: List[float], value, tol) -> Optional[int]:
+        for k, anchor in enumerate(anchors):
+            if math.isclose(anchor, value, abs_tol=tol):
+                return k
+        return None
+
+    def set_text(self, lines: List[LTTextLineHorizontal], strip_text=''):
+        """ 把表格范围内的文本行放进单元格: 行按文字的垂直中心, 列按水平方向重叠最多的列.
+        合并单元格的文字移到左上角的格子, 同一个格子的多个文本行从上到下拼接 """
+        if not self.text or not self.text[0]:
+            return
+        x0, y0, x1, y1 = self.bbox
+        inside = [t for t in lines
+                  if x0 - 2 <= (t.x0 + t.x1) / 2 <= x1 + 2 and y0 - 2 <= (t.y0 + t.y1) / 2 <= y1 + 2]
+        inside.sort(key=lambda t: (-t.y0, t.x0))
+        strip = re.compile('[' + re.escape(strip_text) + ']') if strip_text else None
+        for t in _dedupe(inside):
+            center = (t.y0 + t.y1) / 2
+            r = next((r for r in range(len(self.rows) - 1) if self.rows[r] > center > self.rows[r + 1]), None)
+            if r is None:
+                continue
+            overlaps = [(min(t.x1, right) - max(t.x0, left)) / (right - left) if left <= t.x1 and right >= t.x0
+                        else -1 for left, right in zip(self.cols, self.cols[1:])]
+            c = overlaps.index(max(overlaps))
+            while c > 0 and not self.left[r, c]:
+                c -= 1
+            while r > 0 and not self.top[r, c]:
+                r -= 1
+            text = t.get_text()
+            self.text[r][c] += strip.sub('', text) if strip else text
+
+    def copy_spanning_text(self, copy_text: Sequence[str] = ()):
+        """ 合并单元格里空的格子复制左边('h')或者上面('v')格子的文字 """
+        for direction in copy_text:
+            for r, row in enumerate(self.text):
+                for c in range(len(row)):
+                    if row[c].strip():
+                        continue
+                    if direction == 'h' and not self.left[r, c]:
+                        row[c] = row[c - 1]
+                    elif direction == 'v' and not self.top[r, c]:
+                        row[c] = self.text[r - 1][c]
+
+    def data(self) -> List[List[str]]:
+        return [[text.strip() for text in row] for row in self.text]
+
+
+def _dedupe(lines: List[LTTextLineHorizontal]) -> List[LTTextLineHorizontal]:
+    """ 去掉和另一个更长的文本行重叠超过80%的文本行(重复绘制的文字), 保持原来的顺序 """
+    dropped = set()
+    for a in lines:
+        area = (a.x1 - a.x0) * (a.y1 - a.y0)
+        for b in lines:
+            if a is b or id(b) in dropped:
+                continue
+            width = min(a.x1, b.x1) - max(a.x0, b.x0)
+            height = min(a.y1, b.y1) - max(a.y0, b.y0)
+            if width < 0 or height < 0:
+                continue
+            if (area == 0 or width * height / area > 0.8) and b.x1 - b.x0 >= a.x1 - a.x0:
+                dropped.add(id(a))
+                break
+    return [t for t in lines if id(t) not in dropped]
@@ -0,0 +1,221 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from open_budget.parser.table_cache import file_sha256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    department TEXT NOT NULL,
+    path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    token INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    UNIQUE (path, file_name)
+);
+CREATE INDEX IF NOT EXISTS idx_state ON jobs (state, id);
+CREATE TABLE IF NOT EXISTS results (
+    job_id INTEGER PRIMARY KEY REFERENCES jobs (id),
+    token INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    finished REAL NOT NULL,
+    result BLOB NOT NULL
+);
+"""
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+class Job(NamedTuple):
+    id: int
+    department: str
+    path: str       # 部门目录
+    file_path: str
+    year: int
+    token: int      # 领取任务时加1, 只有持有最新token的worker能续租和提交结果
+    attempts: int
+
+
+class WorkQueue:
+    """ 多台机器上的解析进程共享的任务队列, 每个任务是一个(部门, pdf文件).
+    队列是共享存储上的一个SQLite文件, 不需要消息中间件. 共享存储需要支持文件锁(比如NFSv4, SMB),
+    SQLite在网络文件系统上不能用WAL模式, 这里用默认的回滚日志. 租约用各节点的时钟, 节点之间需要同步时钟(NTP).
+    - 领取(claim): 一个事务里选出最早的等待中的任务, 或者租约过期(节点崩溃)的任务, 设置租约, token加1
+    - 心跳(heartbeat): 解析期间定时延长租约, token不是自己的(租约过期后被别的节点领取了)就失败
+    - 提交(complete): 一个事务里检查token, 把任务标记为完成并写入结果. 同一个任务只有一个结果, 不会重复提交
+    - 失败(fail): 尝试次数没有超过max_attempts时重新等待领取, 否则标记为失败
+    部门目录保存为相对队列文件所在目录的路径, 各节点挂载共享存储的位置可以不同.
+    """
+
+    def __init__(self, db_path, lease=600.0, max_attempts=3):
+        """
+        Parameters
+        ----------
+        db_path : 队列文件路径
+        lease : float, 租约的秒数, 超过这个时间没有心跳的任务可以被别的节点领取
+        max_attempts : int, 每个任务最多尝试的次数
+        """
+        self.db_path = str(db_path)
+        self.root = os.path.dirname(os.path.abspath(self.db_path))
+        self.lease = lease
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """ BEGIN IMMEDIATE: 开始时就拿到写锁, 多个节点同时领取任务时不会选中同一个 """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def enqueue(self, dept_name, dept_path, files: List[Tuple[str, int]], reset=False) -> int:
+        """ 加入部门的pdf文件, 返回新加入或者需要重新解析的任务数.
+        已经在队列里的文件, 内容(sha256)变化了或者reset为True时重新等待领取, 原来的结果作废 """
+        path = os.path.relpath(os.path.abspath(dept_path), self.root)
+        hashed = [(os.path.basename(file_path), year, file_sha256(file_path)) for file_path, year in files]
+        count = 0
+        with self._transaction() as conn:     # 事务里不计算hash, 少占用写锁
+            for name, year, sha256 in hashed:
+                row = conn.execute('SELECT id, sha256 FROM jobs WHERE path = ? AND file_name = ?',
+                                   (path, name)).fetchone()
+                if row is None:
+                    conn.execute('INSERT INTO jobs (department, path, file_name, year, sha256) VALUES (?, ?, ?, ?, ?)',
+                                 (dept_name, path, name, year, sha256))
+                elif reset or row[1] != sha256:
+                    conn.execute("""UPDATE jobs SET year = ?, sha256 = ?, state = 'pending', attempts = 0,
+                                    token = token + 1, worker = NULL, lease_until = NULL, error = NULL
+                                    WHERE id = ?""", (year, sha256, row[0]))
+                    conn.execute('DELETE FROM results WHERE job_id = ?', (row[0],))
+                else:
+                    continue
+                count += 1
+        return count
+
+    def claim(self, worker) -> Optional[Job]:
+        """ 领取一个任务, 没有可以领取的任务时返回None """
+        now = time.time()
+        with self._transaction() as conn:
+            # 租约过期并且已经用完尝试次数的任务, 不再领取
+            conn.execute("""UPDATE jobs SET state = 'failed', error = '租约过期, 节点可能崩溃了'
+                            WHERE state = 'running' AND lease_until < ? AND attempts >= ?""",
+                         (now, self.max_attempts))
+            row = conn.execute("""SELECT id, department, path, file_name, year, token, attempts FROM jobs
+                                  WHERE state = 'pending' OR (state = 'running' AND lease_until < ?)
+                                  ORDER BY id LIMIT 1""", (now,)).fetchone()
+            if row is None:
+                return None
+            job_id, department, path, file_name, year, token, attempts = row
+            conn.execute("""UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, token = ?, attempts = ?
+                            WHERE id = ?""", (worker, now + self.lease, token + 1, attempts + 1, job_id))
+        dept_path = os.path.normpath(os.path.join(self.root, path))
+        return Job(job_id, department, dept_path, os.path.join(dept_path, file_name), year, token + 1, attempts + 1)
+
+    def heartbeat(self, job: Job) -> bool:
+        """ 延长租约. 返回False表示任务已经被别的节点领取了 """
+        with self._transaction() as conn:
+            cursor = conn.execute("""UPDATE jobs SET lease_until = ?
+                                     WHERE id = ? AND token = ? AND state = 'running'""",
+                                  (time.time() + self.lease, job.id, job.token))
+        return cursor.rowcount == 1
+
+    def complete(self, job: Job, result: bytes, worker) -> bool:
+        """ 提交结果. 返回False表示租约已经失效, 结果被丢弃 """
+        with self._transaction() as conn:
+            cursor = conn.execute("""UPDATE jobs SET state = 'done', lease_until = NULL, error = NULL
+                                     WHERE id = ? AND token = ? AND state = 'running'""", (job.id, job.token))
+            if cursor.rowcount != 1:
+                return False
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                         (job.id, job.token, worker, time.time(), result))
+        return True
+
+    def fail(self, job: Job, error: str):
+        """ 任务出错, 还有尝试次数时重新等待领取 """
+        with self._transaction() as conn:
+            conn.execute("""UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                            lease_until = NULL, error = ? WHERE id = ? AND token = ? AND state = 'running'""",
+                         (self.max_attempts, error, job.id, job.token))
+
+    def counts(self) -> Dict[str, int]:
+        """ 每种状态的任务数 """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return dict({state: 0 for state in STATES}, **dict(rows))
+
+    def is_finished(self) -> bool:
+        """ 所有任务都完成或者失败了 """
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['running'] == 0
+
+    def departments(self) -> List[Tuple[str, str]]:
+        """ [(部门名称, 部门目录)], 按加入队列的顺序 """
+        with self._connect() as conn:
+            rows = conn.execute('SELECT department, path, MIN(id) FROM jobs GROUP BY department, path '
+                                'ORDER BY MIN(id)').fetchall()
+        return [(department, os.path.normpath(os.path.join(self.root, path))) for department, path, _ in rows]
+
+    def results(self, dept_path) -> Iterator[bytes]:
+        """ 部门已经完成的任务的结果, 按加入队列的顺序, 合并结果和串行解析一致 """
+        path = os.path.relpath(os.path.abspath(dept_path), self.root)
+        with self._connect() as conn:
+            for (result,) in conn.execute("""SELECT results.result FROM jobs JOIN results ON results.job_id = jobs.id
+                                             WHERE jobs.path = ? AND jobs.state = 'done' ORDER BY jobs.id""", (path,)):
+                yield result
+
+    def failed(self) -> List[Tuple[str, str, int, str]]:
+        """ 用完尝试次数的任务, [(部门名称, 文件名, 尝试次数, 最后的错误)] """
+        with self._connect() as conn:
+            return conn.execute("""SELECT department, file_name, attempts, error FROM jobs
+                                   WHERE state = 'failed' ORDER BY id""").fetchall()
+
+
+class Heartbeat:
+    """ 解析任务期间, 在后台线程里每lease/3秒续租一次 """
+
+    def __init__(self, queue: WorkQueue, job: Job):
+        self.queue = queue
+        self.job = job
+        self.lost = False      # 租约被别的节点领取了
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'heartbeat-{job.id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.queue.lease / 3):
+            try:
+                if not self.queue.heartbeat(self.job):
+                    self.lost = True
+                    return
+            except sqlite3.Error:
+                pass    # 共享存储暂时不可用, 下次再试, 租约过期前恢复就不影响
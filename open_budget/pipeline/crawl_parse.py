@@ -0,0 +1,246 @@
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from typing import Deque, Dict, List, Optional, Tuple
+
+import click
+from urllib3.exceptions import MaxRetryError
+
+from open_budget.parser.parquet_store import ParquetStore
+from open_budget.parser.pdf_parser import BACKENDS, DeptFilesParser, parse_dept_file
+from open_budget.parser.quarantine import failure_summary
+from open_budget.parser.sqlite_index import BudgetIndex
+from open_budget.parser.table_cache import TableCache
+from open_budget.spider.jszwfw_spider import run_parallel, spider_type
+
+
+@click.command()
+@click.argument('local_dir', default='../../pdf_files/jszwfw', type=click.Path(exists=True))
+@click.option('--url',
+              default='http://127.0.0.1:4444/wd/hub',
+              help="URL of the remote server. Defaults to 'http://127.0.0.1:4444/wd/hub'")
+@click.option('--remote_dir',
+              default='/home/seluser/Downloads/jszwfw',
+              help="Remote download directory. Defaults to '/home/seluser/Downloads/jszwfw'")
+@click.option('--start',
+              default=1, type=int,
+              help="The index of departments to start download. Index starts with 1, defaults to 1")
+@click.option('--stop',
+              default=None, type=int,
+              help="The index of departments to stop download. Defaults to the last one index")
+@click.option('--workers',
+              default=1, type=int,
+              help="Number of browser sessions crawling departments in parallel. Defaults to 1")
+@click.option('--direct', is_flag=True,
+              help="Only find the file links with the browser, download the files over HTTP directly")
+@click.option('--recrawl-after',
+              default=24.0, type=float,
+              help="Skip departments completely crawled within this many hours. Defaults to 24")
+@click.option('--fast', is_flag=True,
+              help="Fast crawl profile of the spider, see jszwfw_spider.py")
+@click.option('--jobs', '-j',
+              default=1, type=int,
+              help="Number of worker processes parsing pdf files. Defaults to 1")
+@click.option('--queue-size',
+              default=8, type=int,
+              help="Max number of files downloading or waiting to be parsed. Defaults to 8")
+@click.option('--no-cache', is_flag=True,
+              help="Do not read or write the cache of camelot results")
+@click.option('--cache-dir',
+              default=os.path.expanduser('~/.cache/open_budget/tables'), type=click.Path(),
+              help="Directory of the cache of camelot results. Defaults to '~/.cache/open_budget/tables'")
+@click.option('--backend',
+              default='camelot', type=click.Choice(BACKENDS),
+              help="Table extraction backend, see pdf_parser.py. Defaults to 'camelot'")
+@click.option('--batch-pages',
+              default=None, type=int,
+              help="Stream every pdf file in batches of this many pages, see pdf_parser.py. "
+                   "Defaults to extracting all pages at once")
+@click.option('--output', '-o',
+              multiple=True, default=[], type=click.Choice(['parquet', 'sqlite']),
+              help="Also export the parquet store or the SQLite index next to the departments directory after "
+                   "crawling, can be given more than once. Defaults to the csv files only")
+def run(local_dir, url, remote_dir, start, stop, workers, direct, recrawl_after, fast, jobs, queue_size, no_cache,
+        cache_dir, backend, batch_pages, output):
+    """ 边爬取边解析: 爬虫每下载完一个pdf文件, 马上交给解析进程解析, 并更新这个部门的csv.
+    指定--output时, 所有部门爬取完后, 再导出parquet和SQLite索引.
+    Examples:
+    $python crawl_parse.py ../../pdf_files/jszwfw --start 1 --stop 5
+    $python crawl_parse.py ../../pdf_files/jszwfw --direct --jobs 4 --queue-size 16
+    $python crawl_parse.py ../../pdf_files/jszwfw --direct --backend vector
+    $python crawl_parse.py ../../pdf_files/jszwfw --direct --output parquet --output sqlite
+    $python crawl_parse.py ../../pdf_files/jszwfw --fast --direct --workers 4
+    """
+    if start < 1 or workers < 1 or jobs < 1 or queue_size < 1 or (batch_pages is not None and batch_pages < 1):
+        click.secho('Invalid start, workers, jobs, queue-size or batch-pages. They must be at least 1', err=True,
+                    fg='red')
+        return
+    cache = None if no_cache else TableCache(cache_dir)
+    pipeline = CrawlParsePipeline(jobs, queue_size, cache, backend=backend, batch_pages=batch_pages)
+    try:
+        if workers > 1:
+            errors = run_parallel(local_dir, url, remote_dir, start, stop, workers, direct,
+                                  recrawl_after=recrawl_after * 3600, file_queue=pipeline.file_queue, fast=fast)
+            error_msg = ''.join(f'\nworker{worker}:' + msg for worker, msg in errors.items())
+        else:
+            spider = spider_type(fast)(local_dir, url, remote_dir, direct=direct,
+                                       recrawl_after=recrawl_after * 3600, file_queue=pipeline.file_queue)
+            try:
+                spider.run(start=start, stop=stop)
+            finally:
+                spider.quit()
+            error_msg = spider.error_msg
+    except MaxRetryError:
+        click.secho('selenium远程服务器的url配置出错, 连接不上.', err=True, fg='red')
+        return
+    finally:
+        pipeline.close()
+    depts_dir = os.path.abspath(local_dir)
+    pipeline.export(ParquetStore(depts_dir + '.parquet') if 'parquet' in output else None,
+                    BudgetIndex(depts_dir + '.sqlite') if 'sqlite' in output else None)
+    if error_msg:
+        click.secho(error_msg, fg='red')
+    for error in pipeline.errors:
+        click.secho(error, fg='red')
+
+
+class FileQueue:
+    """ 下载完成的pdf文件队列, 连接爬虫和解析.
+    爬虫开始下载一个文件前reserve一个位置, 解析完成后release. 位置用完时reserve阻塞,
+    所以正在下载、等待解析和正在解析的文件一共不超过maxsize个, 下载不会比解析领先太多.
+    """
+
+    def __init__(self, maxsize=8):
+        self._slots = threading.Semaphore(maxsize)
+        self._queue: 'queue.Queue[Optional[Tuple[str, str]]]' = queue.Queue()
+
+    def reserve(self):
+        self._slots.acquire()
+
+    def cancel(self):
+        """ 下载失败, 释放reserve的位置 """
+        self._slots.release()
+
+    def release(self):
+        """ 文件解析完成(或者不需要解析), 释放位置 """
+        self._slots.release()
+
+    def put(self, dept_name, file_path):
+        self._queue.put((dept_name, file_path))
+
+    def get(self) -> Optional[Tuple[str, str]]:
+        """ 返回(部门名称, 文件路径), 队列关闭后返回None """
+        return self._queue.get()
+
+    def close(self):
+        self._queue.put(None)
+
+
+class CrawlParsePipeline:
+    """ 从FileQueue取出下载完成的文件, 分发到进程池解析, 每个部门一个增量解析的DeptFilesParser.
+    部门的第一个文件到达时, 部门目录里已有但还没解析过的文件(比如上次中断时下载的)也一起解析.
+    每个文件解析完, 合并到部门的结果里, 马上更新部门的csv和解析清单. 并行解析时先解析完的文件等待前面提交的文件,
+    按提交的顺序合并, 合并的结果和解析完成的先后无关.
+    """
+
+    def __init__(self, jobs=1, queue_size=8, cache: TableCache = None, filter_pages=True, backend='camelot',
+                 batch_pages=None):
+        self.file_queue = FileQueue(queue_size)
+        self.cache = cache
+        self.filter_pages = filter_pages
+        self.backend = backend
+        self.batch_pages = batch_pages
+        self.dept_parsers: Dict[str, DeptFilesParser] = dict()
+        self.errors: List[str] = list()
+        # 每个部门已提交还没有合并的文件, 按提交的顺序: [(文件路径, 是否占用了队列的位置, future)]
+        self._submitted: Dict[str, Deque[Tuple[str, bool, Future]]] = dict()
+        self._executor = ProcessPoolExecutor(max_workers=jobs)
+        self._lock = threading.Lock()
+        # daemon: 生产者(爬虫)出错没有调用close时, 不会让进程一直等待这个线程
+        self._consumer = threading.Thread(target=self._consume, name='crawl-parse-consumer', daemon=True)
+        self._consumer.start()
+
+    def close(self):
+        """ 爬取结束后调用, 等待所有文件解析完 """
+        self.file_queue.close()
+        self._consumer.join()
+        self._executor.shutdown(wait=True)
+
+    def export(self, store: ParquetStore = None, index: BudgetIndex = None):
+        """ 导出parquet和SQLite索引 """
+        for parser in self.dept_parsers.values():
+            if not parser.parsed_dfs():
+                continue
+            if store is not None:
+                parser.to_parquet(store)
+            if index is not None:
+                parser.to_index(index)
+
+    def _consume(self):
+        for dept_name, file_path in iter(self.file_queue.get, None):
+            try:
+                with self._lock:
+                    files = self._pending_files(dept_name, file_path)
+            except Exception as e:
+                self.errors.append(f'{file_path} 出错: {e!r}')
+                files = list()
+            reserved = False
+            for path, year in files:
+                is_reserved = os.path.normpath(path) == os.path.normpath(file_path)
+                reserved = reserved or is_reserved
+                self._submit(self.dept_parsers[dept_name], path, year, is_reserved)
+            if not reserved:
+                self.file_queue.release()
+
+    def _pending_files(self, dept_name, file_path) -> List[Tuple[str, int]]:
+        parser = self.dept_parsers.get(dept_name)
+        if parser is None:
+            parser = DeptFilesParser(dept_name, os.path.dirname(file_path), self.cache, self.filter_pages,
+                                     incremental=True, backend=self.backend, batch_pages=self.batch_pages)
+            self.dept_parsers[dept_name] = parser
+            return parser.pending_files()   # 包括file_path
+        year = parser._parse_year(os.path.basename(file_path))
+        if not year:
+            logging.warning(f'{file_path} 文件名解析不到年度信息')
+            return list()
+        return parser.pending_file(file_path, year)     # 重新下载的文件内容变化时, 包括同一年度的其他文件
+
+    def _submit(self, parser: DeptFilesParser, file_path, year, reserved):
+        future = self._executor.submit(parse_dept_file, parser.dept_name, parser.path, file_path, year,
+                                       self.cache, self.filter_pages, backend=self.backend,
+                                       batch_pages=self.batch_pages)
+        with self._lock:
+            self._submitted.setdefault(parser.dept_name, deque()).append((file_path, reserved, future))
+        future.add_done_callback(partial(self._parsed, parser))
+
+    def _parsed(self, parser: DeptFilesParser, _: Future):
+        """ 一个文件解析完: 从部门最早提交的文件开始, 合并已经解析完的文件, 遇到还没解析完的停下 """
+        with self._lock:
+            submitted = self._submitted[parser.dept_name]
+            while submitted and submitted[0][2].done():
+                file_path, reserved, future = submitted.popleft()
+                try:
+                    self._merge(parser, file_path, future)
+                finally:
+                    if reserved:
+                        self.file_queue.release()
+
+    def _merge(self, parser: DeptFilesParser, file_path, future: Future):
+        try:
+            result = future.result()
+            parser.merge(result)
+            for name, report in result.failures.items():
+                self.errors.append(f'{name} {failure_summary(report)}')
+            parser.to_csv()
+            parser.save_manifest()
+        except Exception as e:
+            self.errors.append(f'解析{file_path}出错: {e!r}')
+            parser.manifest.files.pop(os.path.basename(file_path), None)    # 从清单里去掉, 下次重新解析
+
+
+if __name__ == '__main__':
+    run()
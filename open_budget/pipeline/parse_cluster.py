@@ -0,0 +1,177 @@
+import logging
+import os
+import pickle
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from open_budget.parser.pdf_parser import BACKENDS, DeptFilesParser, export_results, list_departments, \
+    parse_dept_file
+from open_budget.parser.table_cache import TableCache
+from open_budget.parser.work_queue import Heartbeat, WorkQueue
+
+
+@click.group()
+def cli():
+    """ 多台机器分布式解析pdf文件. 任务队列是共享存储上的一个SQLite文件, 各节点挂载共享存储后:
+    1. 在任意一个节点上enqueue, 把部门的pdf文件加入队列, 内容没有变化的文件不会重复解析
+    2. 在每个节点上work, 领取任务解析, 结果提交到队列里. 节点崩溃后, 它的任务租约过期, 由其他节点接手
+    3. 所有任务结束后, 在任意一个节点上finalize, 把每个文件的结果合并成部门的csv(--output指定时还有parquet和SQLite索引)
+    Examples:
+    $python parse_cluster.py enqueue /mnt/shared/jszwfw.queue /mnt/shared/jszwfw
+    $python parse_cluster.py work /mnt/shared/jszwfw.queue --jobs 4
+    $python parse_cluster.py status /mnt/shared/jszwfw.queue
+    $python parse_cluster.py finalize /mnt/shared/jszwfw.queue
+    """
+
+
+@cli.command()
+@click.argument('queue_path', type=click.Path())
+@click.argument('path', default='../../pdf_files/jszwfw', type=click.Path(exists=True))
+@click.option('--full', is_flag=True,
+              help="Parse all pdf files again, instead of only the new or changed files")
+def enqueue(queue_path, path, full):
+    """ 把部门的pdf文件加入队列 """
+    queue = WorkQueue(queue_path)
+    _, departments = list_departments(path)
+    count = 0
+    for dept_name, dept_path in departments:
+        count += queue.enqueue(dept_name, dept_path, DeptFilesParser(dept_name, dept_path).list_files(), full)
+    click.echo(f'加入了{count}个任务')
+    _echo_counts(queue)
+
+
+@cli.command()
+@click.argument('queue_path', type=click.Path(exists=True))
+@click.option('--jobs', '-j',
+              default=1, type=int,
+              help="Number of worker processes on this node. Defaults to 1")
+@click.option('--lease',
+              default=600.0, type=float,
+              help="Seconds a claimed job is held without a heartbeat, before other nodes may take it over. "
+                   "Defaults to 600")
+@click.option('--max-attempts',
+              default=3, type=int,
+              help="Max attempts of a job, before it is marked as failed. Defaults to 3")
+@click.option('--poll',
+              default=5.0, type=float,
+              help="Seconds to wait before claiming again, when other nodes still hold all the unfinished jobs. "
+                   "Defaults to 5")
+@click.option('--no-cache', is_flag=True,
+              help="Do not read or write the cache of camelot results")
+@click.option('--cache-dir',
+              default=os.path.expanduser('~/.cache/open_budget/tables'), type=click.Path(),
+              help="Directory of the cache of camelot results on this node. Defaults to '~/.cache/open_budget/tables'")
+@click.option('--all-pages', is_flag=True,
+              help="Parse all pages, instead of the pages whose text matches the table keywords")
+@click.option('--backend',
+              default='camelot', type=click.Choice(BACKENDS),
+              help="Table extraction backend, see pdf_parser.py. Defaults to 'camelot'")
+@click.option('--batch-pages',
+              default=None, type=int,
+              help="Stream every pdf file in batches of this many pages, see pdf_parser.py")
+@click.option('--timeout',
+              default=600, type=int,
+              help="Seconds to wait for extracting the tables of a repaired pdf file, see pdf_parser.py")
+def work(queue_path, jobs, lease, max_attempts, poll, no_cache, cache_dir, all_pages, backend, batch_pages, timeout):
+    """ 领取队列里的任务解析, 直到所有任务都结束 """
+    if jobs < 1 or max_attempts < 1 or lease <= 0 or (batch_pages is not None and batch_pages < 1):
+        click.secho('Invalid jobs, lease, max-attempts or batch-pages. They must be positive', err=True, fg='red')
+        return
+    cache = None if no_cache else TableCache(cache_dir)
+    parse_kwargs = dict(cache=cache, filter_pages=not all_pages, backend=backend, batch_pages=batch_pages,
+                        timeout=timeout)
+    if jobs == 1:
+        committed = work_loop(queue_path, lease, max_attempts, poll, parse_kwargs)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(work_loop, queue_path, lease, max_attempts, poll, parse_kwargs)
+                       for _ in range(jobs)]
+            committed = sum(future.result() for future in futures)
+    click.echo(f'这个节点提交了{committed}个任务')
+    _echo_counts(WorkQueue(queue_path))
+
+
+def work_loop(queue_path, lease, max_attempts, poll, parse_kwargs: dict) -> int:
+    """ 一个worker进程: 领取任务, 解析, 提交结果, 直到队列里所有任务都结束. 返回提交的任务数 """
+    queue = WorkQueue(queue_path, lease, max_attempts)
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    committed = 0
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if queue.is_finished():
+                return committed
+            time.sleep(poll)    # 其他节点正在解析剩下的任务, 它们崩溃的话, 租约过期后接手
+            continue
+        with Heartbeat(queue, job):
+            try:
+                parser = parse_dept_file(job.department, job.path, job.file_path, job.year, **parse_kwargs)
+            except Exception as e:
+                logging.exception(f'{worker}解析{job.file_path}出错, 第{job.attempts}次')
+                queue.fail(job, repr(e))
+                continue
+        parser.cache = None     # 缓存在节点本地, 不放进结果
+        if queue.complete(job, pickle.dumps(parser, protocol=pickle.HIGHEST_PROTOCOL), worker):
+            committed += 1
+        else:
+            logging.warning(f'{job.file_path}的租约已经过期, 被其他节点接手, 丢弃这次的结果')
+
+
+@cli.command()
+@click.argument('queue_path', type=click.Path(exists=True))
+def status(queue_path):
+    """ 显示队列里各种状态的任务数和失败的任务 """
+    _echo_counts(WorkQueue(queue_path))
+
+
+@cli.command()
+@click.argument('queue_path', type=click.Path(exists=True))
+@click.option('--output', '-o',
+              multiple=True, default=['csv'], type=click.Choice(['csv', 'parquet', 'sqlite']),
+              help="Output formats, can be given more than once, e.g. -o csv -o parquet -o sqlite. Defaults to csv")
+@click.option('--store',
+              default=None, type=click.Path(),
+              help="Directory of the parquet store. Defaults to the departments directory with suffix '.parquet'")
+@click.option('--index',
+              default=None, type=click.Path(),
+              help="SQLite index of line items. Defaults to the departments directory with suffix '.sqlite'")
+@click.option('--metrics',
+              default=None, type=click.Path(),
+              help="Write the timers and counters of every stage, per file and per department, to a json file")
+@click.option('--failures',
+              default=None, type=click.Path(),
+              help="Write the failure reports of the quarantined files, per department, to a json file")
+@click.option('--partial', is_flag=True,
+              help="Merge the finished jobs, even if some jobs are still pending or running")
+def finalize(queue_path, output, store, index, metrics, failures, partial):
+    """ 把已经完成的任务的结果, 按加入队列的顺序合并成每个部门的结果并导出 """
+    queue = WorkQueue(queue_path)
+    if not queue.is_finished() and not partial:
+        click.secho('还有任务没有结束, 等待所有节点解析完, 或者用--partial只合并已经完成的任务', err=True, fg='red')
+        _echo_counts(queue)
+        return
+    dept_parsers = list()
+    for dept_name, dept_path in queue.departments():
+        parser = DeptFilesParser(dept_name, dept_path)
+        for result in queue.results(dept_path):
+            parser.merge(pickle.loads(result))
+        dept_parsers.append(parser)
+    if not dept_parsers:
+        click.echo('队列里没有任务')
+        return
+    export_results(dept_parsers, os.path.dirname(dept_parsers[0].path), output, store, index, metrics, failures)
+    _echo_counts(queue)
+
+
+def _echo_counts(queue: WorkQueue):
+    counts = queue.counts()
+    click.echo(', '.join(f'{state} {count}' for state, count in counts.items()))
+    for dept_name, file_name, attempts, error in queue.failed():
+        click.secho(f'{dept_name}/{file_name} 尝试{attempts}次后失败: {error}', fg='yellow')
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from open_budget.parser.table_cache import file_sha256
+
+
+class CrawlManifest:
+    """ 部门目录下已经爬取的文件清单, 用于断点续爬.
+    每个文件记录来源页面、附件标题、大小、sha256, 以及服务器返回的ETag/Last-Modified.
+    部门的所有文件都下载完成后记录completed_at, 在recrawl_after秒内再次爬取时跳过这个部门, 不打开它的页面.
+    下载是异步的: 每登记一个文件expect一次, 下载完成record, 失败fail; 列完所有文件listed后,
+    没有未完成和失败的文件时部门才算完成.
+    """
+    file_name = '.crawl.json'
+
+    def __init__(self, dept_dir):
+        self.dept_dir = dept_dir
+        self.file_path = os.path.join(dept_dir, self.file_name)
+        self.completed_at: Optional[float] = None
+        self.files: Dict[str, dict] = dict()
+        if os.path.exists(self.file_path):
+            with open(self.file_path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.completed_at = data.get('completed_at')
+            self.files = data.get('files', dict())
+        self._lock = threading.RLock()
+        self._outstanding = 0
+        self._failed = False
+        self._listed = False
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.dept_dir, exist_ok=True)
+            data = {'completed_at': self.completed_at, 'files': self.files}
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.file_path)
+
+    def is_complete(self, recrawl_after: float) -> bool:
+        """ 部门在recrawl_after秒内爬取完成过 """
+        return self.completed_at is not None and time.time() - self.completed_at < recrawl_after
+
+    def is_downloaded(self, filename) -> bool:
+        """ 文件已经记录在清单里, 并且本地文件的大小和记录的一致 """
+        entry = self.files.get(filename)
+        path = os.path.join(self.dept_dir, filename)
+        return entry is not None and os.path.exists(path) and os.path.getsize(path) == entry['size']
+
+    def validators(self, filename) -> Dict[str, Optional[str]]:
+        """ 条件请求用的ETag/Last-Modified. 本地文件不完整时返回空值, 重新下载 """
+        if not self.is_downloaded(filename):
+            return {'etag': None, 'last_modified': None}
+        entry = self.files[filename]
+        return {'etag': entry.get('etag'), 'last_modified': entry.get('last_modified')}
+
+    def begin(self):
+        """ 开始爬取部门页面 """
+        with self._lock:
+            self.completed_at = None
+            self._outstanding = 0
+            self._failed = False
+            self._listed = False
+            self.save()
+
+    def expect(self):
+        with self._lock:
+            self._outstanding += 1
+
+    def record(self, filename, page, title, etag=None, last_modified=None):
+        """ 文件下载完成(或者服务器返回未修改) """
+        path = os.path.join(self.dept_dir, filename)
+        entry = {'page': page, 'title': title, 'size': os.path.getsize(path), 'sha256': file_sha256(path),
+                 'etag': etag, 'last_modified': last_modified}
+        with self._lock:
+            self.files[filename] = entry
+            self._outstanding -= 1
+            self._finish()
+
+    def fail(self):
+        with self._lock:
+            self._outstanding -= 1
+            self._failed = True
+            self.save()
+
+    def listed(self):
+        """ 部门页面的所有文件都已经登记 """
+        with self._lock:
+            self._listed = True
+            self._finish()
+
+    def _finish(self):
+        if self._listed and self._outstanding == 0 and not self._failed:
+            self.completed_at = time.time()
+        self.save()
@@ -0,0 +1,176 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:     # 没有安装watchdog时, 退化为定时检查
+    FileSystemEventHandler = object
+    Observer = None
+
+PARTIAL_SUFFIX = '.crdownload'     # chrome下载中的文件后缀
+
+
+class _Download:
+    def __init__(self, filename, dest_dir, deadline, on_done=None, on_failed=None):
+        self.filename = filename
+        self.dest_dir = dest_dir
+        self.deadline = deadline
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.size = None        # 上次检查时的文件大小
+        self.checked_at = None  # 上次检查的时间
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: 'DownloadWatcher'):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        self.watcher.notify()
+
+
+class DownloadWatcher:
+    """ 监听浏览器下载目录, 判断下载完成后把文件移动到部门目录.
+    点击下载后调用expect登记文件, 不用等待下载完成, 可以继续点击下一个文件. 后台线程在收到文件事件(inotify)时检查,
+    文件存在、.crdownload文件已经消失并且大小在stable_seconds内没有变化, 才认为下载完成.
+    没有安装watchdog时, 每隔poll_interval秒检查一次.
+    on_done, on_failed回调在后台线程里调用, 调用时不持有锁, 回调里可以调用expect, 不会挡住其他线程登记文件.
+    """
+
+    def __init__(self, watch_dir, stable_seconds=0.5, timeout=300, poll_interval=1.0,
+                 on_done: Callable[[str, str], None] = None, on_failed: Callable[[str], None] = None):
+        self.watch_dir = watch_dir
+        self.stable_seconds = stable_seconds
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.done: List[str] = list()       # 移动后的文件路径
+        self.failed: List[str] = list()     # 下载失败或超时的文件名
+        self._pending: Dict[str, _Download] = dict()
+        self._callbacks: List[Tuple[Callable, tuple]] = list()     # 已经处理完, 还没有调用的回调
+        self._calling = False       # 后台线程正在调用回调
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._observer = None
+        self._thread = threading.Thread(target=self._loop, name='download-watcher', daemon=True)
+
+    def start(self):
+        if not os.path.isdir(self.watch_dir):
+            raise FileNotFoundError(f'下载目录{self.watch_dir}不存在')
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.watch_dir, recursive=False)
+            self._observer.start()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def expect(self, filename, dest_dir, on_done: Callable[[str, str], None] = None,
+               on_failed: Callable[[str], None] = None):
+        """ 登记一个已经点击下载的文件. 同名文件还没处理完时先等待, 避免两个下载写同一个文件.
+        on_done, on_failed是这个文件的回调, 在构造函数的回调之后调用 """
+        with self._cond:
+            while filename in self._pending and not self._stopped:
+                self._cond.wait()
+            self._pending[filename] = _Download(filename, dest_dir, time.monotonic() + self.timeout, on_done, on_failed)
+            self._cond.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ 等待所有登记的文件处理完(移动或者超时), 并且回调都已经返回. 返回是否全部处理完 """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._callbacks or self._calling:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                wait = self._check()
+                callbacks, self._callbacks = self._callbacks, list()
+                if not callbacks:
+                    self._cond.wait(wait)
+                    continue
+                self._calling = True
+            try:
+                for callback, args in callbacks:    # 释放锁之后再调用
+                    try:
+                        callback(*args)
+                    except Exception:
+                        logging.exception(f'下载回调出错: {args}')
+            finally:
+                with self._cond:
+                    self._calling = False
+                    self._cond.notify_all()
+
+    def _check(self) -> Optional[float]:
+        """ 检查所有登记的文件, 返回下次需要主动检查的间隔; 只需要等待文件事件时返回None """
+        now = time.monotonic()
+        wait = None
+        for filename, download in list(self._pending.items()):
+            path = os.path.join(self.watch_dir, filename)
+            if os.path.exists(path) and not os.path.exists(path + PARTIAL_SUFFIX):
+                size = os.path.getsize(path)
+                if download.size == size and now - download.checked_at >= self.stable_seconds:
+                    self._finish(download, path)
+                    continue
+                if download.size != size:
+                    download.size, download.checked_at = size, now
+                wait = self._min(wait, download.checked_at + self.stable_seconds - now)
+            elif now >= download.deadline:
+                self._fail(download)
+                continue
+            else:
+                wait = self._min(wait, download.deadline - now)
+        if self._observer is None and self._pending:
+            wait = self._min(wait, self.poll_interval)
+        return None if wait is None else max(wait, 0.01)
+
+    def _finish(self, download: _Download, path):
+        dest = os.path.join(download.dest_dir, download.filename)
+        try:
+            os.makedirs(download.dest_dir, exist_ok=True)
+            os.replace(path, dest)
+        except OSError:
+            self._fail(download)
+            return
+        del self._pending[download.filename]
+        self.done.append(dest)
+        self._cond.notify_all()
+        self._callbacks.extend((on_done, (download.filename, dest))
+                               for on_done in (self.on_done, download.on_done) if on_done is not None)
+
+    def _fail(self, download: _Download):
+        del self._pending[download.filename]
+        self.failed.append(download.filename)
+        self._cond.notify_all()
+        self._callbacks.extend((on_failed, (download.filename,))
+                               for on_failed in (self.on_failed, download.on_failed) if on_failed is not None)
+
+    @staticmethod
+    def _min(a, b):
+        return b if a is None else min(a, b)
@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class IncompleteDownload(Exception):
+    """ 收到的字节数比Content-Length少 """
+
+
+class DownloadResult(NamedTuple):
+    path: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    modified: bool      # False: 服务器返回304, 本地文件没有变化
+
+
+class HttpDownloader:
+    """ 不经过浏览器, 直接用HTTP下载文件.
+    - 一个requests.Session, 连接池大小和并发数一样, 连接保持keep-alive复用.
+    - 线程池并发下载, 边下载边写入dest + '.part', 下载完成后重命名为dest.
+    - 连接出错、5xx或者内容不完整时重试, 间隔backoff * 2^n秒; 重试时用Range请求从.part文件的大小继续下载.
+      .part文件对应的ETag/Last-Modified记录在dest + '.part.validator', 续传时作为If-Range发送,
+      服务器上的文件变化了(返回200, 或者206的验证器对不上)时从头下载. 没有验证器时不续传.
+    - 给了上次下载的ETag/Last-Modified时发送条件请求, 服务器返回304时不下载.
+    """
+
+    def __init__(self, max_workers=4, retries=3, backoff=0.5, timeout=30, chunk_size=64 * 1024,
+                 on_done: Callable[[str, str], None] = None, on_failed: Callable[[str], None] = None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.done: List[str] = list()                   # 下载完成的文件路径
+        self.failed: List[Tuple[str, str]] = list()     # (url, 出错信息)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='http-downloader')
+        self._futures: List[Future] = list()
+        self._lock = threading.Lock()
+
+    def submit(self, url, dest, etag=None, last_modified=None) -> Future:
+        """ 提交一个下载任务, 马上返回. Future的结果是DownloadResult """
+        future = self._executor.submit(self._download_task, url, dest, etag, last_modified)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def wait(self):
+        """ 等待已提交的下载任务完成 """
+        while True:
+            with self._lock:
+                futures, self._futures = self._futures, list()
+            if not futures:
+                return
+            for future in futures:
+                future.exception()
+
+    def close(self):
+        self.wait()
+        self._executor.shutdown()
+        self.session.close()
+
+    def download(self, url, dest, etag=None, last_modified=None) -> DownloadResult:
+        """ 下载url到dest, 失败时重试 """
+        for attempt in range(self.retries + 1):
+            try:
+                return self._fetch(url, dest, etag, last_modified)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500 or attempt == self.retries:
+                    raise
+            except (requests.RequestException, IncompleteDownload):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _fetch(self, url, dest, etag=None, last_modified=None) -> DownloadResult:
+        part = dest + '.part'
+        validator_path = part + '.validator'
+        validator = _read_validator(validator_path)
+        offset = os.path.getsize(part) if os.path.exists(part) and validator else 0
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if offset else {}
+        if not offset and os.path.exists(dest):
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                return DownloadResult(dest, etag, last_modified, False)
+            if response.status_code == 416:     # .part文件和服务器上的文件对不上, 从头下载
+                _remove(part, validator_path)
+                raise IncompleteDownload(url)
+            response.raise_for_status()
+            validators = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            if response.status_code == 206 and _if_range(*validators) != validator:
+                # 服务器没有按If-Range检查, 文件已经变化, 不能接在原来的内容后面
+                _remove(part, validator_path)
+                raise IncompleteDownload(url)
+            if response.status_code != 206:     # 服务器不支持Range, 或者文件变化了, 返回了整个文件
+                offset = 0
+                _write_validator(validator_path, _if_range(*validators))
+            length = response.headers.get('Content-Length')
+            expected = offset + int(length) if length is not None else None
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(self.chunk_size):
+                    f.write(chunk)
+        if expected is not None and os.path.getsize(part) < expected:
+            raise IncompleteDownload(url)
+        os.replace(part, dest)
+        _remove(validator_path)
+        return DownloadResult(dest, *validators, True)
+
+    def _download_task(self, url, dest, etag=None, last_modified=None) -> DownloadResult:
+        try:
+            result = self.download(url, dest, etag, last_modified)
+        except Exception as e:
+            with self._lock:
+                self.failed.append((url, repr(e)))
+            if self.on_failed is not None:
+                self.on_failed(os.path.basename(dest))
+            raise
+        with self._lock:
+            self.done.append(dest)
+        if self.on_done is not None:
+            self.on_done(os.path.basename(dest), dest)
+        return result
+
+
+def _if_range(etag, last_modified) -> Optional[str]:
+    """ If-Range用的验证器: 强ETag优先, 弱ETag(W/)不能用于If-Range, 没有时用Last-Modified """
+    if etag and not etag.startswith('W/'):
+        return etag
+    return last_modified
+
+
+def _read_validator(path) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip() or None
+
+
+def _write_validator(path, validator: Optional[str]):
+    if validator is None:
+        _remove(path)
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(validator)
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
@@ -5,13 +5,18 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from tqdm import tqdm
 from urllib3.exceptions import MaxRetryError
+import logging
 import os
-import time
-import sys
-from typing import List
+import queue
+from functools import partial
+import threading
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type
+from open_budget.spider.download_watcher import DownloadWatcher
+from open_budget.spider.http_downloader import HttpDownloader, DownloadResult
+from open_budget.spider.crawl_manifest import CrawlManifest
 
 
 @click.command()
@@ -29,48 +34,189 @@ from typing import List
 @click.option('--stop',
               default=None, type=int,
               help="The index of departments to stop download. Defaults to the last one index")
-def run(local_dir, url, remote_dir, start, stop):
+@click.option('--workers',
+              default=1, type=int,
+              help="Number of browser sessions crawling departments in parallel. Defaults to 1")
+@click.option('--direct', is_flag=True,
+              help="Only find the file links with the browser, download the files over HTTP directly")
+@click.option('--downloads',
+              default=4, type=int,
+              help="Number of concurrent HTTP downloads per session with --direct. Defaults to 4")
+@click.option('--recrawl-after',
+              default=24.0, type=float,
+              help="Skip departments completely crawled within this many hours. Defaults to 24")
+@click.option('--fast', is_flag=True,
+              help="Fast crawl profile: headless Chrome without images, stylesheets and fonts, reading the links of "
+                   "a page with one script and opening pages by URL instead of clicking and switching windows")
+def run(local_dir, url, remote_dir, start, stop, workers, direct, downloads, recrawl_after, fast):
     """ 爬取江苏省预决算公开统一平台，下载部门预算公开PDF文件. 网址是http://www.jszwfw.gov.cn/yjsgk/list.do
     Examples:
     $python jszwfw_spider.py --start 1 --stop 5
     $python jszwfw_spider.py ../../pdf_files/jszwfw --start 1 --stop 5
+    $python jszwfw_spider.py ../../pdf_files/jszwfw --workers 4
+    $python jszwfw_spider.py ../../pdf_files/jszwfw --direct --downloads 8
+    $python jszwfw_spider.py ../../pdf_files/jszwfw --recrawl-after 0
+    $python jszwfw_spider.py ../../pdf_files/jszwfw --fast --direct --workers 4
 """
     if start < 1:
         click.secho('Invalid start. Index starts with 1', err=True, fg='red')
         return
+    if workers < 1 or downloads < 1:
+        click.secho('Invalid workers or downloads. They must be at least 1', err=True, fg='red')
+        return
+    if workers > 1:
+        try:
+            errors = run_parallel(local_dir, url, remote_dir, start, stop, workers, direct, downloads,
+                                  recrawl_after * 3600, fast=fast)
+        except MaxRetryError:
+            click.secho('selenium远程服务器的url配置出错, 连接不上.', err=True, fg='red')
+            return
+        for worker, error_msg in errors.items():
+            click.secho(f'worker{worker}:' + error_msg, fg='red')
+        return
     try:
-        spider = JszwfwSpider(local_dir, url, remote_dir)
+        spider = spider_type(fast)(local_dir, url, remote_dir, direct=direct, max_downloads=downloads,
+                                   recrawl_after=recrawl_after * 3600)
     except MaxRetryError:
         click.secho('selenium远程服务器的url配置出错, 连接不上.', err=True, fg='red')
         return
-    spider.run(start=start, stop=stop)
-    spider.quit()
+    try:
+        spider.run(start=start, stop=stop)
+    finally:
+        spider.quit()
     if spider.error_msg:
         click.secho(spider.error_msg, fg='red')
 
 
+def run_parallel(local_dir, url, remote_dir, start=1, stop=None, workers=2, direct=False,
+                 max_downloads=4, recrawl_after=24 * 3600, file_queue=None, fast=False) -> Dict[int, str]:
+    """ 开workers个浏览器会话并行爬取. 部门序号放在一个队列里, 每个会话爬完一个部门再从队列取下一个.
+    每个会话有自己的下载目录(remote_dir/.workerN, 对应local_dir/.workerN), 同名文件不会冲突.
+    fast为True时用快速模式(FastJszwfwSpider).
+    返回每个worker的出错信息 {worker: error_msg}, 没有出错的worker不包含在内 """
+    spiders: List[JszwfwSpider] = list()
+    try:
+        for worker in range(1, workers + 1):
+            spiders.append(spider_type(fast)(local_dir, url, f'{remote_dir}/.worker{worker}',
+                                             download_dir=os.path.join(local_dir, f'.worker{worker}'),
+                                             direct=direct, max_downloads=max_downloads, recrawl_after=recrawl_after,
+                                             file_queue=file_queue))
+        total = spiders[0].open_dept_list()
+        last = stop if stop and stop < total else total
+        indices = queue.Queue()
+        for i in range(start, last + 1):
+            indices.put(i)
+
+        def work(spider: JszwfwSpider):
+            taken: List[int] = list()
+
+            def take():
+                while True:
+                    try:
+                        taken.append(indices.get_nowait())
+                    except queue.Empty:
+                        return
+                    yield taken[-1]
+
+            try:
+                if spider.dept_page_handle is None:
+                    spider.open_dept_list()
+                spider.crawl(take(), p_bar)
+            except Exception as e:     # 一个会话出错不影响其他会话, 剩下的部门由其他会话爬取
+                where = f'爬取第{taken[-1]}部门' if taken else '打开部门列表'
+                spider.add_error(f'{where}时会话出错, 停止爬取: {e!r}')
+
+        with tqdm(total=max(last - start + 1, 0)) as p_bar:
+            threads = [threading.Thread(target=work, args=(spider,)) for spider in spiders]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        for spider in spiders:
+            spider.quit()
+    return {worker: spider.error_msg for worker, spider in enumerate(spiders, start=1) if spider.error_msg}
+
+
+def spider_type(fast=False) -> Type['JszwfwSpider']:
+    return FastJszwfwSpider if fast else JszwfwSpider
+
+
 class JszwfwSpider:
     """ jszwfw 取名自域名www.jszwfw.gov.cn """
-    def __init__(self, local_dir, url='http://127.0.0.1:4444/wd/hub', remote_dir='/home/seluser/Downloads/jszwfw'):
+    home_url = 'http://www.jszwfw.gov.cn/yjsgk/list.do'     # 平台首页, 从这里找到部门预算公开的部门列表
+
+    def __init__(self, local_dir, url='http://127.0.0.1:4444/wd/hub', remote_dir='/home/seluser/Downloads/jszwfw',
+                 download_dir=None, direct=False, max_downloads=4, recrawl_after=24 * 3600, file_queue=None):
+        """ download_dir是remote_dir对应的本地目录, 默认是local_dir.
+        direct为True时, 浏览器只用来找到文件链接, 文件用HttpDownloader直接下载; 找不到链接的文件仍然点击下载.
+        recrawl_after秒内爬取完成的部门(见CrawlManifest)直接跳过.
+        file_queue是下载完成的文件队列(见open_budget.pipeline.crawl_parse.FileQueue), 下载前reserve一个位置,
+        下载完成后put, 失败时cancel """
         self.local_dir = local_dir
+        self.recrawl_after = recrawl_after
+        self.file_queue = file_queue
+        self.download_dir = download_dir or local_dir
+        self.error_msg = ''
+        self._error_lock = threading.Lock()     # 下载完成的回调在DownloadWatcher和HttpDownloader的线程里记录出错
+        self.dept_page_handle = None
+        os.makedirs(self.download_dir, exist_ok=True)
+        # 下载完成的文件由后台线程移动到部门目录, 点击下载后不用等待
+        self.watcher = DownloadWatcher(self.download_dir, on_done=self._on_downloaded, on_failed=self._on_failed).start()
+        self.downloader = HttpDownloader(max_downloads, on_done=self._on_downloaded, on_failed=self._on_failed) \
+            if direct else None
+        try:
+            self.driver = webdriver.Remote(
+                command_executor=url,
+                desired_capabilities=self.capabilities(remote_dir)
+            )
+        except Exception:
+            self.watcher.stop()
+            if self.downloader is not None:
+                self.downloader.close()
+            raise
+
+    @classmethod
+    def capabilities(cls, remote_dir) -> dict:
+        """ 浏览器会话的参数 """
         options = webdriver.ChromeOptions()
         options.add_experimental_option('prefs', {
             'download.default_directory': remote_dir,
             'download.prompt_for_download': False,
             'download.directory_upgrade': True
         })
-        self.driver = webdriver.Remote(
-            command_executor=url,
-            desired_capabilities=options.to_capabilities()
-        )
-        self.error_msg = ''
+        return options.to_capabilities()
+
+    def add_error(self, msg):
+        """ 记录一条出错信息, 可以在多个线程里调用 """
+        with self._error_lock:
+            self.error_msg += '\n' + msg
 
     def quit(self):
+        self.watcher.wait()
+        self.watcher.stop()
+        if self.downloader is not None:
+            self.downloader.close()
         self.driver.quit()
+        if self.download_dir != self.local_dir:
+            try:
+                os.rmdir(self.download_dir)
+            except OSError:     # 还有没移动走的文件
+                pass
 
     def run(self, start=1, stop=None):
+        total = self.open_dept_list()
+        last = stop if stop and stop < total else total
+        with tqdm(total=last - start + 1) as p_bar:
+            self.crawl(range(start, last + 1), p_bar)
+        self.watcher.wait()
+        if self.downloader is not None:
+            self.downloader.wait()
+
+    def open_dept_list(self) -> int:
+        """ 打开部门预算公开的部门列表页, 返回部门数量 """
         title = '江苏省预决算公开统一平台首页'
-        self.driver.get('http://www.jszwfw.gov.cn/yjsgk/list.do')
+        self.driver.get(self.home_url)
         WebDriverWait(self.driver, 5).until(EC.title_is(title))
         # print('window=', self.driver.current_window_handle, 'title=', title)
 
@@ -82,41 +228,46 @@ class JszwfwSpider:
         WebDriverWait(self.driver, 15).until(
             EC.text_to_be_present_in_element((By.ID, 'mainTitle'), '部门预算公开'))
         # print('window=', self.driver.current_window_handle, 'title=', '部门预算公开')
-        dept_page_handle = self.driver.current_window_handle
+        self.dept_page_handle = self.driver.current_window_handle
         dept_pages: List[WebElement] = self.driver.find_elements_by_xpath('//*[@id="department"]/li')
+        return len(dept_pages)
 
-        i = start
-        last = stop if stop and stop < len(dept_pages) else len(dept_pages)
-        with tqdm(total=last - start + 1) as p_bar:
-            while i <= last:
-                dept_li = self.driver.find_element_by_xpath(f'//*[@id="department"]/li[{i}]')
-                dept_a = dept_li.find_element_by_xpath('a')
-                dept_name = dept_li.text
-                click.echo(f'\n第{i}部门: ' + dept_name)
-                if dept_a.size.get('width') <= dept_li.size.get('width'):
-                    dept_a.click()
-                else:
-                    # 由于页面元素dept_a宽度会大于dept_li，而selenium点击的坐标是元素的中间，所以这种情况下点击dept_li
-                    dept_li.click()
-                self._get_dept_page(dept_name)
+    def crawl(self, indices: Iterable[int], p_bar: tqdm):
+        """ 在部门列表页依次爬取indices里的部门(序号从1开始) """
+        for i in indices:
+            dept_li = self.driver.find_element_by_xpath(f'//*[@id="department"]/li[{i}]')
+            dept_a = dept_li.find_element_by_xpath('a')
+            dept_name = dept_li.text
+            manifest = CrawlManifest(os.path.join(self.local_dir, dept_name))
+            if manifest.is_complete(self.recrawl_after):
+                click.echo(f'\n第{i}部门: ' + dept_name + ' 已爬取, 跳过')
                 p_bar.update(1)
-                self.driver.back()
-                self.driver.switch_to.window(dept_page_handle)
-                i += 1
+                continue
+            click.echo(f'\n第{i}部门: ' + dept_name)
+            if dept_a.size.get('width') <= dept_li.size.get('width'):
+                dept_a.click()
+            else:
+                # 由于页面元素dept_a宽度会大于dept_li，而selenium点击的坐标是元素的中间，所以这种情况下点击dept_li
+                dept_li.click()
+            self._get_dept_page(dept_name, manifest)
+            p_bar.update(1)
+            self.driver.back()
+            self.driver.switch_to.window(self.dept_page_handle)
 
     def _switch_to_new_window(self):
         """  跳到新页面  """
         if self.driver.current_window_handle != self.driver.window_handles[-1]:
             self.driver.switch_to.window(self.driver.window_handles[-1])
 
-    def _get_dept_page(self, dept_name: str):
+    def _get_dept_page(self, dept_name: str, manifest: CrawlManifest):
         main_title = '·部门预算公开'
         try:
             WebDriverWait(self.driver, 15).until(
                 EC.text_to_be_present_in_element((By.ID, 'mainTitle'), main_title))
         except TimeoutException:
-            self.error_msg += '\n' + dept_name + '·部门预算公开, 解析页面出错. 可能是链接失效.'
+            self.add_error(dept_name + '·部门预算公开, 解析页面出错. 可能是链接失效.')
             return
+        manifest.begin()
         page_handle = self.driver.current_window_handle
         # print('window=', self.driver.current_window_handle, 'title=', dept_name + main_title)
         pdf_pages = self.driver.find_elements_by_xpath('//*[@id="contentTitle"]/li')
@@ -124,9 +275,10 @@ class JszwfwSpider:
             file_a = file_page.find_element_by_xpath('a')
             # pdf_page_name = file_a.text
             file_a.click()
-            self._download_pdf_page(dept_name)
+            self._download_pdf_page(dept_name, manifest)
             self.driver.close()
             self.driver.switch_to.window(page_handle)
+        manifest.listed()
 
     @staticmethod
     def _get_filename(file_title: str):
@@ -135,40 +287,269 @@ class JszwfwSpider:
             return file_title[file_title.index('：') + 1:]
         return file_title
 
-    def _download_pdf_page(self, dept_name):
+    def _download_pdf_page(self, dept_name, manifest: CrawlManifest):
         self._switch_to_new_window()
         WebDriverWait(self.driver, 5).until(
             EC.presence_of_element_located((By.ID, 'filespreview')))
         head_text = self.driver.find_element_by_xpath('//*[@id="headText"]').text
         # print('pdf page window=', self.driver.current_window_handle, 'title=', head_text)
 
-        dept_dir = f'{self.local_dir}/{dept_name}'
-        if not os.path.exists(dept_dir):
-            os.mkdir(dept_dir)
-
         files_preview = self.driver.find_elements_by_xpath('//*[@id="filespreview"]/li')
+        if self.downloader is not None:
+            self._copy_cookies()
+        page_url = self.driver.current_url
         for file_preview in files_preview:
-            file_title = file_preview.find_element_by_xpath('a').text
-            filename = self._get_filename(file_title)
-            file_preview.find_element_by_xpath('div[@id="download"]').click()
+            file_a = file_preview.find_element_by_xpath('a')
+            file_url = self._get_file_url(file_a) if self.downloader is not None else None
+            self._download_file(dept_name, manifest, page_url, file_a.text, file_url,
+                                file_preview.find_element_by_xpath('div[@id="download"]').click)
+
+    def _copy_cookies(self):
+        """ 带上浏览器的cookie, 和点击下载时的请求一致 """
+        for cookie in self.driver.get_cookies():
+            self.downloader.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain'))
+
+    def _download_file(self, dept_name, manifest: CrawlManifest, page_url, file_title, file_url: Optional[str],
+                       click_download: Callable[[], None]):
+        """ 下载附件: 有文件链接时用HttpDownloader直接下载, 否则点击下载按钮, 由DownloadWatcher等待下载完成 """
+        dept_dir = f'{self.local_dir}/{dept_name}'
+        os.makedirs(dept_dir, exist_ok=True)
+        filename = self._get_filename(file_title)
+        validators = manifest.validators(filename)
+        if manifest.is_downloaded(filename) and not (file_url and any(validators.values())):
+            # 已经下载过, 没有条件请求可用时不再下载
+            click.echo(' ' * 6 + filename + ' 已下载')
+            return
+        if self.file_queue is not None:
+            self.file_queue.reserve()   # 解析跟不上时在这里等待
+        manifest.expect()
+        done = partial(self._on_file_done, manifest, dept_name, page_url, file_title)
+        failed = partial(self._on_file_failed, manifest)
+        if file_url:
+            future = self.downloader.submit(file_url, os.path.join(dept_dir, filename), **validators)
+            future.add_done_callback(partial(self._record_download, done, failed))
+        else:
+            click_download()
+            self.watcher.expect(filename, dept_dir, on_done=lambda name, file_path: done(file_path),
+                                on_failed=lambda name: failed())
+
+    def _on_file_done(self, manifest: CrawlManifest, dept_name, page_url, file_title, file_path,
+                      etag=None, last_modified=None):
+        """ 文件下载完成后更新清单, 放入文件队列 """
+        manifest.record(os.path.basename(file_path), page_url, file_title, etag, last_modified)
+        if self.file_queue is not None:
+            self.file_queue.put(dept_name, file_path)
+
+    def _on_file_failed(self, manifest: CrawlManifest):
+        manifest.fail()
+        if self.file_queue is not None:
+            self.file_queue.cancel()
+
+    @staticmethod
+    def _record_download(done, failed, future):
+        """ HttpDownloader下载完成后的回调 """
+        if future.exception() is not None:
+            failed()
+            return
+        result: DownloadResult = future.result()
+        done(result.path, result.etag, result.last_modified)
 
-            is_downloaded = self._rename_file(filename, dept_dir)
-            if is_downloaded:
-                click.echo(' ' * 6 + filename)
+    @staticmethod
+    def _get_file_url(file_a: WebElement):
+        """ 附件链接的绝对地址, 不是http链接(比如javascript:)时返回None """
+        return _http_url(file_a.get_attribute('href'))
+
+    @staticmethod
+    def _on_downloaded(filename, file_path):
+        click.echo(' ' * 6 + filename)
+
+    def _on_failed(self, filename):
+        click.secho(' ' * 6 + f'下载{filename}失败或超时', fg='red')
+        self.add_error(f'下载{filename}失败或超时')
+
+
+class Link(NamedTuple):
+    text: str
+    href: str     # 浏览器解析后的绝对地址
+
+
+def _http_url(href) -> Optional[str]:
+    """ http链接返回原样, 其他链接(比如javascript:)返回None """
+    href = href or ''
+    return href if href.startswith(('http://', 'https://')) else None
+
+
+# 一次读取页面上的所有链接. arguments: 选择器, 标题元素的id, 标题要包含的文字.
+# 标题元素还没有出现(页面还在加载)时返回null, 否则返回[{text, href}], 选中的元素不是<a>时取它里面的第一个<a>
+LINKS_SCRIPT = """
+if (arguments[1]) {
+    var title = document.getElementById(arguments[1]);
+    if (!title || title.textContent.indexOf(arguments[2]) < 0) return null;
+}
+return Array.prototype.map.call(document.querySelectorAll(arguments[0]), function (el) {
+    var a = el.tagName === 'A' ? el : el.querySelector('a');
+    return {text: (el.innerText || el.textContent || '').trim(), href: a ? a.href : ''};
+});
+"""
+
+# 快速模式不加载的资源: 图片, 样式, 字体
+BLOCKED_URLS = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.bmp', '*.ico', '*.svg', '*.webp', '*.css', '*.woff', '*.woff2',
+                '*.ttf', '*.otf', '*.eot']
+
+
+class FastJszwfwSpider(JszwfwSpider):
+    """ 快速模式. 默认模式每个附件页都要点击链接, 等待新窗口, 切换窗口, 关闭, 再切换回来, 每个部门还要后退一次,
+    每一步都是一次WebDriver请求, 每个页面还要加载图片, 样式和字体. 快速模式:
+    - headless Chrome, 不加载图片(浏览器设置)和样式, 字体(CDP拦截), 页面的DOM加载完就返回(pageLoadStrategy=eager)
+    - 每个页面用一次execute_script读取所有的部门链接或者附件链接, 不再逐个元素用XPath查找
+    - 按链接地址在同一个窗口里打开部门页和附件页, 不点击, 不切换窗口, 不后退
+    - 页面加载超时时重新打开, 最多重试retries次
+    链接不是http地址(比如javascript:)的部门或者附件页爬取不了, 记录在error_msg里, 需要用默认模式爬取.
+    """
+    retries = 2
+    poll_frequency = 0.2    # 等待页面加载时, 检查的间隔秒数
+
+    def __init__(self, local_dir, url='http://127.0.0.1:4444/wd/hub', remote_dir='/home/seluser/Downloads/jszwfw',
+                 *args, **kwargs):
+        self.dept_links: List[Link] = list()
+        super().__init__(local_dir, url, remote_dir, *args, **kwargs)
+        self._block_resources(remote_dir)
+
+    @classmethod
+    def capabilities(cls, remote_dir) -> dict:
+        options = webdriver.ChromeOptions()
+        options.add_experimental_option('prefs', {
+            'download.default_directory': remote_dir,
+            'download.prompt_for_download': False,
+            'download.directory_upgrade': True,
+            'profile.managed_default_content_settings.images': 2,     # 不加载图片
+        })
+        for argument in ('--headless=new', '--disable-gpu', '--no-sandbox', '--window-size=1280,1024',
+                         '--blink-settings=imagesEnabled=false', '--disable-extensions'):
+            options.add_argument(argument)
+        capabilities = options.to_capabilities()
+        capabilities['pageLoadStrategy'] = 'eager'
+        return capabilities
+
+    def _block_resources(self, remote_dir):
+        """ 用Chrome DevTools协议拦截样式和字体, 允许headless时下载文件.
+        selenium server把goog/cdp/execute转发给chromedriver, 不支持时只是不拦截 """
+        execute_cdp_cmd = self._cdp_executor()
+        if execute_cdp_cmd is None:
+            logging.warning('selenium版本不支持CDP命令, 不拦截样式和字体')
+            return
+        try:
+            for cmd, params in (('Network.enable', {}), ('Network.setBlockedURLs', {'urls': BLOCKED_URLS}),
+                                ('Page.setDownloadBehavior', {'behavior': 'allow', 'downloadPath': remote_dir})):
+                execute_cdp_cmd(cmd, params)
+        except WebDriverException as e:
+            logging.warning(f'浏览器不支持CDP命令, 不拦截样式和字体: {e.msg}')
+
+    def _cdp_executor(self) -> Optional[Callable[[str, dict], dict]]:
+        """ 执行CDP命令的函数. selenium 4的Chrome driver自带execute_cdp_cmd; selenium 3的Remote driver没有,
+        给command_executor注册goog/cdp/execute命令. command_executor没有命令表(_commands)时返回None """
+        if hasattr(self.driver, 'execute_cdp_cmd'):
+            return self.driver.execute_cdp_cmd
+        commands = getattr(self.driver.command_executor, '_commands', None)
+        if not isinstance(commands, dict):
+            return None
+        commands.setdefault('executeCdpCommand', ('POST', '/session/$sessionId/goog/cdp/execute'))
+        return lambda cmd, params: self.driver.execute('executeCdpCommand', {'cmd': cmd, 'params': params})['value']
+
+    def open_dept_list(self) -> int:
+        """ 在首页找到部门预算公开的链接, 在同一个窗口里打开, 读取所有部门的链接.
+        链接不是http地址时和默认模式一样点击打开 """
+        links = self._open(self.home_url, 'a', timeout=5,
+                           ready=lambda res: any(link.text == '部门预算公开' for link in res))
+        href = _http_url(next(link.href for link in links if link.text == '部门预算公开'))
+        if href is not None:
+            self.dept_links = self._open(href, '#department > li', 'mainTitle', '部门预算公开', timeout=15)
+        else:
+            self.driver.execute_script('arguments[0].click()',
+                                       self.driver.find_element_by_xpath('//a[text()="部门预算公开"]'))
+            self._switch_to_new_window()
+            self.dept_links = self._wait_links('#department > li', 'mainTitle', '部门预算公开', timeout=15)
+        self.dept_page_handle = self.driver.current_window_handle
+        return len(self.dept_links)
+
+    def crawl(self, indices: Iterable[int], p_bar: tqdm):
+        for i in indices:
+            dept_name, href = self.dept_links[i - 1]
+            manifest = CrawlManifest(os.path.join(self.local_dir, dept_name))
+            if manifest.is_complete(self.recrawl_after):
+                click.echo(f'\n第{i}部门: ' + dept_name + ' 已爬取, 跳过')
+                p_bar.update(1)
+                continue
+            click.echo(f'\n第{i}部门: ' + dept_name)
+            if _http_url(href) is None:
+                self.add_error(dept_name + ' 的链接不是http地址, 快速模式爬取不了, 请用默认模式爬取.')
             else:
-                click.secho(' ' * 6 + f'下载{filename}失败或超时', fg='red')
+                self._get_dept(dept_name, href, manifest)
+            p_bar.update(1)
 
-    def _rename_file(self, filename, dept_dir, wait_for_seconds=300):
-        for i in range(0, wait_for_seconds):
+    def _get_dept(self, dept_name, href, manifest: CrawlManifest):
+        try:
+            pdf_pages = self._open(href, '#contentTitle > li', 'mainTitle', '·部门预算公开', timeout=15)
+        except TimeoutException:
+            self.add_error(dept_name + '·部门预算公开, 解析页面出错. 可能是链接失效.')
+            return
+        manifest.begin()
+        if self.downloader is not None:
+            self._copy_cookies()    # 一个部门只读取一次cookie
+        complete = True
+        for page in pdf_pages:
+            page_url = _http_url(page.href)
             try:
-                if filename in os.listdir(self.local_dir):
-                    os.rename(f'{self.local_dir}/{filename}', f'{dept_dir}/{filename}')
-                    return True
-                time.sleep(1)
-            except FileNotFoundError:
-                click.echo('文件目录不对. 请检查文件目录设置', err=True, fg='red')
-                sys.exit(1)
-        return False
+                if page_url is None:
+                    raise TimeoutException(f'链接不是http地址: {page.href}')
+                files = self._open(page_url, '#filespreview > li > a', 'filespreview', timeout=5)
+            except TimeoutException as e:
+                self.add_error(f'{dept_name} {page.text} 打开附件页出错: {e.msg}')
+                complete = False    # 下次不跳过这个部门
+                continue
+            for k, file in enumerate(files, start=1):
+                file_url = self._file_url(file.href)
+                self._download_file(dept_name, manifest, page_url, file.text, file_url,
+                                    partial(self._click_download, k))
+        if complete:
+            manifest.listed()
+
+    def _file_url(self, href) -> Optional[str]:
+        return _http_url(href) if self.downloader is not None else None
+
+    def _click_download(self, k):
+        """ 没有文件链接时, 点击第k个附件的下载按钮 """
+        self.driver.find_element_by_xpath(f'//*[@id="filespreview"]/li[{k}]/div[@id="download"]').click()
+
+    def _open(self, url, selector, title_id=None, title_text='', timeout=15,
+              ready: Callable[[List[Link]], bool] = None) -> List[Link]:
+        """ 在当前窗口打开url, 等待标题元素出现(并且包含title_text), 返回页面上selector选中的链接.
+        等待期间每次检查只执行一次LINKS_SCRIPT, 检查通过时链接也读出来了. 超时后重新打开, 最多重试retries次 """
+        for attempt in range(self.retries + 1):
+            self.driver.get(url)
+            try:
+                return self._wait_links(selector, title_id, title_text, timeout, ready)
+            except TimeoutException:
+                if attempt == self.retries:
+                    raise
+                logging.info(f'打开{url}超时, 重试第{attempt + 1}次')
+
+    def _wait_links(self, selector, title_id=None, title_text='', timeout=15,
+                    ready: Callable[[List[Link]], bool] = None) -> List[Link]:
+        return WebDriverWait(self.driver, timeout, poll_frequency=self.poll_frequency).until(
+            partial(self._read_links, selector, title_id, title_text, ready))[0]
+
+    @staticmethod
+    def _read_links(selector, title_id, title_text, ready, driver) -> Optional[Tuple[List[Link]]]:
+        """ WebDriverWait的条件: 页面还没有加载好时返回None(继续等待).
+        until在返回值为假时继续等待, 所以没有链接的页面返回[]也要包一层, 由_wait_links取出 """
+        res = driver.execute_script(LINKS_SCRIPT, selector, title_id, title_text)
+        if res is None:
+            return None
+        links = [Link(item['text'], item['href']) for item in res]
+        if ready is not None and not ready(links):
+            return None
+        return links,
 
 
 if __name__ == '__main__':
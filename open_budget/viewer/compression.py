@@ -0,0 +1,27 @@
+import gzip
+
+from flask import Flask, request
+
+# 压缩这些类型的响应: 回调返回的json, 页面布局, 脚本和样式
+COMPRESS_MIMETYPES = ('application/json', 'text/html', 'text/css', 'application/javascript', 'text/javascript')
+
+
+def gzip_responses(server: Flask, min_size=1024, level=6):
+    """ 用gzip压缩大于min_size字节的响应. 浏览器不支持gzip, 已经压缩过, 或者是流式发送的文件(send_file)时不压缩.
+    回调返回的json重复的键名很多, 一般能压缩到原来的1/5以下 """
+
+    @server.after_request
+    def compress(response):
+        if (response.direct_passthrough or not 200 <= response.status_code < 300
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES
+                or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(gzip.compress(data, level))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    return compress
@@ -1,33 +1,39 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import dash_table
 import plotly.graph_objs as go
+from dash.dependencies import Input, Output, State
 
 import pandas as pd
 from pathlib import PosixPath
 import pathlib
+from open_budget.viewer.data_layer import ITEM_COLUMN, DataLayer, to_records
+from open_budget.viewer.compression import gzip_responses
+from open_budget.parser.sqlite_index import BudgetIndex
 
 # get relative data folder
 PATH = pathlib.Path(__file__).parent
 DATA_PATH: PosixPath = PATH.joinpath('../../pdf_files/jszwfw').resolve()
+STORE_PATH: PosixPath = DATA_PATH.with_name(DATA_PATH.name + '.parquet')     # pdf_parser导出的parquet存储
+data = DataLayer(DATA_PATH, STORE_PATH)
+INDEX_PATH: PosixPath = DATA_PATH.with_name(DATA_PATH.name + '.sqlite')    # pdf_parser维护的SQLite索引
+index = BudgetIndex(INDEX_PATH)
+INDEX_TABLE = '收支预算总表'
+PAGE_SIZE = 20      # 部门表格每页的行数, 只把当前页发给浏览器
 
 # external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
 app = dash.Dash(__name__)
+gzip_responses(app.server)
 
 
 def get_dept_list():
-    res = list()
-    for child in DATA_PATH.iterdir():
-        dept_name = child.name
-        for file in child.iterdir():
-            if file.suffix == '.csv':
-                res.append(dept_name)
-                continue
-    return res
+    return data.departments()
 
 
-dept_list = get_dept_list()
+def get_item_list():
+    return index.items(INDEX_TABLE) if INDEX_PATH.exists() else []
 
 
 def get_all_dept():
@@ -44,8 +50,7 @@ def get_all_dept():
 
 
 def to_df(dept_name, csv_file):
-    df = pd.read_csv(csv_file, index_col=0)
-    return df
+    return data.get_df(dept_name, pathlib.Path(csv_file).stem)
 
 
 def description_card():
@@ -71,6 +76,8 @@ def generate_control_card():
 
     :return: A Div containing controls for graphs.
     """
+    dept_list = get_dept_list()
+    item_list = get_item_list()
     return html.Div(
         id="control-card",
         children=[
@@ -78,23 +85,48 @@ def generate_control_card():
             dcc.Dropdown(
                 id="dept-select",
                 options=[{"label": i, "value": i} for i in dept_list],
-                value=dept_list[0],
+                value=dept_list[0] if dept_list else None,
             ),
+            html.Br(),
+            html.P("Select Item"),
+            dcc.Dropdown(
+                id="item-select",
+                options=[{"label": i, "value": i} for i in item_list],
+                value=item_list[0] if item_list else None,
+            ),
+            html.Br(),
+            html.P("Select Year"),
+            dcc.Dropdown(id="year-select"),
             html.Br()
-
         ],
     )
 
 
 def generate_table(dataframe: pd.DataFrame, max_rows=10):
-    return html.Table(
-        # Header
-        [html.Tr([html.Th(col) for col in dataframe.columns])] +
-
-        # Body
-        [html.Tr([
-            html.Td(dataframe.iloc[i][col]) for col in dataframe.columns
-        ]) for i in range(min(len(dataframe), max_rows))]
+    """ 小表格(比如同比), 一次把数据发给浏览器 """
+    return dash_table.DataTable(
+        columns=[{"name": str(col), "id": str(col)} for col in dataframe.columns],
+        data=to_records(dataframe.head(max_rows).rename(columns=str)),
+        style_table={"overflowX": "auto"},
+    )
+
+
+def generate_dept_table():
+    """ 部门表格: 每行一个项目, 每列一个年度. 分页, 排序和过滤都在服务端做(见update_dept_table),
+    浏览器只收到当前页的行 """
+    return dash_table.DataTable(
+        id="dept-table",
+        page_action="custom",
+        page_current=0,
+        page_size=PAGE_SIZE,
+        sort_action="custom",
+        sort_mode="multi",
+        sort_by=[],
+        filter_action="custom",
+        filter_query="",
+        fixed_columns={"headers": True, "data": 1},
+        style_table={"overflowX": "auto", "minWidth": "100%"},
+        style_cell={"minWidth": "90px"},
     )
 
 
@@ -108,47 +140,120 @@ def run():
 #     generate_table(get_all_dept())
 # ])
 
-app.layout = html.Div(
-    id="app-container",
-    children=[
-        # Banner
-        html.Div(
-            className="budget-banner",
-            id="banner",
-            children=[
-                html.A(
-                    id="dashbudget-logo",
-                    children=[
-                        html.Img(src=app.get_asset_url("dashbudget_logo_transparent.png"))
-                    ],
-                    href="/Portal",
-                ),
-                html.H2("政府部门预算公开"),
-                html.A(
-                    id="gh-link",
-                    children=["View on GitHub"],
-                    href="https://github.com/plotly/dash-sample-apps/tree/master/apps/dash-pk-calc",
-                    style={"color": "white", "border": "solid 1px white"},
-                ),
-                html.Img(src=app.get_asset_url("GitHub-Mark-Light-64px.png")),
-            ],
-        ),
-        # Left column
-        html.Div(
-            id="left-column",
-            className="four columns",
-            children=[description_card(), generate_control_card()]
-        ),
-        # Right column
-        html.Div(
-            id="right-column",
-            className="eight columns",
-            children=[
-
-            ],
-        ),
+def serve_layout():
+    """ 每次打开页面时生成layout, 部门列表在这时才从数据层读取, 启动时不扫描目录 """
+    return html.Div(
+        id="app-container",
+        children=[
+            # Banner
+            html.Div(
+                className="budget-banner",
+                id="banner",
+                children=[
+                    html.A(
+                        id="dashbudget-logo",
+                        children=[
+                            html.Img(src=app.get_asset_url("dashbudget_logo_transparent.png"))
+                        ],
+                        href="/Portal",
+                    ),
+                    html.H2("政府部门预算公开"),
+                    html.A(
+                        id="gh-link",
+                        children=["View on GitHub"],
+                        href="https://github.com/plotly/dash-sample-apps/tree/master/apps/dash-pk-calc",
+                        style={"color": "white", "border": "solid 1px white"},
+                    ),
+                    html.Img(src=app.get_asset_url("GitHub-Mark-Light-64px.png")),
+                ],
+            ),
+            # Left column
+            html.Div(
+                id="left-column",
+                className="four columns",
+                children=[description_card(), generate_control_card()]
+            ),
+            # Right column
+            html.Div(
+                id="right-column",
+                className="eight columns",
+                children=[
+                    html.H5(id="dept-title"),
+                    generate_dept_table(),
+                    dcc.Graph(id="dept-graph"),
+                    html.Div(id="index-graphs"),
+                ],
+            ),
+        ]
+    )
+
+
+app.layout = serve_layout
+
+
+@app.callback(
+    [Output("dept-title", "children"), Output("dept-table", "columns"), Output("dept-table", "data"),
+     Output("dept-table", "page_count"), Output("dept-table", "page_current")],
+    [Input("dept-select", "value"), Input("dept-table", "page_current"), Input("dept-table", "page_size"),
+     Input("dept-table", "sort_by"), Input("dept-table", "filter_query")])
+def update_dept_table(dept_name, page_current, page_size, sort_by, filter_query):
+    """ 只返回过滤, 排序后的当前页. 换部门, 排序或者过滤后回到第一页 """
+    if not dept_name:
+        return None, [], [], 1, 0
+    if dash.callback_context.triggered and dash.callback_context.triggered[0]["prop_id"] != "dept-table.page_current":
+        page_current = 0
+    years = data.years(dept_name)
+    columns = [{"name": ITEM_COLUMN, "id": ITEM_COLUMN, "type": "text"}] + \
+              [{"name": str(year), "id": str(year), "type": "numeric"} for year in years]
+    rows, page_count, page_current = data.query_table(dept_name, page=page_current, page_size=page_size or PAGE_SIZE,
+                                                      sort_by=sort_by, filter_query=filter_query)
+    return dept_name, columns, rows, page_count, page_current
+
+
+@app.callback([Output("year-select", "options"), Output("year-select", "value")], [Input("dept-select", "value")],
+              [State("year-select", "value")])
+def update_year_select(dept_name, year):
+    """ 部门有数据的年度, 新部门也有原来选中的年度时保持不变 """
+    if not dept_name:
+        return [], None
+    years = data.years(dept_name)
+    return [{"label": y, "value": y} for y in years], year if year in years else (years[0] if years else None)
+
+
+@app.callback(Output("dept-graph", "figure"), [Input("dept-select", "value"), Input("year-select", "value")])
+def update_dept_graph(dept_name, year):
+    """ 缓存里序列化好的图表, 不在回调里构造Figure """
+    if not dept_name:
+        return {}
+    years = data.years(dept_name)
+    if year not in years:
+        if not years:
+            return {}
+        year = years[0]     # 年度下拉框还没有更新
+    return data.get_figure(dept_name, year)
+
+
+@app.callback(Output("index-graphs", "children"), [Input("item-select", "value"), Input("dept-select", "value")])
+def update_index_graphs(item, dept_name):
+    """ 跨部门的汇总、Top N和同比, 直接在SQLite索引上查询, 不读取各部门的数据 """
+    if not item or not INDEX_PATH.exists():
+        return []
+    total = index.total_by_year(INDEX_TABLE, item)
+    if total.empty:
+        return []
+    year = int(total['year'].max())
+    top = index.top_departments(INDEX_TABLE, item, year, n=10)
+    children = [
+        html.H5(f'{item} 全部部门合计'),
+        dcc.Graph(figure=go.Figure(data=[go.Scatter(x=total['year'], y=total['amount'], mode='lines+markers')])),
+        html.H5(f'{year}年 {item} 前10的部门'),
+        dcc.Graph(figure=go.Figure(data=[go.Bar(x=top['department'], y=top['amount'])])),
     ]
-)
+    if dept_name:
+        yoy = index.year_over_year(INDEX_TABLE, item, dept_name)
+        children += [html.H5(f'{dept_name} {item} 同比'), generate_table(yoy.drop(columns='department').round(4))]
+    return children
+
 
 if __name__ == '__main__':
     app.run_server(debug=True)
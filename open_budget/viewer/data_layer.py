@@ -0,0 +1,232 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+
+from open_budget.parser.parquet_store import ParquetStore
+
+# 表格视图第一列的列名, 后面每个年度一列
+ITEM_COLUMN = '项目'
+
+
+class DataLayer:
+    """ 可视化模块的数据访问层.
+    - 部门列表在第一次使用时才扫描目录, 不在import时扫描.
+    - 读取的DataFrame放在有上限的LRU缓存里, 以(文件路径, mtime)判断是否过期.
+    - 距离上次检查不到poll_interval秒时直接返回缓存, 不访问磁盘; 超过后stat一次文件(部门列表stat每个部门目录),
+      pdf_parser写了新的结果(mtime变化)时重新读取.
+    数据优先从parquet存储读取, 没有parquet存储时读取部门目录下的csv文件.
+    由DataFrame生成的表格视图和图表(序列化好的json)和DataFrame缓存在一起, 文件变化重新读取时一起失效.
+    """
+
+    def __init__(self, data_path: Path, store_path: Path, max_frames=64, poll_interval=2.0):
+        self.data_path = Path(data_path)
+        self.store_path = Path(store_path)
+        self.store = ParquetStore(str(store_path))
+        self.max_frames = max_frames
+        self.poll_interval = poll_interval
+        self._frames: 'OrderedDict[tuple, list]' = OrderedDict()   # key -> [path, mtime, checked_at, df, views]
+        self._depts: Optional[list] = None      # [root, mtimes, checked_at, 部门列表]
+        self._lock = threading.Lock()
+
+    def departments(self) -> List[str]:
+        """ 有解析结果的部门 """
+        with self._lock:
+            now = time.monotonic()
+            if self._depts is not None and now - self._depts[2] < self.poll_interval:
+                return self._depts[3]
+            root = self._root()
+            mtimes = self._dept_mtimes(root)
+            if self._depts is None or self._depts[0] != root or self._depts[1] != mtimes:
+                self._depts = [root, mtimes, now, self._scan_departments(root)]
+            else:
+                self._depts[2] = now
+            return self._depts[3]
+
+    def get_df(self, dept_name, table_name='收支预算总表') -> pd.DataFrame:
+        """ 部门某个表的解析结果, 行是年度, 列是项目 """
+        key = (dept_name, table_name)
+        with self._lock:
+            now = time.monotonic()
+            entry = self._frames.get(key)
+            if entry is not None:
+                self._frames.move_to_end(key)
+                if now - entry[2] < self.poll_interval:
+                    return entry[3]
+                path = self._source(dept_name, table_name)
+                if path == entry[0] and self._mtime(path) == entry[1]:
+                    entry[2] = now
+                    return entry[3]
+            path = self._source(dept_name, table_name)
+            mtime = self._mtime(path)
+            df = self._read(path, dept_name, table_name)
+            self._frames[key] = [path, mtime, now, df, dict()]
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+            return df
+
+    def get_table(self, dept_name, table_name='收支预算总表') -> pd.DataFrame:
+        """ 表格视图: 每行一个项目, 每列一个年度(新的年度在前), 第一列是项目名称 """
+        return self._view(dept_name, table_name, 'table', to_table)
+
+    def query_table(self, dept_name, table_name='收支预算总表', page=0, page_size=20, sort_by: List[dict] = None,
+                    filter_query='') -> Tuple[List[dict], int, int]:
+        """ 服务端分页: 过滤, 排序后只返回一页的行, 给DataTable(page_action='custom').
+        返回(这一页的行, 总页数, 页码). 页码超出范围时返回最后一页 """
+        df = self.get_table(dept_name, table_name)
+        df = sort_table(filter_table(df, filter_query), sort_by)
+        page_count = max(1, math.ceil(len(df) / page_size))
+        page = min(max(page or 0, 0), page_count - 1)
+        rows = df.iloc[page * page_size:(page + 1) * page_size]
+        return to_records(rows), page_count, page
+
+    def years(self, dept_name, table_name='收支预算总表') -> List[int]:
+        """ 部门有数据的年度, 新的在前 """
+        return [int(column) for column in self.get_table(dept_name, table_name).columns[1:]]
+
+    def get_figure(self, dept_name, year, table_name='收支预算总表') -> Optional[dict]:
+        """ 部门某个年度各项目金额的柱状图. 第一次用到时序列化成紧凑的json缓存起来,
+        之后每次只需要解析json, 不再构造和校验plotly的Figure. 没有这个年度时返回None """
+        text = self._view(dept_name, table_name, f'figure-{year}', lambda df: to_figure(dept_name, df, int(year)))
+        return None if text is None else json.loads(text)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._depts = None
+
+    def _view(self, dept_name, table_name, kind, build: Callable[[pd.DataFrame], object]):
+        """ 由DataFrame生成的视图, 和DataFrame一起缓存 """
+        df = self.get_df(dept_name, table_name)
+        with self._lock:
+            entry = self._frames.get((dept_name, table_name))
+            views = entry[4] if entry is not None and entry[3] is df else dict()    # 刚好被挤出缓存时不缓存
+            if kind not in views:
+                views[kind] = build(df)
+            return views[kind]
+
+    def _root(self) -> Path:
+        return self.store_path if self.store_path.exists() else self.data_path
+
+    def _dept_mtimes(self, root: Path) -> tuple:
+        """ 判断部门列表是否过期. 读取csv文件时, 已有的部门目录下新增了csv文件只改变部门目录的mtime,
+        所以还要看每个部门目录的mtime """
+        if root == self.store_path:
+            return self._mtime(root),
+        try:
+            children = sorted(root.iterdir())
+        except FileNotFoundError:
+            return None,
+        return (self._mtime(root),) + tuple((child.name, self._mtime(child)) for child in children if child.is_dir())
+
+    def _scan_departments(self, root: Path) -> List[str]:
+        if root == self.store_path:
+            return self.store.departments()
+        res = list()
+        for child in sorted(root.iterdir()):
+            if child.is_dir() and any(file.suffix == '.csv' for file in child.iterdir()):
+                res.append(child.name)
+        return res
+
+    def _source(self, dept_name, table_name) -> Path:
+        if self.store_path.exists():
+            return self.store_path.joinpath(f'department={dept_name}')
+        return self.data_path.joinpath(dept_name, f'{table_name}.csv')
+
+    def _read(self, path: Path, dept_name, table_name) -> pd.DataFrame:
+        if path.suffix == '.csv':
+            return pd.read_csv(path, index_col=0, parse_dates=True)
+        return self.store.read_dept(dept_name, table_name)
+
+    @staticmethod
+    def _mtime(path: Path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+
+def to_table(df: pd.DataFrame) -> pd.DataFrame:
+    """ 行是年度, 列是项目的DataFrame转成表格视图: 行是项目, 列是年度(字符串, 新的在前) """
+    df = df.sort_index(ascending=False)
+    table = df.T
+    table.columns = [str(year) for year in df.index.year]
+    table.index.name = ITEM_COLUMN
+    return table.reset_index()
+
+
+def to_records(df: pd.DataFrame) -> List[dict]:
+    """ DataTable的data, 空值转成None(json里的null) """
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+# DataTable过滤语法的一个条件, 比如'{项目} contains 支出', '{2019} > 100', '{项目} s= "收入合计"'
+re_filter = re.compile(r'^\s*\{(?P<column>[^}]+)\}\s+(?P<op>[si]?[<>!=]=?|[a-z]+)\s*(?P<value>.*?)\s*$')
+FILTER_OPS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+KNOWN_OPS = set(FILTER_OPS) | set(FILTER_OPS.values()) | {'contains', 'datestartswith'}
+
+
+def filter_table(df: pd.DataFrame, filter_query) -> pd.DataFrame:
+    """ 按DataTable的filter_query过滤, 多个条件用&&连接. 不认识的条件忽略 """
+    if not filter_query:
+        return df
+    mask = pd.Series(True, index=df.index)
+    for part in filter_query.split(' && '):
+        r = re_filter.match(part)
+        if not r or r.group('column') not in df.columns:
+            continue
+        column, op, value = df[r.group('column')], r.group('op'), r.group('value')
+        if len(op) > 1 and op[0] in 'si' and op[1:] in KNOWN_OPS:
+            op = op[1:]     # s: 区分大小写, i: 不区分大小写, 中文没有区别
+        op = FILTER_OPS.get(op, op)
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        if op in ('contains', 'datestartswith'):
+            text = column.astype(str)
+            mask &= text.str.contains(value, regex=False) if op == 'contains' else text.str.startswith(value)
+            continue
+        if column.dtype == object:
+            other = value
+        else:
+            try:
+                other = float(value)
+            except ValueError:
+                continue
+        if op == '=':
+            mask &= column == other
+        elif op == '!=':
+            mask &= column != other
+        elif op in ('<', '<=', '>', '>='):
+            mask &= {'<': column.lt, '<=': column.le, '>': column.gt, '>=': column.ge}[op](other)
+    return df[mask]
+
+
+def sort_table(df: pd.DataFrame, sort_by: List[dict]) -> pd.DataFrame:
+    """ 按DataTable的sort_by排序, [{'column_id': 列名, 'direction': 'asc'或者'desc'}], 空值排在最后 """
+    sort_by = [item for item in sort_by or [] if item['column_id'] in df.columns]
+    if not sort_by:
+        return df
+    return df.sort_values([item['column_id'] for item in sort_by],
+                          ascending=[item['direction'] == 'asc' for item in sort_by], kind='mergesort',
+                          na_position='last')
+
+
+def to_figure(dept_name, df: pd.DataFrame, year) -> Optional[str]:
+    """ 一个年度的柱状图, 序列化成紧凑(没有缩进和空格)的json, 安装了orjson时plotly用orjson序列化 """
+    rows = df[df.index.year == year]
+    if rows.empty:
+        return None
+    row = rows.iloc[-1].dropna()
+    fig = go.Figure(data=[go.Bar(x=list(row.index), y=row.tolist())],
+                    layout=dict(title=f'{dept_name} {year}年', margin=dict(l=40, r=20, t=40, b=120)))
+    return pio.to_json(fig, pretty=False)
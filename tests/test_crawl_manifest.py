@@ -0,0 +1,36 @@
+from open_budget.spider.crawl_manifest import CrawlManifest
+
+
+def test_crawl_manifest(tmp_path):
+    dept_dir = tmp_path / '江苏省人民检察院'
+    manifest = CrawlManifest(str(dept_dir))
+    assert not manifest.is_complete(3600)
+    manifest.begin()
+    manifest.expect()
+    manifest.expect()
+    dept_dir.joinpath('a.pdf').write_bytes(b'%PDF-a')
+    manifest.record('a.pdf', 'http://example.com/1', '附件1：a.pdf', etag='"v1"')
+    manifest.listed()
+    assert not manifest.is_complete(3600)    # b.pdf还没下载完
+    dept_dir.joinpath('b.pdf').write_bytes(b'%PDF-b')
+    manifest.record('b.pdf', 'http://example.com/1', '附件2：b.pdf')
+    assert manifest.is_complete(3600)
+    assert not manifest.is_complete(0)
+
+    manifest = CrawlManifest(str(dept_dir))     # 重新读取
+    assert manifest.is_complete(3600)
+    assert manifest.files['a.pdf']['size'] == 6
+    assert manifest.is_downloaded('a.pdf')
+    assert manifest.validators('a.pdf') == {'etag': '"v1"', 'last_modified': None}
+    dept_dir.joinpath('a.pdf').write_bytes(b'%PDF')     # 本地文件不完整
+    assert not manifest.is_downloaded('a.pdf')
+    assert manifest.validators('a.pdf') == {'etag': None, 'last_modified': None}
+
+
+def test_crawl_manifest_failed(tmp_path):
+    manifest = CrawlManifest(str(tmp_path))
+    manifest.begin()
+    manifest.expect()
+    manifest.fail()
+    manifest.listed()
+    assert not CrawlManifest(str(tmp_path)).is_complete(3600)
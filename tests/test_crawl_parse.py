@@ -0,0 +1,124 @@
+import os
+import shutil
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pandas as pd
+from open_budget.parser.pdf_parser import DeptFilesParser
+from open_budget.pipeline.crawl_parse import CrawlParsePipeline
+
+DEPT = '江苏省人民检察院'
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw', DEPT)
+
+
+def test_pipeline(tmp_path):
+    dept_dir = tmp_path / DEPT
+    dept_dir.mkdir()
+    pipeline = CrawlParsePipeline(jobs=2, queue_size=1)
+    try:
+        for name in ('2018年省检察院部门预算公开.pdf', '2019年度部门预算公开.pdf'):
+            pipeline.file_queue.reserve()   # queue_size=1, 上一个文件解析完才能继续
+            shutil.copy(os.path.join(SRC_DIR, name), dept_dir)
+            pipeline.file_queue.put(DEPT, str(dept_dir / name))
+    finally:
+        pipeline.close()
+    assert pipeline.errors == []
+    df = pd.read_csv(dept_dir / '收支预算总表.csv', index_col=0, parse_dates=True)
+    assert sorted(df.index.year) == [2018, 2019]
+
+    expected = DeptFilesParser(DEPT, str(dept_dir))
+    expected.parse()
+    expected_df = expected.parsers[0].parsed_df
+    assert df.sort_index().equals(expected_df.sort_index()[df.columns])
+
+    # 文件没有变化时不再解析
+    pipeline = CrawlParsePipeline()
+    try:
+        pipeline.file_queue.reserve()
+        pipeline.file_queue.put(DEPT, str(dept_dir / '2019年度部门预算公开.pdf'))
+    finally:
+        pipeline.close()
+    assert pipeline.dept_parsers[DEPT].pages_total == 0
+    assert sorted(pipeline.dept_parsers[DEPT].parsers[0].parsed_df.index.year) == [2018, 2019]
+
+
+def _parsed_from_scratch(dept_dir):
+    expected = DeptFilesParser(DEPT, str(dept_dir))
+    expected.parse()
+    return expected.parsers[0].parsed_df.sort_index()
+
+
+def test_pipeline_replaced(tmp_path):
+    """ 重新下载的文件内容变化了: 这个文件的年度只保留重新解析出来的行 """
+    dept_dir = tmp_path / DEPT
+    dept_dir.mkdir()
+    target = dept_dir / '2019年度部门预算公开.pdf'
+    pipeline = CrawlParsePipeline(queue_size=1)
+    try:
+        for name in ('2018年省检察院部门预算公开.pdf', '2019年度部门预算公开.pdf', '2017年省检察院部门预算.pdf'):
+            pipeline.file_queue.reserve()
+            shutil.copy(os.path.join(SRC_DIR, name), target if name.startswith('2017') else dept_dir)
+            pipeline.file_queue.put(DEPT, str(dept_dir / (target.name if name.startswith('2017') else name)))
+    finally:
+        pipeline.close()
+    assert pipeline.errors == []
+    df = pd.read_csv(dept_dir / '收支预算总表.csv', index_col=0, parse_dates=True).sort_index()
+    assert list(df.index.year) == [2018, 2019]
+    expected_df = _parsed_from_scratch(dept_dir)
+    assert df.equals(expected_df[df.columns])
+
+    # 新的会话: 从csv读取没有变化的年度, 替换回原来的文件
+    shutil.copy(os.path.join(SRC_DIR, '2019年度部门预算公开.pdf'), target)
+    pipeline = CrawlParsePipeline()
+    try:
+        pipeline.file_queue.reserve()
+        pipeline.file_queue.put(DEPT, str(target))
+    finally:
+        pipeline.close()
+    assert pipeline.errors == []
+    df = pd.read_csv(dept_dir / '收支预算总表.csv', index_col=0, parse_dates=True).sort_index()
+    assert list(df.index.year) == [2018, 2019]
+    assert not df.equals(expected_df[df.columns])
+    assert df.equals(_parsed_from_scratch(dept_dir)[df.columns])
+
+
+def test_pipeline_not_closed():
+    """ 生产者出错没有调用close时, 消费线程不阻止进程退出 """
+    pipeline = CrawlParsePipeline()
+    assert pipeline._consumer.daemon
+    pipeline.close()
+    assert not pipeline._consumer.is_alive()
+
+
+class ManualExecutor:
+    """ 由测试决定每个文件什么时候解析完 """
+    def __init__(self):
+        self.futures = list()
+
+    def submit(self, fn, *args, **kwargs):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_merge_in_submission_order():
+    """ 后提交的文件先解析完时, 等前面的文件解析完再按提交的顺序合并 """
+    pipeline = CrawlParsePipeline(jobs=2)
+    pipeline._executor.shutdown()
+    pipeline._executor = executor = ManualExecutor()
+    merged = list()
+    parser = SimpleNamespace(dept_name=DEPT, path='.', merge=lambda result: merged.append(result.name), to_csv=lambda: None,
+                             save_manifest=lambda: None)
+    try:
+        for k in range(3):
+            pipeline._submit(parser, f'{k}.pdf', 2017 + k, False)
+        for k in (2, 0, 1):
+            executor.futures[k].set_result(SimpleNamespace(name=f'{k}.pdf', failures={}))
+            if k == 2:
+                assert merged == []
+    finally:
+        pipeline.close()
+    assert merged == ['0.pdf', '1.pdf', '2.pdf']
+    assert pipeline.errors == []
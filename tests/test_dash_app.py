@@ -0,0 +1,57 @@
+import gzip
+import json
+
+from flask import Flask
+
+from open_budget.viewer import dash_app
+from open_budget.viewer.compression import gzip_responses
+
+TABLE_OUTPUTS = [('dept-title', 'children'), ('dept-table', 'columns'), ('dept-table', 'data'),
+                 ('dept-table', 'page_count'), ('dept-table', 'page_current')]
+
+
+def _update_dept_table(client, dept_name, page_current=0, page_size=5, sort_by=(), filter_query='',
+                       changed='dept-select.value'):
+    body = {'output': '..' + '...'.join(f'{id_}.{prop}' for id_, prop in TABLE_OUTPUTS) + '..',
+            'outputs': [{'id': id_, 'property': prop} for id_, prop in TABLE_OUTPUTS],
+            'inputs': [{'id': 'dept-select', 'property': 'value', 'value': dept_name},
+                       {'id': 'dept-table', 'property': 'page_current', 'value': page_current},
+                       {'id': 'dept-table', 'property': 'page_size', 'value': page_size},
+                       {'id': 'dept-table', 'property': 'sort_by', 'value': list(sort_by)},
+                       {'id': 'dept-table', 'property': 'filter_query', 'value': filter_query}],
+            'changedPropIds': [changed], 'state': []}
+    response = client.post('/_dash-update-component', json=body, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    data = gzip.decompress(response.data) if response.headers.get('Content-Encoding') == 'gzip' else response.data
+    return json.loads(data)['response']['dept-table']
+
+
+def test_dept_table_page():
+    """ 浏览器只收到当前页的行, 换部门时回到第一页 """
+    client = dash_app.app.server.test_client()
+    dept_name = dash_app.get_dept_list()[0]
+    rows = len(dash_app.data.get_table(dept_name))
+    table = _update_dept_table(client, dept_name, page_current=1, changed='dept-table.page_current')
+    assert table['page_current'] == 1
+    assert len(table['data']) == min(5, rows - 5)
+    assert table['page_count'] == -(-rows // 5)
+    assert _update_dept_table(client, dept_name, page_current=1)['page_current'] == 0
+
+    table = _update_dept_table(client, dept_name, sort_by=[{'column_id': '项目', 'direction': 'asc'}],
+                               filter_query='{项目} contains 支出', changed='dept-table.filter_query')
+    items = [row['项目'] for row in table['data']]
+    assert items == sorted(items) and all('支出' in item for item in items)
+
+
+def test_gzip_responses():
+    app = Flask(__name__)
+    gzip_responses(app, min_size=100)
+    app.add_url_rule('/big', 'big', lambda: {'data': ['项目'] * 100})
+    app.add_url_rule('/small', 'small', lambda: {'data': 1})
+    client = app.test_client()
+    response = client.get('/big', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert json.loads(gzip.decompress(response.data)) == {'data': ['项目'] * 100}
+    assert 'Content-Encoding' not in client.get('/big').headers
+    assert 'Content-Encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
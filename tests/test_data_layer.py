@@ -0,0 +1,114 @@
+import os
+import pandas as pd
+from open_budget.parser.parquet_store import ParquetStore
+from open_budget.viewer.data_layer import DataLayer
+
+
+def _write_csv(data_path, dept_name, value):
+    os.makedirs(data_path / dept_name, exist_ok=True)
+    df = pd.DataFrame([[value]], index=[pd.datetime(2019, 1, 1)], columns=['财政拨款'])
+    df.to_csv(data_path / dept_name / '收支预算总表.csv')
+    return df
+
+
+def test_data_layer_csv(tmp_path):
+    data_path = tmp_path / 'jszwfw'
+    _write_csv(data_path, '江苏省人民检察院', 1.0)
+    os.makedirs(data_path / '没有csv的部门')
+    data = DataLayer(data_path, tmp_path / 'jszwfw.parquet', poll_interval=60)
+    assert data.departments() == ['江苏省人民检察院']
+
+    df = data.get_df('江苏省人民检察院')
+    assert df.iloc[0, 0] == 1.0
+    assert data.get_df('江苏省人民检察院') is df    # 缓存命中
+
+    # 在poll_interval内不检查文件变化
+    _write_csv(data_path, '江苏省人民检察院', 2.0)
+    os.utime(data_path / '江苏省人民检察院' / '收支预算总表.csv', (1, 1))
+    assert data.get_df('江苏省人民检察院') is df
+    data.poll_interval = 0
+    assert data.get_df('江苏省人民检察院').iloc[0, 0] == 2.0
+
+
+def test_departments_new_csv(tmp_path):
+    """ 已有的部门目录下新增了csv文件, 上级目录的mtime不变, 部门列表也要更新 """
+    data_path = tmp_path / 'jszwfw'
+    _write_csv(data_path, '江苏省人民检察院', 1.0)
+    os.makedirs(data_path / '江苏省高级人民法院')
+    data = DataLayer(data_path, tmp_path / 'jszwfw.parquet', poll_interval=0)
+    assert data.departments() == ['江苏省人民检察院']
+    root_mtime = os.stat(data_path).st_mtime_ns
+    _write_csv(data_path, '江苏省高级人民法院', 2.0)
+    os.utime(data_path / '江苏省高级人民法院', ns=(1, 1))     # 只有部门目录的mtime变化
+    assert os.stat(data_path).st_mtime_ns == root_mtime
+    assert data.departments() == ['江苏省人民检察院', '江苏省高级人民法院']
+
+
+def test_data_layer_lru(tmp_path):
+    data_path = tmp_path / 'jszwfw'
+    for i in range(3):
+        _write_csv(data_path, f'部门{i}', float(i))
+    data = DataLayer(data_path, tmp_path / 'jszwfw.parquet', max_frames=2)
+    first = data.get_df('部门0')
+    data.get_df('部门1')
+    data.get_df('部门2')
+    assert len(data._frames) == 2
+    assert data.get_df('部门0') is not first
+
+
+def test_data_layer_store(tmp_path):
+    store_path = tmp_path / 'jszwfw.parquet'
+    df = pd.DataFrame([[1.0]], index=[pd.datetime(2019, 1, 1)], columns=['财政拨款'])
+    ParquetStore(str(store_path)).write('江苏省人民检察院', {'收支预算总表': df})
+    data = DataLayer(tmp_path / 'jszwfw', store_path, poll_interval=0)
+    assert data.departments() == ['江苏省人民检察院']
+    assert data.get_df('江苏省人民检察院').equals(df)
+
+
+def _write_wide(data_path, dept_name, years=3, items=50):
+    os.makedirs(data_path / dept_name, exist_ok=True)
+    df = pd.DataFrame([[float(year * 1000 + i) for i in range(items)] for year in range(2017, 2017 + years)],
+                      index=[pd.datetime(year, 1, 1) for year in range(2017, 2017 + years)],
+                      columns=[f'项目{i}' for i in range(items)])
+    df.iloc[0, 0] = None
+    df.to_csv(data_path / dept_name / '收支预算总表.csv')
+    return df
+
+
+def test_query_table(tmp_path):
+    data_path = tmp_path / 'jszwfw'
+    _write_wide(data_path, '部门')
+    data = DataLayer(data_path, tmp_path / 'jszwfw.parquet', poll_interval=60)
+    table = data.get_table('部门')
+    assert list(table.columns) == ['项目', '2019', '2018', '2017']
+    assert data.get_table('部门') is table
+    assert data.years('部门') == [2019, 2018, 2017]
+
+    rows, page_count, page = data.query_table('部门', page=1, page_size=20)
+    assert (len(rows), page_count, page) == (20, 3, 1)
+    assert rows[0] == {'项目': '项目20', '2019': 2019020.0, '2018': 2018020.0, '2017': 2017020.0}
+    rows, _, page = data.query_table('部门', page=10, page_size=20)    # 超出范围时返回最后一页
+    assert (len(rows), page) == (10, 2)
+
+    rows, page_count, _ = data.query_table('部门', sort_by=[{'column_id': '2017', 'direction': 'desc'}],
+                                           filter_query='{项目} contains 项目1 && {2019} < 2019015')
+    assert [row['项目'] for row in rows] == ['项目14', '项目13', '项目12', '项目11', '项目10', '项目1']
+    rows, _, _ = data.query_table('部门', sort_by=[{'column_id': '2017', 'direction': 'asc'}],
+                                  filter_query='{项目} s= "项目0" && {不存在的列} > 1')
+    assert rows == [{'项目': '项目0', '2019': 2019000.0, '2018': 2018000.0, '2017': None}]
+
+
+def test_figure(tmp_path):
+    data_path = tmp_path / 'jszwfw'
+    _write_wide(data_path, '部门')
+    data = DataLayer(data_path, tmp_path / 'jszwfw.parquet', poll_interval=0)
+    figure = data.get_figure('部门', 2017)
+    assert figure['data'][0]['type'] == 'bar'
+    assert figure['data'][0]['x'][0] == '项目1'     # 空值不画
+    assert data.get_figure('部门', 2016) is None
+    views = data._frames[('部门', '收支预算总表')][4]
+    assert ' ' not in views['figure-2017'].replace(' 2017年', '')    # 紧凑的json
+    # 文件变化后重新生成
+    _write_wide(data_path, '部门', years=4)
+    os.utime(data_path / '部门' / '收支预算总表.csv', (1, 1))
+    assert data.get_figure('部门', 2020)['data'][0]['y'][0] == 2020000.0
@@ -0,0 +1,91 @@
+import threading
+import time
+from open_budget.spider.download_watcher import DownloadWatcher
+
+
+def _download(path, chunks=3):
+    """ 模拟chrome下载: 先写.crdownload文件, 写完后重命名 """
+    with open(str(path) + '.crdownload', 'wb') as f:
+        for _ in range(chunks):
+            f.write(b'%PDF' * 256)
+            f.flush()
+            time.sleep(0.05)
+    (path.parent / (path.name + '.crdownload')).rename(path)
+
+
+def test_watcher(tmp_path):
+    dept_dir = tmp_path / '江苏省人民检察院'
+    done = list()
+    watcher = DownloadWatcher(str(tmp_path), stable_seconds=0.2, on_done=lambda name, dest: done.append(name)).start()
+    try:
+        threads = list()
+        for name in ('a.pdf', 'b.pdf'):
+            watcher.expect(name, str(dept_dir))   # 登记后马上返回, 不等下载完成
+            thread = threading.Thread(target=_download, args=(tmp_path / name,))
+            thread.start()
+            threads.append(thread)
+        assert not done
+        assert watcher.wait(timeout=10)
+        for thread in threads:
+            thread.join()
+    finally:
+        watcher.stop()
+    assert sorted(done) == ['a.pdf', 'b.pdf']
+    assert sorted(p.name for p in dept_dir.iterdir()) == ['a.pdf', 'b.pdf']
+    assert (dept_dir / 'a.pdf').stat().st_size == 3 * 1024
+    assert not (tmp_path / 'a.pdf').exists()
+
+
+def test_watcher_partial(tmp_path):
+    (tmp_path / 'a.pdf').write_bytes(b'%PDF')
+    (tmp_path / 'a.pdf.crdownload').write_bytes(b'%PDF')     # 还在下载中
+    failed = list()
+    watcher = DownloadWatcher(str(tmp_path), stable_seconds=0.1, timeout=0.5, on_failed=failed.append).start()
+    try:
+        watcher.expect('a.pdf', str(tmp_path / 'dept'))
+        assert watcher.wait(timeout=5)
+    finally:
+        watcher.stop()
+    assert failed == ['a.pdf']
+    assert watcher.done == []
+
+
+def test_watcher_without_watchdog(tmp_path, monkeypatch):
+    monkeypatch.setattr('open_budget.spider.download_watcher.Observer', None)
+    watcher = DownloadWatcher(str(tmp_path), stable_seconds=0.1, poll_interval=0.1).start()
+    try:
+        watcher.expect('a.pdf', str(tmp_path / 'dept'))
+        _download(tmp_path / 'a.pdf')
+        assert watcher.wait(timeout=5)
+    finally:
+        watcher.stop()
+    assert watcher.done == [str(tmp_path / 'dept' / 'a.pdf')]
+
+
+def test_watcher_callback_unlocked(tmp_path):
+    """ 回调在释放锁之后调用: 回调执行时其他线程可以登记文件, 回调里也可以调用expect; wait等回调返回 """
+    started, release = threading.Event(), threading.Event()
+    done = list()
+
+    def on_done(name, dest):
+        started.set()
+        release.wait(5)
+        if name == 'a.pdf':
+            watcher.expect('c.pdf', str(tmp_path / 'dept'))
+        done.append(name)
+
+    watcher = DownloadWatcher(str(tmp_path), stable_seconds=0.1, on_done=on_done).start()
+    try:
+        watcher.expect('a.pdf', str(tmp_path / 'dept'))
+        _download(tmp_path / 'a.pdf', chunks=1)
+        assert started.wait(5)
+        start = time.monotonic()
+        watcher.expect('b.pdf', str(tmp_path / 'dept'))
+        assert time.monotonic() - start < 1
+        release.set()
+        _download(tmp_path / 'b.pdf', chunks=1)
+        _download(tmp_path / 'c.pdf', chunks=1)
+        assert watcher.wait(timeout=10)
+    finally:
+        watcher.stop()
+    assert sorted(done) == ['a.pdf', 'b.pdf', 'c.pdf']
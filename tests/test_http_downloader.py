@@ -0,0 +1,127 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from open_budget.spider.http_downloader import HttpDownloader
+
+CONTENT = bytes(range(256)) * 1024     # 256KB
+CHANGED = bytes(reversed(range(256))) * 1024
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ 模拟网站的附件下载: 支持Range请求, If-Range和If-None-Match, /flaky第一次只发送一半内容就断开连接.
+    /changing第一次和/flaky一样, 之后文件变成CHANGED; /changing-ignore-if-range还不检查If-Range """
+    requests = list()
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.get('Range')))
+        content, etag = CONTENT, '"v1"'
+        changing = self.path.startswith('/changing')
+        if changing and len(Handler.requests) > 1:
+            content, etag = CHANGED, '"v2"'
+
+        if self.path == '/missing.pdf':
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if_range = self.headers.get('If-Range')
+        if self.headers.get('Range') and (if_range in (None, etag) or self.path == '/changing-ignore-if-range.pdf'):
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        body = content[start:]
+        if (self.path == '/flaky.pdf' or changing) and start == 0 and len(Handler.requests) == 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = list()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download(server, tmp_path):
+    done = list()
+    downloader = HttpDownloader(max_workers=3, on_done=lambda name, dest: done.append(name))
+    for i in range(5):
+        downloader.submit(f'{server}/{i}.pdf', str(tmp_path / f'{i}.pdf'))
+    downloader.close()
+    assert sorted(done) == [f'{i}.pdf' for i in range(5)]
+    assert downloader.failed == []
+    for i in range(5):
+        assert (tmp_path / f'{i}.pdf').read_bytes() == CONTENT
+    assert not list(tmp_path.glob('*.part'))
+
+
+def test_download_resume(server, tmp_path):
+    downloader = HttpDownloader(backoff=0.01)
+    downloader.download(f'{server}/flaky.pdf', str(tmp_path / 'flaky.pdf'))
+    downloader.close()
+    assert (tmp_path / 'flaky.pdf').read_bytes() == CONTENT
+    # 第二次请求从第一次收到的位置继续下载
+    assert Handler.requests == [('/flaky.pdf', None), ('/flaky.pdf', f'bytes={len(CONTENT) // 2}-')]
+
+
+def test_download_not_found(server, tmp_path):
+    failed = list()
+    downloader = HttpDownloader(backoff=0.01, on_failed=failed.append)
+    with pytest.raises(requests.HTTPError):
+        downloader.submit(f'{server}/missing.pdf', str(tmp_path / 'missing.pdf')).result()
+    downloader.close()
+    assert failed == ['missing.pdf']
+    assert len(Handler.requests) == 1     # 4xx不重试
+
+
+def test_download_conditional(server, tmp_path):
+    downloader = HttpDownloader()
+    dest = str(tmp_path / 'a.pdf')
+    result = downloader.download(f'{server}/a.pdf', dest)
+    assert result.modified and result.etag == '"v1"'
+    result = downloader.download(f'{server}/a.pdf', dest, etag=result.etag)
+    downloader.close()
+    assert not result.modified
+    assert Handler.requests[-1] == ('/a.pdf', None)
+    assert (tmp_path / 'a.pdf').read_bytes() == CONTENT
+
+
+@pytest.mark.parametrize('name', ['changing.pdf', 'changing-ignore-if-range.pdf'])
+def test_download_resume_changed(server, tmp_path, name):
+    """ 续传之前服务器上的文件变化了: 不能把新内容接在旧内容后面, 从头下载新文件 """
+    downloader = HttpDownloader(backoff=0.01)
+    result = downloader.download(f'{server}/{name}', str(tmp_path / name))
+    downloader.close()
+    assert (tmp_path / name).read_bytes() == CHANGED
+    assert result.etag == '"v2"'
+    assert Handler.requests[1] == (f'/{name}', f'bytes={len(CONTENT) // 2}-')
+    assert not list(tmp_path.glob('*.part*'))
+
+
+def test_download_resume_without_validator(server, tmp_path):
+    """ .part文件没有记录验证器时不续传 """
+    (tmp_path / 'a.pdf.part').write_bytes(CHANGED[:1000])
+    downloader = HttpDownloader()
+    downloader.download(f'{server}/a.pdf', str(tmp_path / 'a.pdf'))
+    downloader.close()
+    assert Handler.requests == [('/a.pdf', None)]
+    assert (tmp_path / 'a.pdf').read_bytes() == CONTENT
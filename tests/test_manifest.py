@@ -0,0 +1,51 @@
+import os
+from open_budget.parser.manifest import Manifest
+from open_budget.parser.table_cache import file_sha256
+
+
+def _write_pdf(path, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def test_manifest(tmp_path):
+    pdf = _write_pdf(tmp_path / '2019年预算.pdf', b'%PDF-1.4 2019')
+    manifest = Manifest(str(tmp_path), parser_version=1)
+    assert not manifest.is_unchanged(pdf)
+    manifest.record(pdf, file_sha256(pdf), {'收支预算总表': [2019]})
+    manifest.save()
+
+    manifest = Manifest(str(tmp_path), parser_version=1)
+    assert manifest.is_unchanged(pdf)
+    assert manifest.years('收支预算总表') == {2019}
+    os.utime(pdf, (1, 1))   # 只有mtime变化
+    assert manifest.is_unchanged(pdf)
+    _write_pdf(pdf, b'%PDF-1.4 2019 changed')
+    assert not manifest.is_unchanged(pdf)
+
+    manifest.retain([])
+    assert manifest.years('收支预算总表') == set()
+
+
+def test_manifest_parser_version(tmp_path):
+    pdf = _write_pdf(tmp_path / '2019年预算.pdf', b'%PDF-1.4 2019')
+    manifest = Manifest(str(tmp_path), parser_version=1)
+    manifest.record(pdf, file_sha256(pdf))
+    manifest.save()
+    assert Manifest(str(tmp_path), parser_version=1).is_unchanged(pdf)
+    assert not Manifest(str(tmp_path), parser_version=2).is_unchanged(pdf)
+
+
+def test_manifest_duplicate(tmp_path):
+    pdf_a = _write_pdf(tmp_path / '2017年预算.pdf', b'%PDF-1.4 2017')
+    pdf_b = _write_pdf(tmp_path / '2017年预算公开.pdf', b'%PDF-1.4 2017')
+    manifest = Manifest(str(tmp_path), parser_version=1)
+    manifest.record(pdf_a, file_sha256(pdf_a))
+    assert manifest.duplicate_of(pdf_b, file_sha256(pdf_b)) == '2017年预算.pdf'
+    manifest.record(pdf_b, file_sha256(pdf_b), duplicate_of='2017年预算.pdf')
+    assert manifest.is_unchanged(pdf_b)
+    # 原文件内容变化后, 重复文件需要重新解析
+    _write_pdf(pdf_a, b'%PDF-1.4 2017 changed')
+    manifest.record(pdf_a, file_sha256(pdf_a))
+    assert not manifest.is_unchanged(pdf_b)
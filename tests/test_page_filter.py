@@ -0,0 +1,31 @@
+import os
+
+from open_budget.parser.page_filter import find_pages, select_pages
+from open_budget.parser.pdf_parser import BalanceParser
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+
+head_keywords = BalanceParser.head_keywords
+tail_keywords = BalanceParser.tail_keywords
+
+
+def test_find_pages():
+    pages_text = ['目录', '收入支出项目名称功能分类收入合计支出合计', '说明']
+    assert find_pages(pages_text, head_keywords, tail_keywords) == [2]
+
+
+def test_find_pages_following():
+    # 表格跨页, 加入后面的页直到找到表尾
+    pages_text = ['收入支出项目名称功能分类', '一般公共服务支出', '收入合计支出合计', '说明']
+    assert find_pages(pages_text, head_keywords, tail_keywords) == [1, 2, 3]
+    # 最多加入max_following页
+    pages_text = ['收入支出项目名称功能分类'] + ['支出'] * 5
+    assert find_pages(pages_text, head_keywords, tail_keywords, max_following=3) == [1, 2, 3, 4]
+    assert find_pages(pages_text[:2], head_keywords, tail_keywords) == [1, 2]
+
+
+def test_select_pages():
+    pages, total = select_pages(os.path.join(PDF_DIR, '江苏省人民检察院', '2019年度部门预算公开.pdf'),
+                                [(head_keywords, tail_keywords)])
+    assert pages == '14'
+    assert total == 33
@@ -0,0 +1,44 @@
+import pandas as pd
+from open_budget.parser.parquet_store import ParquetStore, to_long
+
+
+def _parsed_df():
+    return pd.DataFrame([[24169.74, 16593.12, None], [21940.96, 16458.75, 14.39]],
+                        index=[pd.datetime(2019, 1, 1), pd.datetime(2018, 1, 1)],
+                        columns=['财政拨款', '公共安全支出', '其他资金'])
+
+
+def test_to_long():
+    long = to_long('收支预算总表', _parsed_df())
+    assert list(long.columns) == ['year', 'table', 'item', 'amount']
+    assert len(long) == 5   # 去掉了nan
+    assert long[long['year'] == 2018]['amount'].sum() == 21940.96 + 16458.75 + 14.39
+
+
+def test_store(tmp_path):
+    store = ParquetStore(str(tmp_path / 'jszwfw.parquet'))
+    store.write('江苏省人民检察院', {'收支预算总表': _parsed_df()})
+    store.write('江苏省委办公厅', {'收支预算总表': _parsed_df().iloc[:1]})
+    assert store.departments() == ['江苏省人民检察院', '江苏省委办公厅']
+
+    df = store.read()
+    assert set(df.columns) == {'department', 'year', 'table', 'item', 'amount'}
+    assert len(df) == 7
+    assert isinstance(df['item'].dtype, pd.CategoricalDtype)
+    assert df['amount'].dtype == 'float64'
+
+    df = store.read(columns=['department', 'amount'], years=[2018])
+    assert list(df.columns) == ['department', 'amount']
+    assert list(df['department']) == ['江苏省人民检察院'] * 3
+
+    wide = store.read_dept('江苏省人民检察院', '收支预算总表')
+    assert wide.equals(_parsed_df().sort_index())
+
+
+def test_store_overwrite(tmp_path):
+    store = ParquetStore(str(tmp_path / 'jszwfw.parquet'))
+    store.write('江苏省人民检察院', {'收支预算总表': _parsed_df()})
+    store.write('江苏省人民检察院', {'收支预算总表': _parsed_df().iloc[:1]})
+    assert sorted(store.read(columns=['year'])['year'].unique()) == [2019]
+    store.write('江苏省人民检察院', {})
+    assert store.departments() == []
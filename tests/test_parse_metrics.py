@@ -0,0 +1,56 @@
+import json
+import os
+import pickle
+from click.testing import CliRunner
+from open_budget.parser.parse_metrics import ParseMetrics
+from open_budget.parser.pdf_parser import DeptFilesParser, parse_dept_file, run
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+DEPT = '江苏省人民检察院'
+
+
+def test_metrics_merge():
+    metrics = ParseMetrics()
+    with metrics.file('a.pdf'):
+        with metrics.timer('camelot'):
+            metrics.count('tables_extracted', 3)
+    metrics.count('cells_repaired')     # 不在文件范围内, 记在部门上
+    other = pickle.loads(pickle.dumps(metrics))
+    metrics.merge(other)
+    assert metrics.counter('tables_extracted') == 6
+    data = metrics.to_dict()
+    assert list(data['files']) == ['a.pdf']
+    assert data['totals']['counters'] == {'tables_extracted': 6, 'cells_repaired': 2}
+    assert data['files']['a.pdf']['timers']['camelot'] >= 0
+
+
+def test_parse_metrics():
+    path = os.path.join(PDF_DIR, DEPT)
+    parser = DeptFilesParser(DEPT, path)
+    parser.parse()
+    files = parser.metrics.to_dict()['files']
+    assert sorted(files) == sorted(name for name in os.listdir(path) if name.endswith('.pdf'))
+    for stats in files.values():
+        assert stats['counters']['pages_parsed'] <= stats['counters']['pages_scanned']
+        assert stats['counters']['tables_matched.收支预算总表'] >= 1
+        assert {'select_pages', 'camelot', 'parse', 'get_df', 'correct'} <= set(stats['timers'])
+    assert parser.pages_total == parser.metrics.counter('pages_scanned')
+
+    # 进程池返回的统计合并后和串行解析一致
+    merged = DeptFilesParser(DEPT, path)
+    for file_path, year in merged.pending_files():
+        merged.merge(parse_dept_file(DEPT, path, file_path, year))
+    assert merged.metrics.totals()['counters'] == parser.metrics.totals()['counters']
+
+
+def test_cli_metrics(tmp_path):
+    metrics_path = str(tmp_path / 'metrics.json')
+    profile_dir = str(tmp_path / 'profiles')
+    result = CliRunner().invoke(run, [os.path.join(PDF_DIR, DEPT), '--output', 'csv', '--full',
+                                      '--metrics', metrics_path, '--profile', profile_dir])
+    assert result.exit_code == 0
+    with open(metrics_path, encoding='utf-8') as f:
+        data = json.load(f)
+    dept = data['departments'][DEPT]
+    assert 'to_csv' in dept['totals']['timers']
+    assert len(os.listdir(profile_dir)) == len(dept['files'])
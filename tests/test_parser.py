@@ -1,16 +1,31 @@
-from open_budget.parser.pdf_parser import run, BaseParser
+import os
+import shutil
+
+import pandas as pd
+import pytest
+from open_budget.parser.pdf_parser import run, BaseParser, BalanceParser, DeptFilesParser, PARSER_TYPES, \
+    register_parser
+from open_budget.parser.table_cache import CachedTable
 from click.testing import CliRunner
 
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+
 
 def test_parse_single_dept():
     runner = CliRunner()
-    result = runner.invoke(run, ['../pdf_files/jszwfw/江苏省人民检察院'])
+    result = runner.invoke(run, [os.path.join(PDF_DIR, '江苏省人民检察院')])
+    assert result.exit_code == 0
+
+
+def test_parse_single_dept_jobs():
+    runner = CliRunner()
+    result = runner.invoke(run, [os.path.join(PDF_DIR, '江苏省人民检察院'), '--jobs', '3', '--full'])
     assert result.exit_code == 0
 
 
 def test_parse_all_dept():
     runner = CliRunner()
-    result = runner.invoke(run, ['../pdf_files/jszwfw'])
+    result = runner.invoke(run, [PDF_DIR])
     assert result.exit_code == 0
 
 
@@ -28,3 +43,127 @@ def test_base_parser():
     assert r2 is False
     assert t2 is None
     assert parser.split_merge_cell('24,458.43十二、财政专户管理资金')[1] == ('24,458.43', '十二、财政专户管理资金')
+
+
+def test_correct_wrong_new_line():
+    df = pd.DataFrame([[1.0, None, 3.0, 4.0], [None, 2.0, 3.0, None]],
+                      columns=['一般公共服务支出', '一般公共服务', '财政拨款', '财政'])
+    BaseParser.correct_wrong_new_line(df)
+    assert list(df.columns) == ['一般公共服务支出', '财政拨款', '财政']
+    assert list(df['一般公共服务支出']) == [1.0, 2.0]
+
+
+def test_correct_wrong_new_line_per_year():
+    """ 每合并一年纠正一次, 和逐年合并一样; 一次纠正所有年度时, 2019年的两列会阻止2017, 2018年的合并 """
+    short, full = '一般公共服务', '一般公共服务支出'
+    rows = [pd.DataFrame([[1.0]], columns=[short], index=[pd.Timestamp(year=2017, month=1, day=1)]),
+            pd.DataFrame([[2.0]], columns=[full], index=[pd.Timestamp(year=2018, month=1, day=1)]),
+            pd.DataFrame([[3.0, 4.0]], columns=[short, full], index=[pd.Timestamp(year=2019, month=1, day=1)])]
+    parser = BalanceParser()
+    for row in rows:
+        parser.merge(row)
+    df = parser.parsed_df
+    assert list(df.columns) == [full, short]
+    assert list(df[full]) == [1.0, 2.0, 4.0]
+    assert df[short].isna().tolist() == [True, True, False]
+    once = BaseParser.correct_wrong_new_line(pd.concat(rows, sort=False))
+    assert list(once.columns) == [short, full]
+
+    # 分几次读取parsed_df, 结果一样
+    parser = BalanceParser()
+    for row in rows:
+        parser.merge(row)
+        parser.parsed_df
+    assert parser.parsed_df.equals(df)
+
+
+def test_correct_per_year():
+    """ 一次concat再逐年纠正, 和每合并一年调用一次correct_wrong_new_line一样, 包括合并掉的列在以后年度又出现 """
+    rows = [pd.DataFrame([[1.0, None, 5.0]], columns=['一般', '一般公共', '一般公共服务'], index=[2016]),
+            pd.DataFrame([[None, 2.0, None]], columns=['一般', '一般公共', '财政'], index=[2017]),
+            pd.DataFrame([[3.0, 4.0]], columns=['财政拨款', '一般公共'], index=[2018]),
+            pd.DataFrame([[6.0, None], [None, 7.0]], columns=['财政', '财政拨款'], index=[2019, 2020])]
+    expected = None
+    for row in rows:
+        expected = row if expected is None else pd.concat([expected, row], sort=False)
+        expected = BaseParser.correct_wrong_new_line(expected)
+    df = BaseParser.correct_per_year(None, rows)
+    assert list(df.columns) == list(expected.columns)
+    assert df.equals(expected)
+    df = BaseParser.correct_per_year(BaseParser.correct_per_year(None, rows[:2]), rows[2:])
+    assert df.equals(expected)
+
+
+class _FakeParser(BaseParser):
+    """ 第一行是('甲', '乙')的表, 和后面一个table合并 """
+    table_name = '测试表'
+    head_signature = ('甲', '乙')
+
+    def has_tail(self, df):
+        return False
+
+    def parse(self, tables, table_index, year):
+        if not self.has_head(tables[table_index].df) or table_index + 1 >= len(tables):
+            return table_index
+        self.merge(pd.DataFrame([[1.0]], index=[pd.Timestamp(year=year, month=1, day=1)], columns=['合计']))
+        return table_index + 2
+
+
+def test_parser_dispatch(monkeypatch):
+    monkeypatch.setitem(PARSER_TYPES, _FakeParser.head_signature, _FakeParser)
+    parser = DeptFilesParser('测试', '.')
+    assert [type(p) for p in parser.parsers] == [BalanceParser, _FakeParser]
+    # '收 入'去掉空白后和收支预算总表的签名一样; ('甲', '乙')后面的table是合并到测试表的, 不再分派
+    balance_head = [['收入', '收入', '支出', '支出', '支出', '支出'],
+                    ['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途'],
+                    ['', '', '功能科目名称', '金额', '项目名称', '金额'],
+                    ['一般公共预算', '24,458.43', '一般公共服务支出', '1,364.00', '基本支出', '20,153.75']]
+    balance_tail = [['收入合计', '24,458.43', '支出合计', '24,458.43', '', '']]
+    tables = [CachedTable('1', balance_head), CachedTable('2', balance_tail),
+              CachedTable('3', [['甲', ' 乙'], ['1', '2']]),
+              CachedTable('4', [['收 入', '收入', '支出', '支出', '支出', '支出']])]
+    parser.parse_tables(tables, 'a2019.pdf', 2019)
+    counters = parser.metrics.counter
+    assert counters('tables_matched.收支预算总表') == 2
+    assert counters('tables_matched.测试表') == 2
+    assert counters('tables_unmatched') == 0
+    assert parser.parsed_files['a2019.pdf'] == {'收支预算总表': [2019], '测试表': [2019]}
+
+
+def test_register_parser(monkeypatch):
+    monkeypatch.setattr('open_budget.parser.pdf_parser.PARSER_TYPES', dict(PARSER_TYPES))
+    assert register_parser(BalanceParser) is BalanceParser
+    with pytest.raises(ValueError):
+        register_parser(type('SameHeadParser', (BalanceParser,), {}))
+    with pytest.raises(ValueError):
+        register_parser(type('NoHeadParser', (BaseParser,), {}))
+
+
+def _parse_incremental(dept_dir):
+    parser = DeptFilesParser('测试', str(dept_dir), incremental=True, backend='vector')
+    pending = parser.pending_files()
+    for file_path, year in pending:
+        parser._parse_file(file_path, year)
+    parser.to_csv()
+    parser.save_manifest()
+    return parser, sorted(os.path.basename(file_path) for file_path, _ in pending)
+
+
+def test_incremental_same_year(tmp_path):
+    """ 同一年度有两个文件, 修改其中一个: 这个年度不从csv读取旧的行, 另一个文件也重新解析, 这个年度没有重复的行 """
+    src = os.path.join(PDF_DIR, '江苏省委办公厅')
+    a, b = tmp_path / '甲2017年预算.pdf', tmp_path / '乙2017年预算.pdf'
+    shutil.copy(os.path.join(src, '江苏省委办公厅2017年预算公开表格.pdf'), a)
+    shutil.copy(os.path.join(src, '江苏省委办公厅2018年度部门预算公开表.pdf'), b)
+    parser, _ = _parse_incremental(tmp_path)
+    totals = sorted(parser.parsers[0].parsed_df.iloc[:, 0])
+    assert totals == [20702.25, 24458.43]
+
+    shutil.copy(os.path.join(src, '江苏省委办公厅2019年度部门预算公开表格.pdf'), a)
+    parser, pending = _parse_incremental(tmp_path)
+    assert pending == sorted([a.name, b.name])
+    df = pd.read_csv(parser.parsers[0].csv_path(str(tmp_path)), index_col=0, parse_dates=True)
+    assert sorted(df.iloc[:, 0]) == [24458.43, 27664.22]
+    assert list(df.index.year) == [2017, 2017]
+    # 没有变化时不再解析
+    assert _parse_incremental(tmp_path)[1] == []
@@ -0,0 +1,157 @@
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from open_budget.parser.page_filter import count_pages
+from open_budget.parser.pdf_parser import DeptFilesParser, ExtractError, ParseError, run
+from open_budget.parser.quarantine import Quarantine, call_with_timeout, repair_pdf
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+DEPT = '江苏省人民检察院'
+GOOD = '2019年度部门预算公开.pdf'
+BAD = '2018年省检察院部门预算公开.pdf'
+
+
+def _dept_dir(tmp_path):
+    """ 一个正常的pdf和一个损坏的pdf """
+    dept_dir = tmp_path / DEPT
+    dept_dir.mkdir()
+    shutil.copy(os.path.join(PDF_DIR, DEPT, GOOD), dept_dir)
+    with open(dept_dir / BAD, 'wb') as f:
+        f.write(b'%PDF-1.4 broken')
+    return dept_dir
+
+
+def test_quarantine(tmp_path):
+    quarantine = Quarantine(str(tmp_path))
+    quarantine.update({'a.pdf': {'error': 'ValueError'}, 'b.pdf': {'error': 'KeyError'}}, [])
+    quarantine.save()
+    quarantine = Quarantine(str(tmp_path))
+    assert sorted(quarantine.files) == ['a.pdf', 'b.pdf']
+    quarantine.update({}, ['a.pdf'])
+    quarantine.retain(['a.pdf'])
+    assert quarantine.files == {}
+    quarantine.save()
+    assert not os.path.exists(quarantine.file_path)
+
+
+def test_repair_pdf(tmp_path):
+    file_path = os.path.join(PDF_DIR, DEPT, GOOD)
+    repaired = repair_pdf(file_path, str(tmp_path))
+    assert count_pages(repaired) == count_pages(file_path)
+    with open(tmp_path / 'broken.pdf', 'wb') as f:
+        f.write(b'not a pdf')
+    assert repair_pdf(str(tmp_path / 'broken.pdf'), str(tmp_path / 'out')) is None
+
+
+def test_call_with_timeout():
+    assert call_with_timeout(pow, (2, 10), 10) == 1024
+    start = time.time()
+    with pytest.raises(multiprocessing.TimeoutError):
+        call_with_timeout(time.sleep, (30,), 1)
+    assert time.time() - start < 10
+
+
+def test_recover_repaired(monkeypatch, tmp_path):
+    """ 第一次提取出错的文件, 修复后在子进程里重新提取, 解析结果和正常解析一样 """
+    path = os.path.join(PDF_DIR, DEPT)
+    expected = DeptFilesParser(DEPT, path)
+    expected.parse()
+
+    def fail(self, file_path):
+        raise ExtractError('camelot出错')
+    monkeypatch.setattr(DeptFilesParser, '_read_tables', fail)
+    parser = DeptFilesParser(DEPT, path)
+    parser.parse()
+    assert parser.failures == {}
+    assert parser.metrics.counter('files_repaired') == len(parser.list_files())
+    assert parser.parsers[0].parsed_df.sort_index().equals(expected.parsers[0].parsed_df.sort_index())
+
+
+def test_parse_error_not_repaired(monkeypatch):
+    """ 解析table出错(表头对不上)的文件不修复, 直接放进隔离区 """
+    def no_repair(file_path, out_dir):
+        raise AssertionError('不应该修复')
+    monkeypatch.setattr('open_budget.parser.pdf_parser.repair_pdf', no_repair)
+
+    def wrong_header(self, tables, table_index, year):
+        raise ParseError('收支预算总表第2行表头对不上', ['项目', '金额'])
+    monkeypatch.setattr('open_budget.parser.pdf_parser.BalanceParser.parse', wrong_header)
+    parser = DeptFilesParser(DEPT, os.path.join(PDF_DIR, DEPT))
+    parser._parse_file(os.path.join(PDF_DIR, DEPT, GOOD), 2019)
+    report = parser.failures[GOOD]
+    assert (report['stage'], report['error'], report['repaired']) == ('parse', 'ParseError', False)
+    assert parser.metrics.counter('files_quarantined') == 1
+    assert parser.parsed_files == {}
+
+
+def test_parse_error_header():
+    error = pickle.loads(pickle.dumps(ParseError('表头对不上', ['项目', '金额'])))
+    assert (str(error), error.header) == ('表头对不上', ['项目', '金额'])
+
+
+def test_extract_in_process(monkeypatch):
+    """ 第一次提取在本进程里, --profile能看到camelot的耗时 """
+    pids = []
+    read_pdf = DeptFilesParser._read_pdf
+
+    def record(self, file_path):
+        pids.append(os.getpid())
+        return read_pdf(self, file_path)
+    monkeypatch.setattr(DeptFilesParser, '_read_pdf', record)
+    parser = DeptFilesParser(DEPT, os.path.join(PDF_DIR, DEPT))
+    parser._parse_file(os.path.join(PDF_DIR, DEPT, GOOD), 2019)
+    assert pids == [os.getpid()]
+    assert parser.failures == {}
+
+
+def test_repair_timeout(monkeypatch, tmp_path):
+    """ 修复后在子进程里重新提取, 最多等待timeout秒 """
+    def fail(self, file_path):
+        raise ExtractError('camelot出错')
+    monkeypatch.setattr(DeptFilesParser, '_read_tables', fail)
+    monkeypatch.setattr(DeptFilesParser, '_read_pdf', lambda self, file_path: time.sleep(30))
+    monkeypatch.setattr('open_budget.parser.pdf_parser.repair_pdf', lambda file_path, out_dir: file_path)
+    dept_dir = _dept_dir(tmp_path)
+    parser = DeptFilesParser(DEPT, str(dept_dir), timeout=1)
+    start = time.time()
+    parser._parse_file(str(dept_dir / GOOD), 2019)
+    assert time.time() - start < 10
+    report = parser.failures[GOOD]
+    assert (report['stage'], report['repaired']) == ('extract', True)
+    assert '超过1秒' in report['message']
+
+
+def test_quarantine_rerun(tmp_path):
+    dept_dir = _dept_dir(tmp_path)
+    failures_path = str(tmp_path / 'failures.json')
+    result = CliRunner().invoke(run, [str(dept_dir), '--no-cache', '--output', 'csv', '--failures', failures_path])
+    assert result.exit_code == 0
+    assert '已隔离' in result.output
+    with open(failures_path, encoding='utf-8') as f:
+        report = json.load(f)[DEPT][BAD]
+    assert report['stage'] == 'extract'
+    assert report['year'] == 2018
+    assert not report['repaired']
+    assert list(Quarantine(str(dept_dir)).files) == [BAD]
+
+    # 没有变化的文件不再解析, --quarantined只解析隔离区里的文件
+    parser = DeptFilesParser(DEPT, str(dept_dir), incremental=True)
+    assert parser.pending_files() == []
+    parser = DeptFilesParser(DEPT, str(dept_dir), incremental=True, quarantined=True)
+    assert [os.path.basename(file_path) for file_path, _ in parser.pending_files()] == [BAD]
+
+    # 换成正常的文件后重新解析, 移出隔离区, 合并到已有的csv
+    shutil.copy(os.path.join(PDF_DIR, DEPT, BAD), dept_dir)
+    result = CliRunner().invoke(run, [str(dept_dir), '--no-cache', '--output', 'csv', '--quarantined'])
+    assert result.exit_code == 0
+    assert Quarantine(str(dept_dir)).files == {}
+    parser = DeptFilesParser(DEPT, str(dept_dir), incremental=True)
+    assert parser.pending_files() == []
+    assert sorted(parser.parsers[0].parsed_df.index.year) == [2018, 2019]
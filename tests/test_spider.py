@@ -1,5 +1,24 @@
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+import requests
 from click.testing import CliRunner
-from open_budget.spider.jszwfw_spider import run, JszwfwSpider
+from open_budget.spider.jszwfw_spider import run, JszwfwSpider, FastJszwfwSpider, Link
+
+# 离线测试用的网站页面: 首页, 部门列表, 部门页, 附件页
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'jszwfw')
+PDF = b'%PDF-1.4 test'
+CHROMEDRIVER = shutil.which('chromedriver')
+HUB_URL = 'http://127.0.0.1:4444/wd/hub'
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
 
 
 def test_cli():
@@ -14,3 +33,175 @@ def test_run():
     spider.quit()
     if spider.error_msg:
         print(spider.error_msg)
+
+
+@pytest.fixture
+def webdriver_args(request):
+    """ 爬取真实网站用的WebDriver服务器: selenium远程服务器, 没有时用本地的chromedriver, 都没有时跳过 """
+    try:
+        if requests.get(HUB_URL + '/status', timeout=1).ok:
+            return []
+    except requests.RequestException:
+        pass
+    if CHROMEDRIVER is None:
+        pytest.skip('需要selenium远程服务器或者本地的chromedriver和Chrome')
+    return ['--url', request.getfixturevalue('chromedriver'), '--remote_dir', PDF_DIR]
+
+
+def test_cli_workers(webdriver_args):
+    runner = CliRunner()
+    result = runner.invoke(run, [PDF_DIR, '--start', '1', '--stop', '6', '--workers', '2'] + webdriver_args)
+    assert result.exit_code == 0
+
+
+def test_cli_fast(webdriver_args):
+    runner = CliRunner()
+    result = runner.invoke(run, [PDF_DIR, '--start', '1', '--stop', '5', '--fast', '--direct'] + webdriver_args)
+    assert result.exit_code == 0
+
+
+def test_fast_capabilities():
+    capabilities = FastJszwfwSpider.capabilities('/tmp/jszwfw')
+    options = capabilities['goog:chromeOptions']
+    assert '--headless=new' in options['args']
+    assert options['prefs']['download.default_directory'] == '/tmp/jszwfw'
+    assert options['prefs']['profile.managed_default_content_settings.images'] == 2
+    assert capabilities['pageLoadStrategy'] == 'eager'
+    assert 'pageLoadStrategy' not in JszwfwSpider.capabilities('/tmp/jszwfw')
+
+
+class ScriptDriver:
+    """ 依次返回results里的execute_script结果 """
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = 0
+
+    def execute_script(self, script, *args):
+        self.calls += 1
+        return self.results.pop(0)
+
+
+def test_wait_links():
+    """ 页面没有加载好时继续等待, 没有链接的页面返回[] """
+    spider = FastJszwfwSpider.__new__(FastJszwfwSpider)
+    spider.poll_frequency = 0.01
+    spider.driver = ScriptDriver([None, [{'text': '附件1：a.pdf', 'href': 'http://x/a.pdf'}]])
+    assert spider._wait_links('#filespreview > li > a', 'filespreview', timeout=1) == \
+        [Link('附件1：a.pdf', 'http://x/a.pdf')]
+    assert spider.driver.calls == 2
+    spider.driver = ScriptDriver([None, []])
+    assert spider._wait_links('#contentTitle > li', 'mainTitle', timeout=1) == []
+    spider.driver = ScriptDriver([[Link('a', 'javascript:void(0)')._asdict()], [{'text': '部门预算公开', 'href': ''}]])
+    assert spider._wait_links('a', ready=lambda links: links[0].text == '部门预算公开', timeout=1)[0].href == ''
+
+
+class CdpDriver:
+    """ selenium 3的Remote driver: 没有execute_cdp_cmd, 通过command_executor的命令表执行 """
+    def __init__(self, command_executor):
+        self.command_executor = command_executor
+        self.executed = list()
+
+    def execute(self, command, params):
+        self.executed.append((command, params['cmd']))
+        return {'value': {}}
+
+
+def test_block_resources():
+    """ 不同selenium版本执行CDP命令的方式不同, 不支持时只是不拦截 """
+    spider = FastJszwfwSpider.__new__(FastJszwfwSpider)
+    cmds = ['Network.enable', 'Network.setBlockedURLs', 'Page.setDownloadBehavior']
+    executor = SimpleNamespace(_commands={})
+    spider.driver = CdpDriver(executor)
+    spider._block_resources('/tmp/jszwfw')
+    assert executor._commands['executeCdpCommand'] == ('POST', '/session/$sessionId/goog/cdp/execute')
+    assert spider.driver.executed == [('executeCdpCommand', cmd) for cmd in cmds]
+    # selenium 4的Chrome driver
+    executed = list()
+    spider.driver = SimpleNamespace(execute_cdp_cmd=lambda cmd, params: executed.append(cmd),
+                                    command_executor=SimpleNamespace())
+    spider._block_resources('/tmp/jszwfw')
+    assert executed == cmds
+    # 没有命令表
+    spider.driver = SimpleNamespace(command_executor=SimpleNamespace())
+    spider._block_resources('/tmp/jszwfw')
+
+
+def test_add_error():
+    """ 多个线程同时记录出错信息, 一条也不丢 """
+    spider = JszwfwSpider.__new__(JszwfwSpider)
+    spider.error_msg = ''
+    spider._error_lock = threading.Lock()
+    threads = [threading.Thread(target=lambda: [spider.add_error('下载失败') for _ in range(500)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert spider.error_msg.count('\n下载失败') == 8 * 500
+
+
+class PageHandler(SimpleHTTPRequestHandler):
+    """ 提供PAGES_DIR里的页面和一个pdf附件, 记录浏览器请求的路径 """
+    paths = list()
+
+    def do_GET(self):
+        PageHandler.paths.append(self.path)
+        if self.path == '/files/test.pdf':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(PDF)))
+            self.end_headers()
+            self.wfile.write(PDF)
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    PageHandler.paths = list()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(PageHandler, directory=PAGES_DIR))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def chromedriver():
+    """ 本地的chromedriver就是一个WebDriver服务器, 代替selenium远程服务器 """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([CHROMEDRIVER, f'--port={port}'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                if requests.get(url + '/status', timeout=1).ok:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.mark.skipif(CHROMEDRIVER is None, reason='需要本地的chromedriver和Chrome')
+def test_fast_offline(monkeypatch, site, chromedriver, tmp_path):
+    """ 快速模式爬取本地的页面: LINKS_SCRIPT读出链接, 按地址打开部门页和附件页, 样式和图片不加载 """
+    monkeypatch.setattr(FastJszwfwSpider, 'home_url', site + '/list.html')
+    spider = FastJszwfwSpider(str(tmp_path), chromedriver, str(tmp_path / 'remote'), direct=True)
+    try:
+        spider.run()
+    finally:
+        spider.quit()
+    assert spider.dept_links == [Link('江苏省测试厅', site + '/dept1.html'), Link('脚本链接部门', 'javascript:void(0)')]
+    assert (tmp_path / '江苏省测试厅' / 'test.pdf').read_bytes() == PDF
+    assert '脚本链接部门 的链接不是http地址' in spider.error_msg
+    assert [path for path in PageHandler.paths if path.endswith('.html')] == \
+        ['/list.html', '/department.html', '/dept1.html', '/page1.html']
+    assert not any(path.startswith('/static/') for path in PageHandler.paths)
@@ -0,0 +1,43 @@
+import pandas as pd
+from open_budget.parser.sqlite_index import BudgetIndex, normalize_item
+
+
+def _parsed_df():
+    return pd.DataFrame([[24169.74, 16593.12, None], [21940.96, 16458.75, 14.39]],
+                        index=[pd.datetime(2019, 1, 1), pd.datetime(2018, 1, 1)],
+                        columns=['财政拨款', '公共安全支出', '其他资金'])
+
+
+def test_normalize_item():
+    assert normalize_item('一、 财政拨款（补助）') == '一、财政拨款(补助)'
+
+
+def test_index(tmp_path):
+    index = BudgetIndex(tmp_path / 'jszwfw.sqlite')
+    index.replace_department('江苏省人民检察院', {'收支预算总表': _parsed_df()})
+    index.replace_department('江苏省委办公厅', {'收支预算总表': _parsed_df().iloc[:1] * 2})
+    assert index.departments() == ['江苏省人民检察院', '江苏省委办公厅']
+    assert index.items('收支预算总表') == sorted(['财政拨款', '公共安全支出', '其他资金'])
+
+    total = index.total_by_year('收支预算总表', '财政拨款')
+    assert list(total['year']) == [2018, 2019]
+    assert list(total['amount']) == [21940.96, 24169.74 * 3]
+    assert list(total['departments']) == [1, 2]
+
+    top = index.top_departments('收支预算总表', '财政拨款', 2019, n=1)
+    assert list(top['department']) == ['江苏省委办公厅']
+
+    yoy = index.year_over_year('收支预算总表', '财政拨款', '江苏省人民检察院')
+    assert list(yoy['year']) == [2018, 2019]
+    assert pd.isna(yoy['growth'][0])
+    assert abs(yoy['growth'][1] - (24169.74 / 21940.96 - 1)) < 1e-9
+    assert len(index.year_over_year('收支预算总表', '财政拨款')) == 3
+
+
+def test_index_replace(tmp_path):
+    index = BudgetIndex(tmp_path / 'jszwfw.sqlite')
+    index.replace_department('江苏省人民检察院', {'收支预算总表': _parsed_df()})
+    index.replace_department('江苏省人民检察院', {'收支预算总表': _parsed_df().iloc[:1]})
+    assert list(index.total_by_year('收支预算总表', '财政拨款')['year']) == [2019]
+    index.replace_department('江苏省人民检察院', {})
+    assert index.departments() == []
@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+from open_budget.parser.table_cache import TableCache, CachedTable
+
+
+def _write_pdf(path, content: bytes):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def test_cache_hit(tmp_path):
+    cache = TableCache(str(tmp_path / 'cache'))
+    pdf = _write_pdf(tmp_path / 'a.pdf', b'%PDF-1.4 a')
+    key = cache.key(pdf, {'pages': 'all'})
+    assert cache.get(key) is None
+
+    tables = [CachedTable('1', [['收入', '支出'], ['24,458.43', '']])]
+    cache.put(key, tables)
+    cached = cache.get(key)
+    assert len(cached) == 1
+    assert cached[0].page == '1'
+    assert cached[0].df.equals(pd.DataFrame([['收入', '支出'], ['24,458.43', '']]))
+
+
+def test_cache_key(tmp_path):
+    pdf_a = _write_pdf(tmp_path / 'a.pdf', b'%PDF-1.4 a')
+    pdf_b = _write_pdf(tmp_path / 'b.pdf', b'%PDF-1.4 a')
+    pdf_c = _write_pdf(tmp_path / 'c.pdf', b'%PDF-1.4 c')
+    assert TableCache.key(pdf_a, {'pages': 'all'}) == TableCache.key(pdf_b, {'pages': 'all'})
+    assert TableCache.key(pdf_a, {'pages': 'all'}) != TableCache.key(pdf_c, {'pages': 'all'})
+    assert TableCache.key(pdf_a, {'pages': 'all'}) != TableCache.key(pdf_a, {'pages': '1'})
+
+
+def test_cache_refresh(tmp_path):
+    cache = TableCache(str(tmp_path / 'cache'))
+    cache.put('k', [CachedTable('1', [['a']])])
+    assert TableCache(str(tmp_path / 'cache'), refresh=True).get('k') is None
+    assert cache.get('k') is not None
+
+
+def test_cache_evict(tmp_path):
+    cache = TableCache(str(tmp_path / 'cache'))
+    cache.put('k1', [CachedTable('1', [['a']])])
+    cache.max_size = os.path.getsize(cache._path('k1')) * 2
+    cache.put('k2', [CachedTable('1', [['a']])])
+    os.utime(cache._path('k1'), (1, 1))
+    os.utime(cache._path('k2'), (2, 2))
+    cache.get('k1')     # k1变成最近访问的
+    cache.put('k3', [CachedTable('1', [['a']])])
+    assert cache.get('k1') is not None
+    assert cache.get('k2') is None
+    assert cache.get('k3') is not None
+
+
+def test_cache_stream(tmp_path):
+    cache = TableCache(str(tmp_path / 'cache'))
+    tables = [CachedTable('1', [['a']]), CachedTable('2', [['b']])]
+    # 没有读完时不写入缓存
+    tee = cache.tee('k', tables)
+    assert next(tee) is tables[0]
+    tee.close()
+    assert cache.stream('k') is None
+    assert list(cache.tee('k', tables)) == tables
+    assert [(table.page, table.df.iat[0, 0]) for table in cache.stream('k')] == [('1', 'a'), ('2', 'b')]
+
+
+def test_cache_corrupted(tmp_path):
+    cache = TableCache(str(tmp_path / 'cache'))
+    cache.put('k', [CachedTable('1', [['a']])])
+    with open(cache._path('k'), 'r+b') as f:
+        f.seek(-4, os.SEEK_END)
+        f.write(b'\0\0\0\0')    # gzip末尾的长度校验不对
+    assert cache.get('k') is None
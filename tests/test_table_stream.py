@@ -0,0 +1,95 @@
+import gc
+import os
+import weakref
+
+import pytest
+from click.testing import CliRunner
+
+from open_budget.parser.pdf_parser import DeptFilesParser, run
+from open_budget.parser.table_cache import CachedTable, TableCache
+from open_budget.parser.table_stream import TableWindow, page_batches
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+DEPT = '江苏省人民检察院'
+
+BALANCE = [['收入', '收入', '支出', '支出', '支出', '支出'],
+           ['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途'],
+           ['', '', '功能科目名称', '金额', '项目名称', '金额'],
+           ['一、一般公共预算', '100.00', '一般公共服务支出', '60.00', '一、基本支出', '70.00'],
+           ['', '', '公共安全支出', '40.00', '二、项目支出', '30.00'],
+           ['收入合计', '100.00', '支出合计', '100.00', '', '']]
+
+
+def _split_tables(noise):
+    """ 逐个生成table: 前面noise个不相关的table, 后面是跨两页的收支预算总表 """
+    for page in range(1, noise + 1):
+        yield CachedTable(str(page), [['说明', f'第{page}页']])
+    yield CachedTable(str(noise + 1), BALANCE[:4])
+    yield CachedTable(str(noise + 2), BALANCE[4:])
+
+
+def test_table_window():
+    tables = TableWindow(iter('abcdef'))
+    assert tables[1] == 'b'
+    assert tables.consumed == 2
+    tables.release(1)
+    with pytest.raises(IndexError):
+        tables[0]
+    assert tables[4] == 'e'
+    assert tables.peak == 4
+    with pytest.raises(IndexError):
+        tables[6]
+    assert tables.consumed == 6
+
+
+def test_page_batches():
+    assert list(page_batches('7,8,9,12', 0, 3)) == ['7,8,9', '12']
+    assert list(page_batches('all', 5, 2)) == ['1,2', '3,4', '5']
+    assert list(page_batches('', 5, 2)) == []
+
+
+def test_stream_releases_tables():
+    """ 流式解析时, 前面的table解析完就释放, 同时存在的table不超过get_df向后查看的数量 """
+    alive = list()
+    max_alive = list()
+
+    def generate():
+        for table in _split_tables(50):
+            gc.collect()
+            max_alive.append(sum(ref() is not None for ref in alive))
+            alive.append(weakref.ref(table))
+            yield table
+            del table
+
+    streamed = DeptFilesParser('test', '.')
+    streamed.parse_tables(generate(), 'test2019.pdf', 2019)
+    assert max(max_alive) <= 4
+    assert streamed.metrics.counter('tables_extracted') == 52
+
+    parser = DeptFilesParser('test', '.')
+    parser.parse_tables(list(_split_tables(50)), 'test2019.pdf', 2019)
+    assert streamed.parsers[0].parsed_df.equals(parser.parsers[0].parsed_df)
+    assert streamed.parsed_files == {'test2019.pdf': {'收支预算总表': [2019]}}
+
+
+@pytest.mark.parametrize('backend', ['camelot', 'vector'])
+def test_stream_parse(tmp_path, backend):
+    path = os.path.join(PDF_DIR, DEPT)
+    parser = DeptFilesParser(DEPT, path, backend=backend)
+    parser.parse()
+    expected = parser.parsers[0].parsed_df
+    cache = TableCache(str(tmp_path / 'cache'))
+    for filter_pages in (True, False):
+        for i in range(2):     # 第一次边解析边写缓存, 第二次流式读取缓存
+            streamed = DeptFilesParser(DEPT, path, cache, filter_pages, backend=backend, batch_pages=2)
+            streamed.parse()
+            assert streamed.parsers[0].parsed_df.equals(expected)
+            assert streamed.metrics.counter('cache_hits') == (len(streamed.list_files()) if i else 0)
+
+
+def test_cli_batch_pages():
+    result = CliRunner().invoke(run, [os.path.join(PDF_DIR, DEPT), '--batch-pages', '0'])
+    assert 'Invalid' in result.output
+    result = CliRunner().invoke(run, [os.path.join(PDF_DIR, DEPT), '--batch-pages', '3', '--backend', 'vector',
+                                      '--no-cache', '--full', '--output', 'csv'])
+    assert result.exit_code == 0
@@ -0,0 +1,162 @@
+import os
+import shutil
+
+import camelot
+from click.testing import CliRunner
+
+from open_budget.parser.parse_profile import load_profile, profile_path, save_profile
+from open_budget.parser.page_filter import select_pages
+from open_budget.parser.pdf_parser import READ_PDF_KWARGS, BalanceParser, DeptFilesParser
+from open_budget.parser.table_cache import TableCache
+from open_budget.parser.tune_params import PARAM_GRID, candidates, extract_tables, load_samples, render_pages, run, \
+    score_parallel
+from open_budget.parser.vector_lattice import read_pdf
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+DEPT = '江苏省高级人民法院'
+FILE = '江苏省高级人民法院2019年度部门预算公开.pdf'
+# 字符间距太大, 相邻单元格的文字合成一行
+BAD_PROFILE = {'layout_kwargs': {'char_margin': 3.0}}
+
+
+def _dept_dir(tmp_path):
+    dept_dir = tmp_path / DEPT
+    dept_dir.mkdir()
+    shutil.copy(os.path.join(PDF_DIR, DEPT, FILE), dept_dir)
+    return dept_dir
+
+
+def _balance_df():
+    parser = BalanceParser()
+    tables = read_pdf(os.path.join(PDF_DIR, DEPT, FILE), 'all', READ_PDF_KWARGS['layout_kwargs'],
+                      READ_PDF_KWARGS['copy_text'], READ_PDF_KWARGS['strip_text'])
+    for i in range(len(tables)):
+        df, _ = parser.get_df(tables, i)
+        if df is not None:
+            parser.correct(df)
+            return df
+
+
+def test_reconcile():
+    df = _balance_df()
+    assert BalanceParser().reconcile(df) == 3
+    # 一级项目的金额错了, 收入这一组对不上
+    row = df.index[df.iloc[:, 0].str.startswith('一、')][0]
+    df.iat[row, 1] = '1.00'
+    assert BalanceParser().reconcile(df) == 2
+
+
+def test_candidates():
+    params_list = candidates(PARAM_GRID)
+    assert params_list[0] == {'layout_kwargs': READ_PDF_KWARGS['layout_kwargs'], 'copy_text': ['h'],
+                              'strip_text': '\n'}
+    assert len(params_list) == 4 * 3 * 3 * 2 * 2
+    assert all(params not in params_list[:k] for k, params in enumerate(params_list))
+    params_list = candidates(PARAM_GRID, BAD_PROFILE, trials=10)
+    assert len(params_list) == 10
+    assert params_list[1]['layout_kwargs'] == dict(READ_PDF_KWARGS['layout_kwargs'], char_margin=3.0)
+
+
+def test_score(tmp_path):
+    parser = DeptFilesParser(DEPT, str(_dept_dir(tmp_path)))
+    samples = load_samples(parser)
+    assert [name for name, _ in samples] == [FILE]
+    params_list = candidates(PARAM_GRID, BAD_PROFILE, trials=3)
+    # 并行和串行的得分一样. 默认参数: 表头, 表尾, 三组合计都对得上
+    scores = score_parallel(samples, params_list, 2)
+    assert scores == score_parallel(samples, params_list, 1)
+    assert scores[0] == 5
+    assert scores[1] < scores[0]
+    # vector后端的得分
+    samples = load_samples(DeptFilesParser(DEPT, str(tmp_path / DEPT), backend='vector'))
+    assert [lines for _, _, lines in samples[0][1]] == [None]
+    assert score_parallel(samples, params_list, 1)[0] == 5
+
+
+def test_extract_camelot():
+    """ 用缓存的表格线提取出来的table, 和camelot.read_pdf提取的一样 """
+    file_path = os.path.join(PDF_DIR, DEPT, FILE)
+    pages, _ = select_pages(file_path, DeptFilesParser(DEPT, os.path.join(PDF_DIR, DEPT))._page_keywords())
+    layouts = render_pages(file_path, pages)
+    for params in candidates(PARAM_GRID, BAD_PROFILE, trials=3):
+        tables = extract_tables(layouts, params)
+        expected = camelot.read_pdf(file_path, **dict(READ_PDF_KWARGS, pages=pages, **params))
+        assert tables
+        assert [(table.page, table.df.values.tolist()) for table in tables] == \
+               [(int(table.page), table.df.values.tolist()) for table in expected]
+
+
+def test_score_error(monkeypatch, tmp_path):
+    """ 一组参数解析table出错时得0分, 其他参数照常打分 """
+    samples = load_samples(DeptFilesParser(DEPT, str(_dept_dir(tmp_path))))
+    params_list = candidates(PARAM_GRID, trials=3)
+    calls = list()
+    correct = BalanceParser.correct
+
+    def failing_correct(df):
+        calls.append(df)
+        if len(calls) == 2:
+            raise ValueError('odd table')
+        return correct(df)
+
+    monkeypatch.setattr(BalanceParser, 'correct', staticmethod(failing_correct))
+    scores = score_parallel(samples, params_list, 1)
+    assert scores[0] == 5
+    assert scores[1] == 0
+    assert scores[2] > 0
+
+
+def test_profile(tmp_path):
+    """ 部门目录下的参数配置自动生效, 改变缓存key, 配置变化后增量解析重新解析所有文件 """
+    dept_dir = _dept_dir(tmp_path)
+    cache = TableCache(str(tmp_path / 'cache'))
+    parser = DeptFilesParser(DEPT, str(dept_dir), cache, incremental=True)
+    assert parser.read_kwargs == READ_PDF_KWARGS
+    key = parser._cache_key(str(dept_dir / FILE))
+    parser.parse()
+    parser.to_csv()
+    parser.save_manifest()
+    assert DeptFilesParser(DEPT, str(dept_dir), incremental=True).pending_files() == []
+
+    save_profile(str(dept_dir), dict(READ_PDF_KWARGS, **BAD_PROFILE), {'score': 0}, 'camelot')
+    assert load_profile(str(dept_dir)) == {'layout_kwargs': BAD_PROFILE['layout_kwargs'], 'copy_text': ['h'],
+                                           'strip_text': '\n'}
+    # 只用在调优时的backend上
+    assert load_profile(str(dept_dir), 'vector') == {}
+    assert DeptFilesParser(DEPT, str(dept_dir), backend='vector').read_kwargs == READ_PDF_KWARGS
+    parser = DeptFilesParser(DEPT, str(dept_dir), cache, incremental=True)
+    assert parser.read_kwargs['layout_kwargs']['char_margin'] == 3.0
+    assert parser.read_kwargs['layout_kwargs']['line_margin'] == READ_PDF_KWARGS['layout_kwargs']['line_margin']
+    assert parser._cache_key(str(dept_dir / FILE)) != key
+    assert len(parser.pending_files()) == 1
+
+
+def test_cli(tmp_path):
+    """ 默认参数最好时, 删除不合适的配置 """
+    dept_dir = _dept_dir(tmp_path)
+    save_profile(str(dept_dir), dict(READ_PDF_KWARGS, **BAD_PROFILE), {'score': 0}, 'camelot')
+    # 不删除为别的backend调优的配置
+    result = CliRunner().invoke(run, [str(dept_dir), '--trials', '2', '--backend', 'vector'])
+    assert result.exit_code == 0
+    assert '默认参数5分, 最好5分' in result.output
+    assert '删除参数配置' not in result.output
+    result = CliRunner().invoke(run, [str(dept_dir), '--trials', '4', '--dry-run'])
+    assert result.exit_code == 0
+    assert '默认参数5分, 最好5分' in result.output
+    assert os.path.exists(profile_path(str(dept_dir)))
+    result = CliRunner().invoke(run, [str(dept_dir), '--trials', '4', '--jobs', '2'])
+    assert result.exit_code == 0
+    assert '删除参数配置' in result.output
+    assert load_profile(str(dept_dir)) == {}
+
+
+def test_cli_save(monkeypatch, tmp_path):
+    """ 得分最高的参数写入配置 """
+    dept_dir = _dept_dir(tmp_path)
+    monkeypatch.setattr('open_budget.parser.tune_params.score_parallel',
+                        lambda samples, params_list, jobs: [4, 5, 3])
+    result = CliRunner().invoke(run, [str(dept_dir), '--trials', '3'])
+    assert result.exit_code == 0
+    profile = load_profile(str(dept_dir), 'camelot')
+    assert profile == candidates(PARAM_GRID, trials=3)[1]
+    assert DeptFilesParser(DEPT, str(dept_dir)).read_kwargs == dict(READ_PDF_KWARGS, **profile)
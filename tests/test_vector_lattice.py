@@ -0,0 +1,57 @@
+import os
+from click.testing import CliRunner
+from open_budget.parser.pdf_parser import READ_PDF_KWARGS, DeptFilesParser, run
+from open_budget.parser.vector_lattice import analyze_layout, extract_tables, parse_pages, read_layouts, read_pdf
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+
+
+def test_parse_pages():
+    assert parse_pages('all') is None
+    assert parse_pages('1,3,5') == {1, 3, 5}
+    assert parse_pages('2-4,7') == {2, 3, 4, 7}
+
+
+def test_read_pdf():
+    tables = read_pdf(os.path.join(PDF_DIR, '江苏省人大办公厅', '江苏省人大办公厅2017年度预算公开.pdf'), '7,9',
+                      READ_PDF_KWARGS['layout_kwargs'], READ_PDF_KWARGS['copy_text'], READ_PDF_KWARGS['strip_text'])
+    assert [(table.page, table.df.shape) for table in tables] == [(7, (11, 6)), (9, (3, 4)), (9, (8, 3))]
+    df = tables[0].df
+    # 合并单元格的文字复制到右边, 上下合并的单元格文字在上面的格子
+    assert list(df.iloc[0]) == ['收入', '收入', '支出', '支出', '支出', '支出']
+    assert list(df.iloc[1]) == ['项目名称', '金额', '功能分类', '功能分类', '支出用途', '支出用途']
+    assert list(df.iloc[2]) == ['', '', '功能科目名称', '金额', '项目名称', '金额']
+    assert list(df.iloc[3, :2]) == ['一、财政拨款', '13,649.07']
+
+
+def test_read_layouts():
+    """ 先不做版面分析读取页面, 再用参数做版面分析, 结果和read_pdf一样, 并且可以重复分析 """
+    file_path = os.path.join(PDF_DIR, '江苏省人大办公厅', '江苏省人大办公厅2017年度预算公开.pdf')
+    expected = read_pdf(file_path, '7,9', READ_PDF_KWARGS['layout_kwargs'], READ_PDF_KWARGS['copy_text'],
+                        READ_PDF_KWARGS['strip_text'])
+    layouts = read_layouts(file_path, '7,9')
+    assert [number for number, _ in layouts] == [7, 9]
+    for _ in range(2):
+        tables = [table for number, raw in layouts
+                  for table in extract_tables(analyze_layout(raw, READ_PDF_KWARGS['layout_kwargs']), number,
+                                              READ_PDF_KWARGS['copy_text'], READ_PDF_KWARGS['strip_text'])]
+        assert [table.page for table in tables] == [table.page for table in expected]
+        assert all(table.df.equals(other.df) for table, other in zip(tables, expected))
+
+
+def test_same_as_camelot():
+    path = os.path.join(PDF_DIR, '江苏省人民检察院')
+    dfs = list()
+    for backend in ('camelot', 'vector'):
+        parser = DeptFilesParser('江苏省人民检察院', path, backend=backend)
+        parser.parse()
+        dfs.append(parser.parsers[0].parsed_df)
+    assert dfs[0].equals(dfs[1])
+
+
+def test_cli_backend(tmp_path):
+    metrics_path = str(tmp_path / 'metrics.json')
+    result = CliRunner().invoke(run, [os.path.join(PDF_DIR, '江苏省委办公厅'), '--backend', 'vector', '--no-cache',
+                                      '--full', '--output', 'csv', '--metrics', metrics_path])
+    assert result.exit_code == 0
+    assert 'vector' in result.output
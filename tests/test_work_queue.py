@@ -0,0 +1,108 @@
+import os
+import shutil
+import time
+
+import pandas as pd
+from click.testing import CliRunner
+
+from open_budget.parser.pdf_parser import DeptFilesParser
+from open_budget.parser.work_queue import Heartbeat, WorkQueue
+from open_budget.pipeline.parse_cluster import cli
+
+PDF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_files', 'jszwfw')
+DEPT = '江苏省人民检察院'
+
+
+def _dept_dir(tmp_path):
+    dept_dir = tmp_path / 'jszwfw' / DEPT
+    shutil.copytree(os.path.join(PDF_DIR, DEPT), dept_dir, ignore=shutil.ignore_patterns('*.csv', '.*'))
+    return dept_dir
+
+
+def _files(dept_dir):
+    return sorted(DeptFilesParser(DEPT, str(dept_dir)).list_files())
+
+
+def test_lease_takeover(tmp_path):
+    """ 租约过期的任务被别的节点接手, 原来的节点不能续租和提交, 每个任务只有一个结果 """
+    dept_dir = _dept_dir(tmp_path)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), lease=0.1)
+    assert queue.enqueue(DEPT, str(dept_dir), _files(dept_dir)[:1]) == 1
+    crashed = queue.claim('node1')
+    assert crashed.file_path == os.path.normpath(_files(dept_dir)[0][0])
+    assert queue.claim('node2') is None     # 租约还没过期
+    time.sleep(0.2)
+    job = queue.claim('node2')
+    assert (job.id, job.token, job.attempts) == (crashed.id, crashed.token + 1, 2)
+    assert not queue.heartbeat(crashed)
+    assert queue.heartbeat(job)
+    assert queue.complete(job, b'node2', 'node2')
+    assert not queue.complete(crashed, b'node1', 'node1')
+    assert list(queue.results(str(dept_dir))) == [b'node2']
+    assert queue.is_finished()
+
+
+def test_retry(tmp_path):
+    dept_dir = _dept_dir(tmp_path)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), max_attempts=2)
+    queue.enqueue(DEPT, str(dept_dir), _files(dept_dir)[:1])
+    queue.fail(queue.claim('node1'), 'ValueError()')
+    assert queue.counts()['pending'] == 1
+    queue.fail(queue.claim('node1'), 'ValueError()')
+    assert queue.counts()['failed'] == 1
+    assert queue.failed() == [(DEPT, os.path.basename(_files(dept_dir)[0][0]), 2, 'ValueError()')]
+    assert queue.claim('node1') is None
+    assert queue.is_finished()
+
+
+def test_enqueue_changed(tmp_path):
+    dept_dir = _dept_dir(tmp_path)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'))
+    files = _files(dept_dir)
+    assert queue.enqueue(DEPT, str(dept_dir), files) == len(files)
+    while True:
+        job = queue.claim('node1')
+        if job is None:
+            break
+        queue.complete(job, b'', 'node1')
+    assert queue.enqueue(DEPT, str(dept_dir), files) == 0
+    with open(files[0][0], 'ab') as f:
+        f.write(b'\n')
+    assert queue.enqueue(DEPT, str(dept_dir), files) == 1
+    assert queue.counts() == {'pending': 1, 'running': 0, 'done': len(files) - 1, 'failed': 0}
+    assert queue.enqueue(DEPT, str(dept_dir), files, reset=True) == len(files)
+
+
+def test_heartbeat(tmp_path):
+    dept_dir = _dept_dir(tmp_path)
+    queue = WorkQueue(str(tmp_path / 'queue.sqlite'), lease=0.3)
+    queue.enqueue(DEPT, str(dept_dir), _files(dept_dir)[:1])
+    job = queue.claim('node1')
+    with Heartbeat(queue, job) as heartbeat:
+        time.sleep(0.6)     # 超过租约, 但是一直在续租
+        assert queue.claim('node2') is None
+    assert not heartbeat.lost
+
+
+def test_cluster(tmp_path):
+    """ 一个节点崩溃, 其他节点接手, 合并的结果和直接解析一样 """
+    dept_dir = _dept_dir(tmp_path)
+    queue_path = str(tmp_path / 'queue.sqlite')
+    runner = CliRunner()
+    result = runner.invoke(cli, ['enqueue', queue_path, str(dept_dir)])
+    assert result.exit_code == 0
+    WorkQueue(queue_path, lease=0.1).claim('crashed')
+    result = runner.invoke(cli, ['finalize', queue_path])
+    assert '还有任务没有结束' in result.output
+    time.sleep(0.2)
+    result = runner.invoke(cli, ['work', queue_path, '--jobs', '2', '--backend', 'vector', '--no-cache'])
+    assert result.exit_code == 0
+    assert WorkQueue(queue_path).counts()['done'] == len(_files(dept_dir))
+    result = runner.invoke(cli, ['finalize', queue_path, '--output', 'csv'])
+    assert result.exit_code == 0
+
+    expected = DeptFilesParser(DEPT, str(dept_dir), backend='vector')
+    expected.parse()
+    df = pd.read_csv(dept_dir / '收支预算总表.csv', index_col=0, parse_dates=True)
+    expected_df = expected.parsers[0].parsed_df
+    assert df.sort_index().equals(expected_df.sort_index()[df.columns])